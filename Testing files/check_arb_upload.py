@@ -0,0 +1,34 @@
+# Offline check of SignalGenerator.load_arb against the simulated 33500B: waveforms left in volatile
+# memory by an earlier run are replaced, not silently kept
+import os
+import sys
+
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'src'))
+from classes.instruments import SignalGenerator, instrument_addresses
+from classes.sessions import SessionPool
+from classes.simulator import SimulatedResourceManager
+
+address = instrument_addresses['generator1']
+rm = SimulatedResourceManager(time_scale=0)
+resource = rm.open_resource(address)
+first = np.sin(2 * np.pi * np.arange(1000) / 1000)
+second = np.sign(first)
+
+# First run uploads, an identical reload only selects the waveform
+generator = SignalGenerator(address, pool=SessionPool(rm))
+assert generator.load_arb(first, 1e6)
+assert not generator.load_arb(first, 1e6)
+
+# A new run (fresh pool, so an empty cache) finds ARB1 in volatile memory and replaces it
+generator = SignalGenerator(address, pool=SessionPool(rm))
+assert generator.load_arb(second, 1e6)
+assert np.array_equal(resource.arbs[(1, 'ARB1')], np.round(second * 32767).astype('<i2'))
+assert not resource.errors, resource.errors
+print('load_arb replaces waveforms left over from an earlier run')
+
+# Uploading under a name that is already there is an error, which check_errors picks up
+generator.session.write_binary_values('SOUR1:DATA:ARB:DAC ARB1,', np.zeros(8, '<i2'), datatype='h')
+assert generator.check_errors(), 'duplicate arb name was accepted'
+print('duplicate arb names are rejected')
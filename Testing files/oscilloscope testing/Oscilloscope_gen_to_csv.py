@@ -1,8 +1,12 @@
 import pyvisa
+import sys
 import time
 import numpy as np
 import os
 
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', '..', 'src'))
+from classes.instruments import SignalGenerator
+
 # Addresses
 gen_address  = 'USB0::0x0957::0x2707::MY62004397::0::INSTR'
 osc_address = 'USB0::0x2A8D::0x4704::MY65120148::INSTR'
@@ -16,27 +20,23 @@ use_arb = os.path.exists(arb_file)
 rm = pyvisa.ResourceManager()
 
 
-with rm.open_resource(gen_address) as gen:
-    gen.write_termination = '\n'
-    gen.timeout = 5000
-    gen.write('*RST')
-    gen.write('*CLS')
-    if use_arb:
-        # Load arbitrary waveform from CSV (expects one column of floats, normalized -1 to 1)
-        arb_data = np.loadtxt(arb_file, delimiter=',')
-        arb_data = np.clip(arb_data, -1, 1)
-        arb_data_int = ((arb_data + 1) * 8191.5).astype(int)  # 0 to 16383 for 14-bit
-        arb_str = ','.join(str(val) for val in arb_data_int)
-        gen.write('DATA VOLATILE,' + arb_str)
-        gen.write('FUNC:USER VOLATILE')
-        gen.write('FUNC:SHAP USER')
-        gen.write('VOLT 0.05')  # 1 Vpp
-        gen.write('FREQ 2000')  # 2 kHz
-        print('Arbitrary waveform loaded and outputting.')
-    else:
-        gen.write('APPL:SIN 2000,0.05,0')  # 2 kHz, 1 Vpp (0.05 V amplitude), 0 V offset
-        gen.write('OUTP ON')
-        print('Sine wave outputting.')
+gen = SignalGenerator(gen_address, reset=True)
+gen.session.timeout = 5000
+if use_arb:
+    # Load arbitrary waveform from CSV (expects one column of floats, normalized -1 to 1)
+    arb_data = np.loadtxt(arb_file, delimiter=',')
+    # One period of the waveform every 0.5 ms (2 kHz), sent as a binary block of DAC codes
+    start = time.perf_counter()
+    gen.load_arb(arb_data, sample_rate=len(arb_data) * 2000, name='CSV_ARB', amplitude=0.05)
+    print(f'Arbitrary waveform uploaded in {(time.perf_counter() - start) * 1e3:.1f} ms')
+    gen.write('OUTP ON')
+    print('Arbitrary waveform loaded and outputting.')
+else:
+    gen.write('APPL:SIN 2000,0.05,0')  # 2 kHz, 1 Vpp (0.05 V amplitude), 0 V offset
+    gen.write('OUTP ON')
+    print('Sine wave outputting.')
+for error in gen.check_errors():
+    print('Generator error:', error)
     
 
 
@@ -49,10 +49,14 @@ with rm.open_resource(osc_address) as osc:
     osc.write(':STOP')
     osc.write(':WAV:FORM ASCii')
     osc.write(':WAV:SOUR CHAN1')
-    osc.write(':RUN')
-    time.sleep(0.5)
     osc.write(':SING')
-    time.sleep(1)
+    osc.query('*OPC?')
+    # Poll the Run bit of the operation status register instead of sleeping for a worst case time
+    deadline = time.time() + 10
+    while int(osc.query(':OPER:COND?')) & 8:
+        if time.time() > deadline:
+            raise TimeoutError('Oscilloscope did not trigger within 10 s')
+        time.sleep(0.005)
     osc.write(':WAV:POIN:MODE RAW')
     osc.write(':WAV:POIN 1000')
     data = osc.query(':WAV:DATA?')
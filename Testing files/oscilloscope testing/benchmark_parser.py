@@ -0,0 +1,50 @@
+# Parse throughput (MB/s) of classes.waveform_parser against the old float() per token approach
+import os
+import sys
+import time
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', '..', 'src'))
+from classes import waveform_parser
+from classes.simulator import SimulatedResource
+
+target_points = 10_000_000
+csv_file = os.path.join(os.path.dirname(__file__), 'oscilloscope_capture.csv')
+
+# Scale the checked-in capture up to target_points by repeating its values
+with open(csv_file, 'rb') as f:
+    capture = waveform_parser.parse_ascii_block(f.read())
+repeats = -(-target_points // len(capture))
+values = np.tile(capture, repeats)[:target_points]
+print(f'{len(capture)} points in {os.path.basename(csv_file)}, scaled to {len(values)} points')
+
+ascii_block = SimulatedResource.block(','.join(f'{v:+.5e}' for v in values).encode('ascii'))
+codes = np.round(values / (0.8 / 65536) + 32768).astype('<u2')
+word_block = SimulatedResource.block(codes.tobytes())
+preamble = {'yincrement': 0.8 / 65536, 'yorigin': 0.0, 'yreference': 32768}
+
+
+def legacy_parse(block):
+    # What plot_oscilloscope_csv.py used to do
+    data = block.decode('ascii')
+    data = data[2 + int(data[1]):]
+    return np.array([float(val) for val in data.replace('\n', ',').split(',') if val.strip()])
+
+
+def timed(label, func, n_bytes):
+    start = time.perf_counter()
+    result = func()
+    elapsed = time.perf_counter() - start
+    print(f'  {label:32s} {elapsed*1e3:9.1f} ms  {n_bytes / elapsed / 1e6:9.1f} MB/s  ({len(result)} points)')
+    return result
+
+
+print(f'ASCII block: {len(ascii_block) / 1e6:.1f} MB, WORD block: {len(word_block) / 1e6:.1f} MB')
+legacy = timed('ASCII, float() per token', lambda: legacy_parse(ascii_block), len(ascii_block))
+fast = timed('ASCII, parse_ascii_block', lambda: waveform_parser.parse_ascii_block(ascii_block), len(ascii_block))
+raw = timed('WORD, parse_binary_block', lambda: waveform_parser.parse_binary_block(word_block), len(word_block))
+volts = timed('WORD, parse + scale_codes', lambda: waveform_parser.scale_codes(
+    waveform_parser.parse_binary_block(word_block), preamble), len(word_block))
+
+assert np.allclose(legacy, fast)
+assert np.allclose(volts, values, atol=0.8 / 65536)
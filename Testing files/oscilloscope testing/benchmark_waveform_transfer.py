@@ -0,0 +1,50 @@
+# Compare the ASCII and binary (WORD/BYTE) waveform transfer paths offline, using the simulated scope
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', '..', 'src'))
+from classes.instruments import Oscilloscope, instrument_addresses
+from classes.sessions import SessionPool
+from classes.simulator import SimulatedResourceManager
+
+points_list = [1000, 100000, 1000000]
+repeats = 3
+
+pool = SessionPool(SimulatedResourceManager())
+scope = Oscilloscope(instrument_addresses['oscilloscope'], pool=pool)
+
+for points in points_list:
+    results = {}
+    for label, read in [('ASCII', lambda: scope.read_waveform_ascii(1, points)),
+                        ('WORD', lambda: scope.read_waveform(1, points, format='WORD')),
+                        ('BYTE', lambda: scope.read_waveform(1, points, format='BYTE'))]:
+        read()  # Warm up (the simulator caches the generated block)
+        best_wall = best_cpu = float('inf')
+        for _ in range(repeats):
+            wall, cpu = time.perf_counter(), time.process_time()
+            data = read()
+            best_wall = min(best_wall, time.perf_counter() - wall)
+            best_cpu = min(best_cpu, time.process_time() - cpu)
+        results[label] = (best_wall, best_cpu, len(data))
+
+    print(f'{points} points:')
+    for label, (wall, cpu, n) in results.items():
+        speedup = results['ASCII'][0] / wall
+        print(f'  {label:5s} wall {wall*1e3:9.2f} ms  cpu {cpu*1e3:9.2f} ms  ({n} samples, {speedup:5.1f}x vs ASCII)')
+
+# Segmented, multi-channel capture: one arm and one block per channel versus one read per segment
+segments, points = 1000, 1000
+start = time.perf_counter()
+data = scope.capture(channels=[1, 2, 3, 4], segments=segments, points=points)
+batched = time.perf_counter() - start
+scope.write(':ACQ:MODE RTIM')
+start = time.perf_counter()
+for _ in range(segments):
+    for channel in [1, 2, 3, 4]:
+        scope.read_waveform(channel, points)
+looped = time.perf_counter() - start
+print(f'{segments} segments x 4 channels {data.shape}: capture() {batched*1e3:.1f} ms, '
+      f'per-segment reads {looped*1e3:.1f} ms ({looped / batched:.1f}x)')
+
+pool.close_all()
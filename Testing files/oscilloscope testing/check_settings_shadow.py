@@ -0,0 +1,58 @@
+# Offline checks of the settings shadow against the simulated instruments: actions are always sent,
+# aliases of one setting share a shadow entry and rejected settings are forgotten
+import os
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', '..', 'src'))
+from classes import tracing
+from classes.instruments import Oscilloscope, SignalGenerator, instrument_addresses
+from classes.sessions import SessionPool
+from classes.simulator import SimulatedResourceManager
+
+pool = SessionPool(SimulatedResourceManager())
+scope = Oscilloscope(instrument_addresses['oscilloscope'], pool=pool)
+generator = SignalGenerator(instrument_addresses['generator1'], pool=pool)
+tracer = tracing.enable()
+
+
+def sent(prefix):
+    return sum(1 for record in tracer.records
+               if record[3] == 'write' and record[4].lstrip(':').upper().startswith(prefix))
+
+
+# Two identical captures must each arm a new acquisition
+scope.capture(channels=[1, 2], points=1000)
+scope.capture(channels=[1, 2], points=1000)
+assert sent('DIG') == 2, f'expected two :DIG writes, got {sent("DIG")}'
+print('capture() sends :DIG every time')
+
+# OUTP and OUTP1 are the same setting, so switching it off through one spelling is seen by the other
+tracer.clear()
+generator.enable_output(True)
+generator.configure(1, output=False)
+generator.enable_output(True)
+assert sent('OUTP') == 3, f'expected three output writes, got {sent("OUTP")}'
+assert generator.shadow['OUTP'] == '1.0'
+print('OUTP / OUTP1 share one shadow entry')
+
+# Only known long forms are shortened, other keywords never collapse onto one key
+assert generator._normalise_header('SOURce1:Frequency') == 'FREQ'
+assert generator._normalise_header('Function') != generator._normalise_header('Frequency')
+
+# A setting the instrument rejects is dropped from the shadow when the batch is synced, so it is sent again
+with generator.batch() as batch:
+    generator.write('SOUR1:FUNC:ARB MISSING')
+assert batch.failed and 'FUNC:ARB' not in generator.shadow
+generator.check_errors()
+tracer.clear()
+generator.write('SOUR1:FUNC:ARB MISSING')
+assert sent('SOUR1:FUNC:ARB') == 1
+generator.check_errors()
+print('rejected settings are not shadowed')
+
+# Action headers are never shadowed, so verify_shadow only queries real settings
+assert not any(header.startswith(('DIG', 'SING')) for header in scope.shadow)
+print('stale settings after verify_shadow:', scope.verify_shadow(), generator.verify_shadow())
+
+tracing.disable()
+pool.close_all()
@@ -3,17 +3,47 @@ import os
 import tkinter as tk
 from tkinter import messagebox
 from tkinter import ttk
-from datetime import datetime
 from PIL import Image, ImageTk
-import time
 import threading
 import subprocess
-from classes.instruments import SMU, SignalGenerator
+import asyncio
+from classes.instruments import SignalGenerator
 from classes.measurements import dual_channel, read_scope
 from classes.instruments import instrument_addresses
+from classes.async_instruments import AsyncSMU, background_loop, executor_for
+from classes.orchestrator import setup_instruments
+from classes import tracing
+from classes.results import ResultStore
 from classes.measurements_AP import Noise, TransferFunction
 
 
+def when_done(master, future, on_done, on_error=None, poll_ms=50):
+    """
+    Call on_done(result) on the Tk thread once a background future finishes.
+
+    The future is polled with master.after so Tk is only ever touched from its own thread.
+    on_error(exception) is called instead if the future raised.
+    """
+    def poll():
+        if not future.done():
+            master.after(poll_ms, poll)
+            return
+        error = future.exception()
+        if error is None:
+            on_done(future.result())
+        elif on_error is not None:
+            on_error(error)
+    master.after(poll_ms, poll)
+
+
+def outputs_off(generator):
+    """Switch both channels of a SignalGenerator off; submit it to executor_for(generator.address)."""
+    with generator.batch(sync=False):
+        for num in [1, 2]:
+            generator.write(f'OUTP{num} OFF')
+
+
+
 
 # --- Main Menu Modes ---
 class ManualTestingGUI:
@@ -152,14 +182,9 @@ class Noise_vs_FrequencyGUI:
         style.configure('TFrame', background="#ffffff")
         style.configure('TLabel', background="#ffffff", font=("Segoe UI", 12))
 
-        self.smu = SMU(instrument_addresses['SMU'])
-        self.smu.smu.write_termination = '\n'
-
+        self.smu = AsyncSMU(instrument_addresses['SMU'])
         self.signalgen = SignalGenerator(instrument_addresses['generator1'])
-        self.signalgen.sg.write_termination = '\n'
-
         self.clock = SignalGenerator(instrument_addresses['generator2'])
-        self.clock.sg.write_termination = '\n'
 
         frame = ttk.Frame(master, padding=30, style='TFrame')
         frame.pack(padx=40, pady=40)
@@ -186,7 +211,7 @@ class Noise_vs_FrequencyGUI:
         self.current_entry = ttk.Entry(input_row, font=("Segoe UI", 12), width=8)
         self.current_entry.pack(side='left', padx=(0,5))
 
-        self.power_btn = ttk.Button(input, text = "Set Power", style='Accent.Rounded.TButton', command=self.set_power)
+        self.power_btn = ttk.Button(input_row, text = "Set Power", style='Accent.Rounded.TButton', command=self.set_power)
         self.power_btn.pack(side='left', padx=(15,0))
 
         img_frame = ttk.Frame(horiz_frame)
@@ -231,6 +256,13 @@ class Noise_vs_FrequencyGUI:
         self.measure_btn.pack(pady=10)
 
 
+    @staticmethod
+    def _entry_value(entry):
+        try:
+            return float(entry.get())
+        except ValueError:
+            return None
+
     def set_power(self):
         try:
             voltage = float(self.voltage_entry.get())
@@ -240,64 +272,87 @@ class Noise_vs_FrequencyGUI:
             messagebox.showerror("Input Error", "Please enter valid numbers for voltage and current.")
             return
 
-        self.smu.smu.write(':SOUR:FUNC:MODE VOLT')
-        self.smu.smu.write('VOLT:MODE FIXED')
-        self.smu.smu.write('CURR:MODE FIXED')
-        # Increase the compliance limit for a short amount of time to make sure the capacitor charges fully and the machine does not enter constant current mode
-        self.smu.smu.write(f':SENS:CURR:PROT {1.5*current}')
-        self.smu.smu.write(f'VOLT {voltage}')
-        self.smu.smu.write('OUTP ON')
-        time.sleep(0.5)
-        # Return the machine to its original compliance limit to not break the DUT
-        self.smu.smu.write(f':SENS:CURR:PROT {current}')
-        self.smu.smu.write(f'VOLT {voltage}')
-        self.smu.smu.write('OUTP ON')
+        async def power_up():
+            # Increase the compliance limit for a short amount of time to make sure the capacitor charges fully and the machine does not enter constant current mode
+            await self.smu.source_voltage(voltage, 1.5*current)
+            # Continue as soon as the charging current has dropped, 0.5 s is only the worst case
+            await self.smu.run(self.smu.instrument.wait_for_current_below, current, timeout=0.5)
+            # Return the machine to its original compliance limit to not break the DUT
+            await self.smu.source_voltage(voltage, current)
+
+        # Runs on the instrument loop so the window stays responsive while the SMU settles
+        self.power_btn.config(state='disabled')
+        future = background_loop().submit(power_up())
+        def on_error(e):
+            self.power_btn.config(state='normal')
+            messagebox.showerror("Instrument Error", f"Could not set the power supply.\n{e}")
+        when_done(self.master, future, lambda _: self.power_btn.config(state='normal'), on_error)
 
     # Button to start noise measurement
     def start_noise_measurement(self):
-        try:
-            noise = Noise()
-            noise.setup_noise_measurement()
-            freqs, noise_vals = noise.run_noise_measurement()
+        def run():
+            with tracing.span('APx noise measurement'):
+                noise = Noise()
+                noise.setup_noise_measurement()
+                return noise.run_noise_measurement()
+
+        async def measure():
+            # The APx sequence blocks for the whole acquisition, so it runs off the Tk thread
+            return await asyncio.get_running_loop().run_in_executor(None, run)
+
+        def on_done(result):
+            self.measure_btn.config(state='normal')
+            freqs, noise_vals = result
+            try:
+                with ResultStore() as store:
+                    store.save('noise', {'frequency': freqs, 'noise_density': noise_vals},
+                               supply_voltage=self._entry_value(self.voltage_entry),
+                               supply_current_uA=self._entry_value(self.current_entry),
+                               dc_offset_mV=self._entry_value(self.dc_entry), chopping=self.chopping_var.get())
+            except Exception as e:
+                messagebox.showerror("Error", f"Could not save the noise results.\n{e}")
             messagebox.showinfo("Measurement Complete", f"Noise measurement finished.\nFrequencies: {freqs}\nNoise: {noise_vals}")
-
-            for num in [1, 2]:
-                self.signalgen.sg.write(f'SOUR{num}:OUTP OFF')
-                self.clock.sg.write(f'SOUR{num}:OUTP OFF')
+            # On each generator's I/O thread, so these writes never interleave with the async wrappers' traffic
+            for generator in [self.signalgen, self.clock]:
+                when_done(self.master, executor_for(generator.address).submit(outputs_off, generator), lambda _: None,
+                          lambda e: messagebox.showerror("Error", f"Could not turn the generators off.\n{e}"))
 
             self.voltage_entry.delete(0, tk.END)
             self.current_entry.delete(0, tk.END)
 
-        except Exception as e:
+        def on_error(e):
+            self.measure_btn.config(state='normal')
             messagebox.showerror("Error", f"Noise measurement failed.\n{e}")
 
+        self.measure_btn.config(state='disabled')
+        when_done(self.master, background_loop().submit(measure()), on_done, on_error)
+
     def set_signal(self):
         offset = float(self.dc_entry.get())/1000
         v_dd = float(self.voltage_entry.get())
 
         if self.chopping_var.get() == "ON":
-            for num in [1, 2]:
-                self.clock.sg.write(f'SOUR{num}:FUNC SQU')
-                self.clock.sg.write(f'SOUR{num}:FREQ 4000')
-                self.clock.sg.write(f'SOUR{num}:VOLT {v_dd}')
-                self.clock.sg.write(f'SOUR{num}:VOLT:OFFS {v_dd/2}')
-            self.clock.sg.write('SOUR1:PHAS 0')
-            self.clock.sg.write('SOUR2:PHAS 180')
-            self.clock.sg.write('PHAS:SYNC')
-            for num in [1, 2]:
-                self.clock.sg.write(f'SOUR{num}:OUTP ON')
-        elif self.chopping_var.get() == "OFF":
-            for num in [1, 2]:
-                self.clock.sg.write(f'SOUR{num}:FUNC DC')
-            self.clock.sg.write('SOUR1:VOLT:OFFS 0')
-            self.clock.sg.write(f'SOUR2:VOLT:OFFS {v_dd}')
-            for num in [1, 2]:
-                self.clock.sg.write(f'SOUR{num}:OUTP ON')
-
-        for num in [1, 2]:
-            self.signalgen.sg.write(f'SOUR{num}:FUNC DC')
-            self.signalgen.sg.write(f'SOUR{num}:VOLT:OFFS {offset}')
-            self.signalgen.sg.write(f'SOUR{num}:OUTP ON')
+            clock = {'kind': 'generator', 'address': instrument_addresses['generator2'],
+                     'channels': {num: {'function': 'SQU', 'frequency': 4000, 'amplitude': v_dd, 'offset': v_dd/2}
+                                  for num in [1, 2]},
+                     'outputs': [1, 2], 'phase_sync': True}
+            clock['channels'][1]['phase'] = 0
+            clock['channels'][2]['phase'] = 180
+        else:
+            clock = {'kind': 'generator', 'address': instrument_addresses['generator2'],
+                     'channels': {1: {'function': 'DC', 'offset': 0}, 2: {'function': 'DC', 'offset': v_dd}},
+                     'outputs': [1, 2]}
+        signal = {'kind': 'generator', 'address': instrument_addresses['generator1'],
+                  'channels': {num: {'function': 'DC', 'offset': offset} for num in [1, 2]},
+                  'outputs': [1, 2]}
+
+        # Both generators are configured at the same time and enabled together after an *OPC? barrier
+        self.signal_btn.config(state='disabled')
+        future = background_loop().submit(setup_instruments({'clock': clock, 'signal': signal}))
+        def on_error(e):
+            self.signal_btn.config(state='normal')
+            messagebox.showerror("Instrument Error", f"Could not configure the generators.\n{e}")
+        when_done(self.master, future, lambda _: self.signal_btn.config(state='normal'), on_error)
 
 class TransferFunctionGUI: ################################## WORK IN PROGRESS ##############################################
     """
@@ -388,8 +443,8 @@ class SMU_GUI:
             bordercolor=[('focus', '#388E3C'), ('!focus', '#4CAF50')]
         )
 
-        self.smu = SMU(instrument_addresses['SMU'])
-        self.smu.smu.write_termination = '\n'
+        self.smu = AsyncSMU(instrument_addresses['SMU'])
+        self.sampler = None  # Streams the output current while the output is on
 
         # Main frame
         frame = ttk.Frame(master, padding=20, style='TFrame')
@@ -437,20 +492,26 @@ class SMU_GUI:
             messagebox.showerror("Input Error", "Please enter positive numbers for voltage, current, and time.")
             return
 
-        self.smu.smu.write(':SOUR:FUNC:MODE VOLT')
-        self.smu.smu.write('VOLT:MODE FIXED')
-        self.smu.smu.write('CURR:MODE FIXED')
-        self.smu.smu.write(f':SENS:CURR:PROT {current}')
-        self.smu.smu.write(f'VOLT {voltage}')
-        self.smu.smu.write('OUTP ON')
+        async def power_up():
+            await self.smu.source_voltage(voltage, current)
+            # Started from a worker thread, the sampler queues its own transfers on the SMU's I/O thread
+            return await asyncio.get_running_loop().run_in_executor(None, self.smu.instrument.stream_current)
 
-        self._countdown_time = int(duration)
-        self._countdown_active = True
-        self._countdown_status(voltage, current)
+        def start_countdown(sampler):
+            self.sampler = sampler
+            self._countdown_time = int(duration)
+            self._countdown_active = True
+            self._countdown_status(voltage, current)
+
+        self.status.set("Turning output on...")
+        future = background_loop().submit(power_up())
+        when_done(self.master, future, start_countdown, lambda e: self.status.set(f"Error: {e}"))
 
     def _countdown_status(self, voltage, current):
         if self._countdown_active and self._countdown_time > 0:
-            self.status.set(f"Output ON: {voltage} V, {current} A | Time left: {self._countdown_time} s")
+            stats = self.sampler.stats() if self.sampler is not None else None
+            measured = f" | I mean {stats['mean']*1e6:.3f} µA, peak {stats['peak']*1e6:.3f} µA" if stats else ""
+            self.status.set(f"Output ON: {voltage} V, {current} A{measured} | Time left: {self._countdown_time} s")
             self._countdown_time -= 1
             self.master.after(1000, lambda: self._countdown_status(voltage, current))
         else:
@@ -458,9 +519,15 @@ class SMU_GUI:
 
     def turn_off(self):
         self._countdown_active = False
-        self.smu.smu.write('OUTP OFF')
-        self.smu.smu.write('VOLT 0')
-        self.smu.smu.write('CURR 0')
+        sampler, self.sampler = self.sampler, None
+
+        async def power_down():
+            if sampler is not None:
+                await asyncio.get_running_loop().run_in_executor(None, sampler.stop)
+            await self.smu.output_off()
+
+        future = background_loop().submit(power_down())
+        when_done(self.master, future, lambda _: None, lambda e: self.status.set(f"Error: {e}"))
         self.voltage_entry.delete(0, tk.END)
         self.current_entry.delete(0, tk.END)
         self.time_entry.delete(0, tk.END)
@@ -652,35 +719,41 @@ class SignalGeneratorGUI:
 
         def show_double_gui_input(self):
             type_ = self.type
-            if type_ == 'DC':
-                # For DC, use offset as output voltage
-                for num in [1, 2]:
-                    self.sg.sg.write(f'SOUR{num}:FUNC {type_}')
-                    self.sg.sg.write(f'SOUR{num}:VOLT:OFFS {offset/1000}')
-                # No phase, frequency, or amplitude commands for DC
-            else:
-                for num in [1, 2]:
-                    self.sg.sg.write(f'SOUR{num}:FUNC {type_}')
-                    self.sg.sg.write(f'SOUR{num}:FREQ {frequency}')
-                    self.sg.sg.write(f'SOUR{num}:VOLT {amplitude/1000}')
-                    self.sg.sg.write(f'SOUR{num}:VOLT:OFFS {offset/1000}')
-                # Set phase according to phase_mode
-                if phase_mode_value == 'Antiphase':
-                    self.sg.sg.write('SOUR1:PHAS 0')
-                    self.sg.sg.write('SOUR2:PHAS 180')
-                else:
-                    self.sg.sg.write('SOUR1:PHAS 0')
-                    self.sg.sg.write('SOUR2:PHAS 0')
-                self.sg.sg.write('PHAS:SYNC')
-            for num in [1, 2]:
-                self.sg.sg.write(f'OUTP{num} ON')
-            if type_ != 'DC':
-                self.sg.sg.write('PHAS:SYNC')
-            time.sleep(self.duration)
+            # The writes go through the generator's I/O executor, only the hold runs on this thread
+            executor_for(self.sg.address).submit(start_input, self, type_).result()
+            # Returns early when Stop sets the event
+            with tracing.span('output hold', self.sg.address):
+                self.stop_event.wait(self.duration)
             # Only send OFF if not stopped
             if not getattr(self, '_stop_generators', False):
+                executor_for(self.sg.address).submit(outputs_off, self.sg).result()
+
+        def start_input(self, type_):
+            with self.sg.batch():
+                if type_ == 'DC':
+                    # For DC, use offset as output voltage
+                    for num in [1, 2]:
+                        self.sg.write(f'SOUR{num}:FUNC {type_}')
+                        self.sg.write(f'SOUR{num}:VOLT:OFFS {offset/1000}')
+                    # No phase, frequency, or amplitude commands for DC
+                else:
+                    for num in [1, 2]:
+                        self.sg.write(f'SOUR{num}:FUNC {type_}')
+                        self.sg.write(f'SOUR{num}:FREQ {frequency}')
+                        self.sg.write(f'SOUR{num}:VOLT {amplitude/1000}')
+                        self.sg.write(f'SOUR{num}:VOLT:OFFS {offset/1000}')
+                    # Set phase according to phase_mode
+                    if phase_mode_value == 'Antiphase':
+                        self.sg.write('SOUR1:PHAS 0')
+                        self.sg.write('SOUR2:PHAS 180')
+                    else:
+                        self.sg.write('SOUR1:PHAS 0')
+                        self.sg.write('SOUR2:PHAS 0')
+                    self.sg.write('PHAS:SYNC')
                 for num in [1, 2]:
-                    self.sg.sg.write(f'OUTP{num} OFF')
+                    self.sg.write(f'OUTP{num} ON')
+                if type_ != 'DC':
+                    self.sg.write('PHAS:SYNC')
 
         self.input_sg._stop_generators = False
         self.input_sg.show_double = show_double_gui_input.__get__(self.input_sg)
@@ -692,24 +765,27 @@ class SignalGeneratorGUI:
         if self.use_clock.get():
             # Clock type is always 'square'
             self.clock_sg = dual_channel(instrument_addresses['generator2'], type='square', duration=duration)
+            def start_clock(self, type_):
+                with self.sg.batch():
+                    for num in [1, 2]:
+                        self.sg.write(f'SOUR{num}:FUNC {type_}')
+                        self.sg.write(f'SOUR{num}:FREQ {clock_frequency}')
+                        self.sg.write(f'SOUR{num}:VOLT {clock_amplitude/1000}')
+                        self.sg.write(f'SOUR{num}:VOLT:OFFS {clock_offset/1000}')
+                    self.sg.write('SOUR1:PHAS 0')
+                    self.sg.write('SOUR2:PHAS 180')
+                    self.sg.write('PHAS:SYNC')
+                    for num in [1, 2]:
+                        self.sg.write(f'OUTP{num} ON')
+                    self.sg.write('PHAS:SYNC')
+
             def show_double_gui_clock(self):
-                type_ = self.type
-                for num in [1, 2]:
-                    self.sg.sg.write(f'SOUR{num}:FUNC {type_}')
-                    self.sg.sg.write(f'SOUR{num}:FREQ {clock_frequency}')
-                    self.sg.sg.write(f'SOUR{num}:VOLT {clock_amplitude/1000}')
-                    self.sg.sg.write(f'SOUR{num}:VOLT:OFFS {clock_offset/1000}')
-                self.sg.sg.write('SOUR1:PHAS 0')
-                self.sg.sg.write('SOUR2:PHAS 180')
-                self.sg.sg.write('PHAS:SYNC')
-                for num in [1, 2]:
-                    self.sg.sg.write(f'OUTP{num} ON')
-                self.sg.sg.write('PHAS:SYNC')
-                time.sleep(self.duration)
+                executor_for(self.sg.address).submit(start_clock, self, self.type).result()
+                with tracing.span('output hold', self.sg.address):
+                    self.stop_event.wait(self.duration)
                 # Only send OFF if not stopped
                 if not getattr(self, '_stop_generators', False):
-                    for num in [1, 2]:
-                        self.sg.sg.write(f'OUTP{num} OFF')
+                    executor_for(self.sg.address).submit(outputs_off, self.sg).result()
             self.clock_sg._stop_generators = False
             self.clock_sg.show_double = show_double_gui_clock.__get__(self.clock_sg)
             t2 = threading.Thread(target=self.clock_sg.show_double)
@@ -741,20 +817,17 @@ class SignalGeneratorGUI:
         # Stop the countdown and update status immediately
         self._countdown_active = False
         # Set stop flag so threads don't send OFF after close
-        if self.input_sg:
-            self.input_sg._stop_generators = True
-        if self.clock_sg:
-            self.clock_sg._stop_generators = True
-        # Immediately turn off outputs if possible
+        for sg in [self.input_sg, self.clock_sg]:
+            if sg:
+                sg._stop_generators = True
+                sg.stop_event.set()
+        # Immediately turn off outputs if possible, queued on each generator's I/O thread
         for sg in [self.input_sg, self.clock_sg]:
             if sg and hasattr(sg, 'sg') and hasattr(sg.sg, 'sg'):
-                try:
-                    sg.sg.sg.write('OUTP1 OFF')
-                    sg.sg.sg.write('OUTP2 OFF')
-                except Exception:
-                    pass
-        # Give threads a moment to check the flag
-        time.sleep(0.1)
+                executor_for(sg.sg.address).submit(outputs_off, sg.sg)
+        # The stop event wakes the threads immediately, wait for them to finish
+        for t in getattr(self, '_generator_threads', []):
+            t.join(timeout=1.0)
         if self.input_sg:
             self.input_sg.sg.close()
             self.input_sg = None
@@ -772,7 +845,7 @@ class OscilloscopeGUI:
         master: The main application window.
 
     Methods:
-        read_and_save: Reads data from the oscilloscope and saves it to a file.
+        read_and_save: Reads data from the oscilloscope and saves it to the results file.
     """
     def __init__(self, master):
         self.master = master
@@ -825,21 +898,20 @@ class OscilloscopeGUI:
     def read_and_save(self):
         try:
             scope_reader = read_scope()
-            data = scope_reader.read()  # Assumes read() returns the scope data as a string or bytes
+            data = scope_reader.read_waveform()
+            preamble = scope_reader.scope.preamble
+            settings = dict(scope_reader.scope.shadow)
+            scope_reader.scope.close()
             label = self.label_entry.get().strip().replace(' ', '_')
             if not label:
                 label = "unlabeled"
-            today = datetime.now().strftime('%Y-%m-%d_%H-%M-%S')
-            scope_filename = f"scope_{label}_{today}.txt"
-            comment_filename = f"scope_{label}_{today}_comments.txt"
-            # Save scope output
-            with open(scope_filename, "w") as f:
-                f.write(data if isinstance(data, str) else data.decode())
-            # Save comment
             comment = self.comment_text.get("1.0", tk.END).strip()
-            with open(comment_filename, "w") as f:
-                f.write(comment)
-            self.status.set(f"Scope data saved to {scope_filename}, comment saved to {comment_filename}")
+            # One compressed run in the results file, with the comment, settings and scaling as attributes
+            with ResultStore() as store:
+                run = store.save('scope', {'voltage': data}, label=label, comment=comment, settings=settings,
+                                 address=scope_reader.scope.address,
+                                 **{f'preamble_{key}': value for key, value in preamble.items()})
+            self.status.set(f"Scope data saved to {store.path} as {run}")
         except Exception as e:
             self.status.set(f"Error: {e}")
 
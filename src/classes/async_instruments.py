@@ -0,0 +1,147 @@
+# asyncio front end for the instrument classes, so independent instruments can work at the same time
+import asyncio
+import functools
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from classes.instruments import SMU, SignalGenerator, Oscilloscope
+
+# One single-threaded executor per VISA address: calls to the same instrument stay in
+# order (VISA sessions are not thread safe), calls to different instruments overlap.
+_executors = {}
+_executors_lock = threading.Lock()
+
+
+def executor_for(address):
+    """Return the I/O executor that owns all traffic to address."""
+    with _executors_lock:
+        if address not in _executors:
+            _executors[address] = ThreadPoolExecutor(max_workers=1, thread_name_prefix=f'visa-{address}')
+        return _executors[address]
+
+
+def shutdown_executors():
+    with _executors_lock:
+        executors = list(_executors.values())
+        _executors.clear()
+    for executor in executors:
+        executor.shutdown(wait=True)
+
+
+class AsyncInstrument:
+    """
+    Wraps a synchronous Instrument and runs its calls on the instrument's own I/O thread.
+
+    Attributes:
+        instrument: The wrapped synchronous instrument.
+
+    Methods:
+        run: Runs any method of the wrapped instrument without blocking the event loop.
+        write: Awaitable Instrument.write.
+        query: Awaitable Instrument.query.
+        sync: Awaitable *OPC? barrier.
+    """
+    def __init__(self, instrument):
+        self.instrument = instrument
+        self._executor = executor_for(instrument.address)
+
+    async def run(self, func, *args, **kwargs):
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self._executor, functools.partial(func, *args, **kwargs))
+
+    async def write(self, command):
+        return await self.run(self.instrument.write, command)
+
+    async def query(self, command):
+        return await self.run(self.instrument.query, command)
+
+    async def sync(self):
+        """Wait until the instrument has finished every pending operation."""
+        return await self.query('*OPC?')
+
+
+class AsyncSMU(AsyncInstrument):
+    """
+    Async wrapper of SMU.
+
+    Methods:
+        source_voltage: Awaitable SMU.source_voltage.
+        output_off: Awaitable SMU.output_off.
+    """
+    def __init__(self, address, reset=False, pool=None):
+        super().__init__(SMU(address, reset, pool))
+
+    async def source_voltage(self, voltage, current_limit, enable=True):
+        return await self.run(self.instrument.source_voltage, voltage, current_limit, enable)
+
+    async def output_off(self):
+        return await self.run(self.instrument.output_off)
+
+
+class AsyncSignalGenerator(AsyncInstrument):
+    """
+    Async wrapper of SignalGenerator.
+
+    Methods:
+        configure: Awaitable SignalGenerator.configure for one channel.
+        enable_output: Awaitable SignalGenerator.enable_output.
+    """
+    def __init__(self, address, reset=False, pool=None):
+        super().__init__(SignalGenerator(address, reset, pool))
+
+    async def configure(self, channel=1, **settings):
+        return await self.run(self.instrument.configure, channel, **settings)
+
+    async def enable_output(self, enable=True):
+        return await self.run(self.instrument.enable_output, enable)
+
+
+class AsyncOscilloscope(AsyncInstrument):
+    """
+    Async wrapper of Oscilloscope.
+
+    Methods:
+        read_waveform: Awaitable Oscilloscope.read_waveform.
+        capture: Awaitable Oscilloscope.capture.
+    """
+    def __init__(self, address, reset=False, pool=None):
+        super().__init__(Oscilloscope(address, reset, pool))
+
+    async def read_waveform(self, channel=1, points=None, format='WORD'):
+        return await self.run(self.instrument.read_waveform, channel, points, format)
+
+    async def capture(self, channels=(1, 2, 3, 4), segments=1, points=None, format='WORD', timeout=None):
+        return await self.run(self.instrument.capture, channels, segments, points, format, timeout)
+
+
+class EventLoopThread:
+    """
+    An asyncio event loop running in a daemon thread, for use from the Tkinter GUIs.
+
+    The Tk main loop cannot await, so GUIs submit coroutines here and poll the returned
+    concurrent.futures.Future with master.after() instead of blocking on VISA calls.
+
+    Methods:
+        submit: Schedules a coroutine on the loop and returns a concurrent.futures.Future.
+        stop: Stops the loop.
+    """
+    def __init__(self):
+        self.loop = asyncio.new_event_loop()
+        self._thread = threading.Thread(target=self.loop.run_forever, name='instrument-loop', daemon=True)
+        self._thread.start()
+
+    def submit(self, coro):
+        return asyncio.run_coroutine_threadsafe(coro, self.loop)
+
+    def stop(self):
+        self.loop.call_soon_threadsafe(self.loop.stop)
+
+
+_background = None
+
+
+def background_loop():
+    """The shared EventLoopThread, started on first use."""
+    global _background
+    if _background is None:
+        _background = EventLoopThread()
+    return _background
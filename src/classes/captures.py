@@ -0,0 +1,215 @@
+# Lazy, memory-mapped reading of recorded captures (WAV, raw binary and .npy files)
+import os
+import struct
+from fractions import Fraction
+import numpy as np
+from scipy import signal
+
+# WAVE_FORMAT_PCM, WAVE_FORMAT_IEEE_FLOAT and WAVE_FORMAT_EXTENSIBLE
+WAV_PCM, WAV_FLOAT, WAV_EXTENSIBLE = 1, 3, 0xFFFE
+
+
+def _wav_layout(path):
+    """Walk the RIFF chunks and return (sample_rate, channels, bits, format, data_offset, data_bytes)."""
+    with open(path, 'rb') as f:
+        riff, _, wave = struct.unpack('<4sI4s', f.read(12))
+        if riff not in (b'RIFF', b'RF64') or wave != b'WAVE':
+            raise ValueError(f"{path} is not a WAV file")
+        layout = None
+        while True:
+            header = f.read(8)
+            if len(header) < 8:
+                raise ValueError(f"{path} has no data chunk")
+            chunk, size = struct.unpack('<4sI', header)
+            if chunk == b'fmt ':
+                fmt = f.read(size)
+                format_tag, channels, sample_rate = struct.unpack('<HHI', fmt[:8])
+                bits = struct.unpack('<H', fmt[14:16])[0]
+                if format_tag == WAV_EXTENSIBLE:
+                    # The real format tag is the first two bytes of the sub-format GUID
+                    format_tag = struct.unpack('<H', fmt[24:26])[0]
+                layout = (sample_rate, channels, bits, format_tag)
+            elif chunk == b'data':
+                if layout is None:
+                    raise ValueError(f"{path} has no fmt chunk before its data")
+                # Streaming writers leave the size at 0 or 0xFFFFFFFF (and RF64 keeps it elsewhere)
+                available = os.path.getsize(path) - f.tell()
+                if size in (0, 0xFFFFFFFF) or size > available:
+                    size = available
+                return layout + (f.tell(), size)
+            else:
+                f.seek(size + (size & 1), os.SEEK_CUR)
+
+
+def _scale_codes(codes, scale, zero=0, packed=False):
+    # Integer codes (or packed 24 bit bytes) to float64
+    if packed:
+        # Packed 24 bit samples: widen to int32
+        codes = codes[..., 0].astype(np.int32) | codes[..., 1].astype(np.int32) << 8 | codes[..., 2].astype(np.int32) << 16
+        codes = np.where(codes & 0x800000, codes - 0x1000000, codes)
+    return (np.asarray(codes, dtype=np.float64) - zero) * scale
+
+
+class ScaledView:
+    """
+    One channel of integer samples that is converted to floats only when used.
+
+    Slicing returns another ScaledView of the memory map without reading anything;
+    np.asarray() (which numpy, scipy and StreamingWelch.update apply to their inputs)
+    converts just the viewed samples. Code that works through a signal block by block,
+    like the Welch path of TransferFunctionAnalyzer, so only ever holds one block as
+    floats, while a full-length FFT converts the whole signal as it needs it anyway.
+
+    Attributes:
+        codes: The memory-mapped codes.
+        scale: Full scale (1.0) per code.
+        zero: Code of 0.
+        packed: Whether the codes are packed 24 bit bytes.
+    """
+    dtype = np.dtype(np.float64)
+    ndim = 1
+
+    def __init__(self, codes, scale, zero=0, packed=False):
+        self.codes = codes
+        self.scale = scale
+        self.zero = zero
+        self.packed = packed
+
+    def __len__(self):
+        return self.codes.shape[0]
+
+    @property
+    def shape(self):
+        return (len(self),)
+
+    def __getitem__(self, key):
+        if isinstance(key, slice):
+            return ScaledView(self.codes[key], self.scale, self.zero, self.packed)
+        return _scale_codes(self.codes[key], self.scale, self.zero, self.packed)
+
+    def __array__(self, dtype=None, copy=None):
+        samples = _scale_codes(self.codes, self.scale, self.zero, self.packed)
+        return samples if dtype is None else samples.astype(dtype, copy=False)
+
+
+class Capture:
+    """
+    A recorded capture, memory-mapped instead of decoded into memory.
+
+    Opening a file only parses its header: the samples stay on disk and are paged
+    in by the OS as they are touched, so a multi-GB capture opens instantly and
+    slicing it reads only the slice. view() returns a channel without converting
+    anything: float data as a view of the file, integer data as a ScaledView that
+    converts to floats only the blocks that are used. read() returns float64 copies
+    and so allocates 8 bytes per sample of the requested slice; use it for slices,
+    not whole multi-GB captures.
+
+    Attributes:
+        path: The file.
+        data: The memory map, shape (n_samples, channels), in the file's own format.
+        sample_rate: Samples per second (None if unknown for raw files).
+        channels: Number of interleaved channels.
+        scale: Full scale (1.0) per integer code, 1.0 for float data.
+
+    Methods:
+        view: One channel between two sample indices, without converting or copying.
+        read: Float64 copy of one channel (or all) between two sample indices.
+        read_seconds: The same with start and stop in seconds.
+        resample: Polyphase resampling of a slice to another rate, only when asked for.
+    """
+    def __init__(self, path, data, sample_rate, scale=1.0, zero=0, packed=False):
+        self.path = path
+        self.data = data if data.ndim >= 2 else data.reshape(-1, 1)
+        self.sample_rate = sample_rate
+        self.channels = self.data.shape[1]
+        self.scale = scale
+        self.zero = zero  # Code of 0 V, 128 for unsigned 8 bit WAV
+        self.packed = packed  # 24 bit samples kept as 3 bytes each
+
+    def __len__(self):
+        return self.data.shape[0]
+
+    @property
+    def duration(self):
+        return len(self) / self.sample_rate if self.sample_rate else None
+
+    def view(self, start=0, stop=None, channel=0):
+        """
+        Samples [start, stop) of a channel without reading or converting them.
+
+        Returns a view of the memory map for float data, a ScaledView for integer data.
+        """
+        codes = self.data[start:stop, channel]
+        if codes.dtype.kind == 'f':
+            return codes
+        return ScaledView(codes, self.scale, self.zero, self.packed)
+
+    def read(self, start=0, stop=None, channel=0):
+        """
+        Return samples [start, stop) of a channel (None for every channel, shape (n, channels)).
+
+        Float data comes back as a view of the file, integer data as a float64 copy of the
+        slice (8 bytes per sample); use view() to work through long integer captures.
+        """
+        block = self.data[start:stop] if channel is None else self.data[start:stop, channel]
+        if block.dtype.kind == 'f':
+            return block
+        return _scale_codes(block, self.scale, self.zero, self.packed)
+
+    def read_seconds(self, start=0.0, stop=None, channel=0):
+        first = int(round(start * self.sample_rate))
+        last = None if stop is None else int(round(stop * self.sample_rate))
+        return self.read(first, last, channel)
+
+    def resample(self, sample_rate, start=0, stop=None, channel=0):
+        """Resample a slice to sample_rate with scipy.signal.resample_poly (an exact rational ratio)."""
+        ratio = Fraction(sample_rate / self.sample_rate).limit_denominator(1000)
+        samples = self.read(start, stop, channel)
+        if ratio == 1:
+            return samples
+        return signal.resample_poly(samples, ratio.numerator, ratio.denominator, axis=0)
+
+
+def open_capture(path, sample_rate=None, dtype=None, channels=1, offset=0):
+    """
+    Memory-map a capture file.
+
+    Parameters:
+    - path: .wav, .npy or raw binary file
+    - sample_rate: Hz, required for raw and .npy files (WAV files carry their own)
+    - dtype: sample type of a raw file, e.g. '<i2' or '<f4'
+    - channels: interleaved channels in a raw file
+    - offset: header bytes to skip in a raw file
+
+    Returns:
+        Capture
+    """
+    extension = os.path.splitext(path)[1].lower()
+    if extension == '.wav':
+        rate, n_channels, bits, format_tag, data_offset, data_bytes = _wav_layout(path)
+        frame = n_channels * (bits // 8)
+        frames = data_bytes // frame
+        if format_tag == WAV_FLOAT and bits in (32, 64):
+            data = np.memmap(path, f'<f{bits // 8}', 'r', data_offset, (frames, n_channels))
+            return Capture(path, data, rate)
+        if format_tag != WAV_PCM:
+            raise ValueError(f"Unsupported WAV format {format_tag} in {path}")
+        if bits == 8:
+            data = np.memmap(path, np.uint8, 'r', data_offset, (frames, n_channels))
+            return Capture(path, data, rate, 1 / 128, zero=128)
+        if bits == 24:
+            data = np.memmap(path, np.uint8, 'r', data_offset, (frames, n_channels, 3))
+            # Kept packed, read() unpacks only the slice
+            return Capture(path, data, rate, 1 / 2 ** 23, packed=True)
+        if bits in (16, 32):
+            data = np.memmap(path, f'<i{bits // 8}', 'r', data_offset, (frames, n_channels))
+            return Capture(path, data, rate, 1 / 2 ** (bits - 1))
+        raise ValueError(f"Unsupported WAV sample size {bits} bits in {path}")
+    if extension == '.npy':
+        data = np.load(path, mmap_mode='r')
+        return Capture(path, data.T if data.ndim == 2 and data.shape[0] < data.shape[1] else data, sample_rate)
+    if dtype is None:
+        raise ValueError("A raw capture needs its dtype")
+    data = np.memmap(path, np.dtype(dtype), 'r', offset)
+    frames = len(data) // channels
+    return Capture(path, data[:frames * channels].reshape(frames, channels), sample_rate)
@@ -0,0 +1,260 @@
+# SQLite index of every stored run, for finding runs across boards and sessions without opening data files
+import argparse
+import glob
+import json
+import os
+import sqlite3
+import sys
+import numpy as np
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS runs (
+    id INTEGER PRIMARY KEY,
+    kind TEXT NOT NULL,
+    label TEXT,
+    created TEXT,
+    comment TEXT,
+    file TEXT NOT NULL,
+    run TEXT NOT NULL,
+    UNIQUE (file, run)
+);
+CREATE TABLE IF NOT EXISTS parameters (
+    run_id INTEGER NOT NULL REFERENCES runs (id) ON DELETE CASCADE,
+    name TEXT NOT NULL,
+    value REAL,
+    text TEXT
+);
+CREATE TABLE IF NOT EXISTS statistics (
+    run_id INTEGER NOT NULL REFERENCES runs (id) ON DELETE CASCADE,
+    dataset TEXT NOT NULL,
+    samples INTEGER,
+    mean REAL,
+    rms REAL,
+    minimum REAL,
+    maximum REAL
+);
+CREATE INDEX IF NOT EXISTS runs_kind_label ON runs (kind, label, created);
+CREATE INDEX IF NOT EXISTS runs_created ON runs (created);
+CREATE INDEX IF NOT EXISTS parameters_value ON parameters (name, value, run_id);
+CREATE INDEX IF NOT EXISTS parameters_text ON parameters (name, text, run_id);
+CREATE INDEX IF NOT EXISTS parameters_run ON parameters (run_id);
+CREATE INDEX IF NOT EXISTS statistics_run ON statistics (run_id);
+'''
+
+# Attributes every run has, stored as columns of runs rather than as parameters
+RUN_COLUMNS = ('kind', 'label', 'created', 'comment')
+
+
+def catalogue_path(results_path):
+    """The catalogue kept next to a results file: results.h5 -> results.sqlite."""
+    return os.path.splitext(results_path)[0] + '.sqlite'
+
+
+def _number(value):
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return None
+
+
+def _statistics(data):
+    values = np.asarray(data)
+    if values.dtype.kind == 'c':
+        values = np.abs(values)
+    if values.dtype.kind not in 'biuf' or values.size == 0:
+        return None
+    values = values.astype(np.float64, copy=False).ravel()
+    return (values.size, float(values.mean()), float(np.sqrt(np.dot(values, values) / values.size)),
+            float(values.min()), float(values.max()))
+
+
+class Catalogue:
+    """
+    SQLite catalogue of the runs kept in results files (see classes.results).
+
+    Every run gets a row with its kind, DUT label, time, comment and location
+    (file and group), its parameters (extra attributes and instrument settings)
+    as indexed name/value rows and summary statistics of each dataset, so queries
+    over tens of thousands of runs are answered from the indexes without opening
+    a single data file.
+
+    Attributes:
+        path: The SQLite file.
+        connection: The sqlite3 connection.
+
+    Methods:
+        add_run: Adds or replaces the entry of a run.
+        index_file: Adds every run of a results file.
+        query: Finds runs by kind, label, time and parameter values.
+        close: Closes the database.
+    """
+    def __init__(self, path):
+        self.path = path
+        self.connection = sqlite3.connect(path)
+        self.connection.row_factory = sqlite3.Row
+        # WAL lets the GUI add runs while another process queries
+        self.connection.execute('PRAGMA journal_mode=WAL')
+        self.connection.execute('PRAGMA foreign_keys=ON')
+        self.connection.executescript(SCHEMA)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def close(self):
+        self.connection.close()
+
+    def add_run(self, file, run, attributes, datasets):
+        """
+        Add (or replace) the entry of one run.
+
+        Parameters:
+        - file: results file holding the run
+        - run: path of the run's group in the file
+        - attributes: the run's metadata, as returned by ResultStore.attributes
+        - datasets: dict {name: array or h5py dataset} summarised in the statistics table
+        """
+        file = os.path.abspath(file)
+        attributes = dict(attributes)
+        settings = attributes.pop('settings', {}) or {}
+        with self.connection:
+            self.connection.execute('DELETE FROM runs WHERE file = ? AND run = ?', (file, run))
+            run_id = self.connection.execute(
+                'INSERT INTO runs (kind, label, created, comment, file, run) VALUES (?, ?, ?, ?, ?, ?)',
+                [str(attributes.get(column, '')) for column in RUN_COLUMNS] + [file, run]).lastrowid
+            parameters = {name: value for name, value in attributes.items() if name not in RUN_COLUMNS}
+            parameters.update(settings)
+            self.connection.executemany(
+                'INSERT INTO parameters (run_id, name, value, text) VALUES (?, ?, ?, ?)',
+                [(run_id, name, _number(value), str(value)) for name, value in parameters.items()])
+            rows = []
+            for name, data in datasets.items():
+                summary = _statistics(data)
+                if summary is not None:
+                    rows.append((run_id, name) + summary)
+            self.connection.executemany(
+                'INSERT INTO statistics (run_id, dataset, samples, mean, rms, minimum, maximum) '
+                'VALUES (?, ?, ?, ?, ?, ?, ?)', rows)
+        return run_id
+
+    def index_file(self, results_path):
+        """Add every run of a results file, e.g. to build the catalogue of files written before it existed."""
+        from classes.results import ResultStore
+        with ResultStore(results_path, mode='r', catalogue=False) as store:
+            runs = store.runs()
+            for run in runs:
+                self.add_run(results_path, run, store.attributes(run), dict(store.file[run].items()))
+        return len(runs)
+
+    def query(self, kind=None, label=None, since=None, until=None, limit=None, **parameters):
+        """
+        Find runs, newest first.
+
+        Parameters:
+        - kind: e.g. 'scope', 'noise' or 'transfer_function'
+        - label: DUT label, SQL LIKE patterns such as 'board3%' are allowed
+        - since, until: ISO dates or times bounding the creation time
+        - limit: maximum number of runs returned
+        - parameters: name=value for an exact match (numbers to 1 ppb), or name=(low, high) for a range
+
+        Returns:
+            list of dicts with the run's columns, its 'parameters' and its 'statistics' per dataset.
+
+        Example:
+            catalogue.query(kind='noise', label='board3%', supply_voltage=1.8)
+        """
+        conditions, values = [], []
+        for column, value, operator in (('kind', kind, '='), ('label', label, 'LIKE'),
+                                        ('created', since, '>='), ('created', until, '<=')):
+            if value is not None:
+                conditions.append(f'{column} {operator} ?')
+                values.append(value)
+        for name, value in parameters.items():
+            if isinstance(value, (tuple, list)):
+                conditions.append('id IN (SELECT run_id FROM parameters WHERE name = ? AND value BETWEEN ? AND ?)')
+                values.extend([name, value[0], value[1]])
+            elif _number(value) is not None and not isinstance(value, str):
+                conditions.append('id IN (SELECT run_id FROM parameters WHERE name = ? AND value BETWEEN ? AND ?)')
+                tolerance = 1e-9 * max(abs(float(value)), 1.0)
+                values.extend([name, float(value) - tolerance, float(value) + tolerance])
+            else:
+                conditions.append('id IN (SELECT run_id FROM parameters WHERE name = ? AND text = ?)')
+                values.extend([name, str(value)])
+        sql = 'SELECT * FROM runs'
+        if conditions:
+            sql += ' WHERE ' + ' AND '.join(conditions)
+        sql += ' ORDER BY created DESC'
+        if limit is not None:
+            sql += f' LIMIT {int(limit)}'
+
+        runs = {row['id']: dict(row, parameters={}, statistics={}) for row in self.connection.execute(sql, values)}
+        if runs:
+            # Two more queries fetch the parameters and statistics of every matching run at once
+            placeholders = ','.join('?' * len(runs))
+            for row in self.connection.execute(
+                    f'SELECT run_id, name, value, text FROM parameters WHERE run_id IN ({placeholders})', list(runs)):
+                runs[row['run_id']]['parameters'][row['name']] = row['value'] if row['value'] is not None else row['text']
+            for row in self.connection.execute(
+                    f'SELECT * FROM statistics WHERE run_id IN ({placeholders})', list(runs)):
+                runs[row['run_id']]['statistics'][row['dataset']] = {
+                    key: row[key] for key in ('samples', 'mean', 'rms', 'minimum', 'maximum')}
+        return list(runs.values())
+
+
+def _parse_parameter(text):
+    # name=value or name=low:high
+    name, _, value = text.partition('=')
+    if ':' in value:
+        low, high = value.split(':', 1)
+        return name, (float(low), float(high))
+    return name, float(value) if _number(value) is not None else value
+
+
+def main(argv=None):
+    """
+    Command line interface, run from src/:
+        python -m classes.catalogue index results.h5
+        python -m classes.catalogue query --kind noise --label "board3%" --param supply_voltage=1.8
+    """
+    parser = argparse.ArgumentParser(prog='python -m classes.catalogue', description='Index and query stored runs.')
+    parser.add_argument('--catalogue', help='SQLite file, defaults to the one next to the results file')
+    commands = parser.add_subparsers(dest='command', required=True)
+    index = commands.add_parser('index', help='add the runs of results files to the catalogue')
+    index.add_argument('files', nargs='+', help='results files (glob patterns allowed)')
+    query = commands.add_parser('query', help='list matching runs')
+    query.add_argument('--kind')
+    query.add_argument('--label', help='SQL LIKE pattern, e.g. "board3%%"')
+    query.add_argument('--since', help='ISO date or time')
+    query.add_argument('--until', help='ISO date or time')
+    query.add_argument('--param', action='append', default=[], metavar='NAME=VALUE',
+                       help='parameter value or range low:high, may be repeated')
+    query.add_argument('--limit', type=int)
+    query.add_argument('--json', action='store_true', help='print the full entries as JSON')
+    query.add_argument('--results', default='results.h5', help='results file whose catalogue is queried')
+    args = parser.parse_args(argv)
+
+    if args.command == 'index':
+        files = [path for pattern in args.files for path in sorted(glob.glob(pattern))]
+        if not files:
+            parser.error('no results files found')
+        with Catalogue(args.catalogue or catalogue_path(files[0])) as catalogue:
+            for path in files:
+                print(f'Indexed {catalogue.index_file(path)} runs of {path}')
+        return 0
+
+    with Catalogue(args.catalogue or catalogue_path(args.results)) as catalogue:
+        runs = catalogue.query(args.kind, args.label, args.since, args.until, args.limit,
+                               **dict(_parse_parameter(p) for p in args.param))
+    if args.json:
+        print(json.dumps(runs, indent=2))
+    else:
+        for run in runs:
+            print(f"{run['created'][:19]}  {run['kind']:18s} {run['label']:24s} {run['file']}:{run['run']}")
+        print(f'{len(runs)} runs')
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
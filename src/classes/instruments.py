@@ -1,4 +1,10 @@
+import threading
+import time
+import zlib
+from contextlib import contextmanager
+import numpy as np
 import pyvisa
+from classes import sessions, tracing, waveform_parser
 
 instrument_addresses = {
     'power_supply': 'USB0::0x2A8D::0x1002::MY61005055::INSTR',  # Power supply USB address
@@ -11,103 +17,894 @@ instrument_addresses = {
 
 
 
-class SMU:
+class CommandBatch:
+    """
+    Commands queued by Instrument.batch() and the statistics of sending them.
+
+    Attributes:
+        commands: Every SCPI command queued in the batch.
+        pending: Queued commands not sent yet.
+        writes: Number of bus writes used to send them.
+        synced: Whether the batch was closed with an *OPC? query.
+        failed: Whether the instrument reported an error (*ESR?) when the batch was synced.
+
+    Methods:
+        messages: Joins the pending commands into as few messages as possible.
+        round_trips_saved: Bus transactions saved compared with one write per command.
+    """
+    def __init__(self):
+        self.commands = []
+        self.pending = []
+        self.writes = 0
+        self.synced = False
+        self.failed = False
+
+    def add(self, command):
+        self.commands.append(command)
+        self.pending.append(command)
+
+    def round_trips_saved(self):
+        return len(self.commands) - self.writes - (1 if self.synced else 0)
+
+    def messages(self, max_bytes):
+        """Join the pending commands with ';' into messages of at most max_bytes and clear them."""
+        messages = []
+        current = ''
+        for command in self.pending:
+            # After ';' a command is relative to the previous header path, a leading ':' makes it absolute
+            part = command if command[0] in ':*' else ':' + command
+            if current and len(current) + 1 + len(part) <= max_bytes:
+                current += ';' + part
+            else:
+                if current:
+                    messages.append(current)
+                current = part
+        if current:
+            messages.append(current)
+        self.pending = []
+        return messages
+
+
+class Instrument:
+    """
+    Base class for the VISA instruments.
+
+    Sessions are borrowed from the process-wide SessionPool (classes.sessions), so
+    creating an instrument object for an address that is already open is instant and
+    does not reset the instrument. One-off configuration in setup() only runs when the
+    session was actually opened (or reset) by this constructor.
+
+    Attributes:
+        address: The VISA address of the instrument.
+        pool: The SessionPool the session was borrowed from.
+        session: The VISA resource for this instrument.
+        last_batch: The CommandBatch of the most recent batch() block.
+        shadow: The settings last written to the instrument, {header: value}, shared through the pool.
+        verify_every: Re-query the shadowed settings after this many sent writes (0 disables).
+        writes_skipped: Number of writes skipped because the shadow showed no change.
+
+    Methods:
+        setup: One-off configuration after the session was opened or reset.
+        write: Sends a command, or queues it while a batch() block is active.
+        query: Sends a query and returns the response (flushes any queued commands first).
+        batch: Context manager that coalesces writes into as few bus transactions as possible.
+        invalidate_shadow: Forgets the shadowed settings so every following write is sent.
+        forget_setting: Forgets one shadowed setting.
+        check_errors: Reads the error queue, invalidating the shadow if there were errors.
+        verify_shadow: Re-queries the shadowed settings and drops those that no longer match.
+        wait_complete: Waits for pending operations using *OPC and a service request (or *ESR? polling).
+        close: Releases the instrument, the session stays open in the pool.
+    """
+    # Longest message sent in one write, kept well below the instruments' input buffers
+    MAX_MESSAGE_BYTES = 1024
+    # Commands that change settings behind the shadow's back
+    SHADOW_INVALIDATING = ('*RST', '*RCL', 'SYST:PRES', 'APPL')
+    # Actions that take an argument (:DIG CHAN1, INIT:ACQ, ...) but are not settings; they must be sent every time
+    ACTION_ROOTS = ('DIG', 'SING', 'RUN', 'STOP', 'INIT', 'ABOR', 'AUT')
+    ACTION_SUFFIXES = ('TRIG', 'TRIG:IMM', 'CLE', 'PHAS:SYNC')
+    # Long forms of the keywords used by these instruments, so 'SOURCE1:VOLTAGE' and 'VOLT' share a shadow entry
+    LONG_FORMS = {
+        'SOURCE': 'SOUR', 'VOLTAGE': 'VOLT', 'CURRENT': 'CURR', 'FREQUENCY': 'FREQ', 'FUNCTION': 'FUNC',
+        'OUTPUT': 'OUTP', 'OFFSET': 'OFFS', 'PHASE': 'PHAS', 'CHANNEL': 'CHAN', 'TIMEBASE': 'TIM',
+        'WAVEFORM': 'WAV', 'SENSE': 'SENS', 'TRIGGER': 'TRIG', 'FORMAT': 'FORM', 'ACQUIRE': 'ACQ',
+        'POINTS': 'POIN', 'PROTECTION': 'PROT', 'APERTURE': 'APER', 'COUNT': 'COUN', 'STATE': 'STAT',
+        'SWEEP': 'SWE', 'RANGE': 'RANG', 'SCALE': 'SCAL', 'DIGITIZE': 'DIG', 'SINGLE': 'SING',
+        'INITIATE': 'INIT', 'ABORT': 'ABOR', 'IMMEDIATE': 'IMM', 'LEVEL': 'LEV', 'COUPLING': 'COUP',
+        'INPUT': 'INP', 'DISPLAY': 'DISP', 'SEGMENTED': 'SEGM', 'UNSIGNED': 'UNS', 'BYTEORDER': 'BYT',
+        'TIMER': 'TIM', 'ELEMENTS': 'ELEM', 'BORDER': 'BORD', 'CLEAR': 'CLE', 'SYNCHRONIZE': 'SYNC',
+        'VOLATILE': 'VOL', 'SRATE': 'SRAT', 'AUTOSCALE': 'AUT', 'ARBITRARY': 'ARB', 'DWELL': 'DWEL',
+        'START': 'STAR', 'SPACING': 'SPAC', 'SYSTEM': 'SYST', 'BEEPER': 'BEEP', 'ROSCILLATOR': 'ROSC',
+        'MEASURE': 'MEAS', 'FETCH': 'FETC', 'TRACE': 'TRAC', 'CONTROL': 'CONT', 'OPERATION': 'OPER',
+        'CONDITION': 'COND', 'PREAMBLE': 'PRE', 'SEGMENT': 'SEGM', 'MODULATION': 'MOD',
+    }
+    # Standard Event Status Register bits set by query, device, execution and command errors
+    ESR_ERROR_BITS = 0x04 | 0x08 | 0x10 | 0x20
+
+    def __init__(self, address, reset=False, pool=None):
+        self.address = address
+        self.pool = pool if pool is not None else sessions.pool
+        # Batches are per thread, so a GUI thread writing while a worker batches is not swallowed
+        self._local = threading.local()
+        self.last_batch = None
+        self.verify_every = 0
+        self.writes_skipped = 0
+        self._writes_since_verify = 0
+        self.session, opened = self.pool.open(address, reset=reset)
+        self.shadow = self.pool.shadow(address)
+        if opened:
+            self.setup()
+
+    @property
+    def _batch(self):
+        return getattr(self._local, 'batch', None)
+
+    @_batch.setter
+    def _batch(self, batch):
+        self._local.batch = batch
+
+    def setup(self):
+        pass
+
+    @classmethod
+    def _normalise_header(cls, header):
+        """
+        Fold the spellings of one header onto a single shadow key.
+
+        Keywords are upper-cased and the long forms in LONG_FORMS shortened (only those:
+        other keywords are kept whole, so two settings never share a key by accident), the
+        default suffix 1 is dropped (OUTP1 -> OUTP) and the optional SOUR root is removed,
+        so 'SOURce1:VOLTage', 'SOUR:VOLT' and 'VOLT' are the same setting while
+        'SOUR2:VOLT' stays separate.
+        """
+        keywords = []
+        for keyword in header.strip().lstrip(':').split(':'):
+            keyword = keyword.upper()
+            stem = keyword.rstrip('0123456789?')
+            suffix = keyword[len(stem):]
+            stem = cls.LONG_FORMS.get(stem, stem)
+            if suffix.rstrip('?') == '1':
+                suffix = suffix[1:]
+            keywords.append(stem + suffix)
+        if len(keywords) > 1 and keywords[0] == 'SOUR':
+            keywords = keywords[1:]
+        return ':'.join(keywords)
+
+    @staticmethod
+    def _normalise_value(value):
+        value = value.strip().strip('"').upper()
+        value = {'ON': '1', 'OFF': '0'}.get(value, value)
+        try:
+            return repr(float(value))
+        except ValueError:
+            return value
+
+    @classmethod
+    def _is_action(cls, header):
+        return header.split(':', 1)[0] in cls.ACTION_ROOTS or \
+            any(header == suffix or header.endswith(':' + suffix) for suffix in cls.ACTION_SUFFIXES)
+
+    @classmethod
+    def _split_setting(cls, command):
+        """
+        Split a setting command into a normalised (header, value) pair.
+
+        Returns None for queries, common commands, commands without a value
+        (e.g. PHAS:SYNC) and actions that take one (e.g. :DIG CHAN1), which must
+        always be sent.
+        """
+        header, _, value = command.strip().partition(' ')
+        if not value.strip() or header.endswith('?') or header.lstrip(':').startswith('*'):
+            return None
+        header = cls._normalise_header(header)
+        if cls._is_action(header):
+            return None
+        return header, cls._normalise_value(value)
+
+    def write(self, command, force=False):
+        """
+        Send a command, skipping settings that the shadow shows are already applied.
+
+        force=True always sends the command (and still records it in the shadow).
+        """
+        header = self._normalise_header(command.strip().partition(' ')[0])
+        if header.startswith(self.SHADOW_INVALIDATING):
+            self.invalidate_shadow()
+        else:
+            setting = self._split_setting(command)
+            if setting is not None:
+                header, value = setting
+                if not force and self.shadow.get(header) == value:
+                    self.writes_skipped += 1
+                    return
+                self.shadow[header] = value
+
+        if self._batch is not None:
+            self._batch.add(command)
+            return
+        try:
+            self.session.write(command)
+        except Exception:
+            # The instrument state is unknown after a failed write
+            self.invalidate_shadow()
+            raise
+        self._writes_since_verify += 1
+        if self.verify_every and self._writes_since_verify >= self.verify_every:
+            self.verify_shadow()
+
+    def forget_setting(self, command_header):
+        """Drop one setting from the shadow so it is sent the next time, e.g. after the instrument changed it itself."""
+        self.shadow.pop(self._normalise_header(command_header), None)
+
+    def invalidate_shadow(self):
+        self.shadow.clear()
+
+    def check_errors(self):
+        """Drain SYST:ERR? and return the errors; any error invalidates the shadow."""
+        errors = []
+        for _ in range(50):
+            error = self.query('SYST:ERR?').strip()
+            if error.startswith(('+0', '0')):
+                break
+            errors.append(error)
+        if errors:
+            self.invalidate_shadow()
+        return errors
+
+    def verify_shadow(self):
+        """
+        Query every shadowed setting and drop the ones that differ from the instrument.
+
+        Dropped settings are sent again the next time they are written. Returns the
+        headers that did not match.
+        """
+        self._writes_since_verify = 0
+        stale = []
+        for header, value in list(self.shadow.items()):
+            try:
+                actual = self._normalise_value(self.query(header + '?'))
+            except Exception:
+                actual = None
+            if actual != value:
+                self.shadow.pop(header, None)
+                stale.append(header)
+        return stale
+
+    def query(self, command):
+        self._flush()
+        return self.session.query(command)
+
+    def _flush(self):
+        # Send whatever the active batch has queued so far, e.g. before a query needs the settings applied
+        if self._batch is None:
+            return
+        for message in self._batch.messages(self.MAX_MESSAGE_BYTES):
+            self.session.write(message)
+            self._batch.writes += 1
+
+    @contextmanager
+    def batch(self, sync=True):
+        """
+        Queue writes and send them joined with ';' when the block exits.
+
+        Usage:
+            with sg.batch() as b:
+                sg.write('SOUR1:FREQ 1000')
+                sg.write('SOUR1:VOLT 0.1')
+            print(b.round_trips_saved())
+
+        Settings already applied (according to the shadow) are not queued at all.
+        If the block raises, the commands still queued are discarded. With sync=True a
+        single *OPC?;*ESR? is sent at the end so the block returns once the instrument has
+        applied every setting; if the instrument reports an error, the batch's settings are
+        dropped from the shadow so they are sent again next time. Nested batch() blocks
+        join the outer batch.
+        """
+        if self._batch is not None:
+            yield self._batch
+            return
+        batch = CommandBatch()
+        self._batch = batch
+        try:
+            yield batch
+            self._flush()
+        except Exception:
+            # Queued settings were never sent, so the shadow no longer matches the instrument
+            self.invalidate_shadow()
+            raise
+        finally:
+            self._batch = None
+        if sync and batch.commands:
+            # *ESR? rides along with the *OPC? to learn whether the instrument rejected anything
+            esr = self.session.query('*OPC?;*ESR?').strip().split(';')[-1]
+            batch.synced = True
+            if int(float(esr)) & self.ESR_ERROR_BITS:
+                # Some setting was not applied, so none of the batch's shadow entries can be trusted
+                batch.failed = True
+                for command in batch.commands:
+                    setting = self._split_setting(command)
+                    if setting is not None:
+                        self.shadow.pop(setting[0], None)
+        self.last_batch = batch
+
+    def wait_complete(self, timeout=10.0, poll_interval=0.005, use_srq=True):
+        """
+        Return as soon as every pending operation has completed.
+
+        Sends *OPC, which sets the Operation Complete bit of the Standard Event Status
+        register when the instrument is done. With use_srq the bit is routed to a
+        service request (*ESE 1, *SRE 32) and the call sleeps in wait_on_event until it
+        arrives. If the backend has no SRQ support it falls back to polling *ESR?.
+
+        Parameters:
+        - timeout: seconds to wait before raising TimeoutError
+        - poll_interval: seconds between *ESR? polls in the fallback path
+        - use_srq: try the service request path first
+
+        Returns:
+            Seconds spent waiting.
+        """
+        self._flush()
+        start = time.perf_counter()
+        self.session.write('*ESE 1')
+        self.session.query('*ESR?')  # Clear a stale Operation Complete bit
+        if use_srq:
+            try:
+                self.session.write('*SRE 32')
+                self.session.enable_event(pyvisa.constants.EventType.service_request,
+                                          pyvisa.constants.EventMechanism.queue)
+                try:
+                    self.session.write('*OPC')
+                    self.session.wait_on_event(pyvisa.constants.EventType.service_request, int(timeout * 1000))
+                finally:
+                    self.session.disable_event(pyvisa.constants.EventType.service_request,
+                                               pyvisa.constants.EventMechanism.queue)
+                    self.session.write('*SRE 0')
+                self.session.query('*ESR?')  # Clears the event register
+                return time.perf_counter() - start
+            except pyvisa.errors.VisaIOError as e:
+                if e.error_code == pyvisa.constants.StatusCode.error_timeout:
+                    raise TimeoutError(f"Operation did not complete within {timeout} s") from e
+            except (AttributeError, NotImplementedError):
+                pass  # Backend without event support, poll instead
+            self.session.write('*SRE 0')
+
+        self.session.write('*OPC')
+        poll_until(lambda: int(self.session.query('*ESR?')) & 1, timeout, poll_interval)
+        return time.perf_counter() - start
+
+    def close(self):
+        # Sessions are shared, they are closed by sessions.close_all() on exit
+        pass
+
+
+def poll_until(condition, timeout=10.0, poll_interval=0.005):
+    """
+    Call condition() until it returns a truthy value, raising TimeoutError after timeout seconds.
+
+    The poll interval starts small and doubles up to poll_interval * 16, so short
+    operations return almost immediately while long ones do not flood the bus.
+    """
+    deadline = time.perf_counter() + timeout
+    interval = poll_interval
+    with tracing.span('poll_until'):
+        while True:
+            result = condition()
+            if result:
+                return result
+            if time.perf_counter() >= deadline:
+                raise TimeoutError(f"Condition not met within {timeout} s")
+            time.sleep(interval)
+            interval = min(interval * 2, poll_interval * 16)
+
+
+class SMU(Instrument):
     """
     Class for controlling the Source Measure Unit (SMU) instrument.
 
     Attributes:
-        rm: The resource manager for handling VISA resources.
         smu: The specific SMU instrument resource.
 
     Methods:
-        close: Closes the SMU instrument and the resource manager.
+        close: Releases the SMU instrument back to the session pool.
+        source_voltage: Sources a fixed voltage with a current compliance limit.
+        output_off: Turns the output off and zeroes the source.
+        wait_for_current_below: Polls the measured current until it drops below a limit.
+        list_sweep: Runs a voltage list sweep on the SMU and fetches the whole trace in one transfer.
+        stream_current: Starts logging the measured current continuously in the background.
     """
-    def __init__(self, address):
-        self.rm = pyvisa.ResourceManager()
-        self.smu = self.rm.open_resource(address)
-        self.smu.write_termination = '\n'
-        self.smu.write('*RST')
-        self.smu.write('*CLS')
+    # Longest voltage list the B2901 accepts
+    LIST_MAX_POINTS = 2500
 
-    def close(self):
-        self.smu.close()
-        self.rm.close()
+    def __init__(self, address, reset=False, pool=None):
+        super().__init__(address, reset, pool)
+        self.smu = self.session
+
+    def source_voltage(self, voltage, current_limit, enable=True):
+        """Source a fixed voltage (V) with a current compliance (A), all in one batched write."""
+        with self.batch():
+            self.write(':SOUR:FUNC:MODE VOLT')
+            self.write('VOLT:MODE FIXED')
+            self.write('CURR:MODE FIXED')
+            self.write(f':SENS:CURR:PROT {current_limit}')
+            self.write(f'VOLT {voltage}')
+            if enable:
+                self.write('OUTP ON')
+
+    def output_off(self):
+        with self.batch(sync=False):
+            self.write('OUTP OFF')
+            self.write('VOLT 0')
+            self.write('CURR 0')
+
+    def wait_for_current_below(self, limit, timeout=0.5, poll_interval=0.01):
+        """
+        Wait until the measured output current is below limit, e.g. once decoupling capacitors have charged.
+
+        Returns True as soon as the current settles, or False if it did not within timeout
+        (the worst case the caller would otherwise have slept for).
+        """
+        try:
+            poll_until(lambda: abs(float(self.query(':MEAS:CURR?'))) < limit, timeout, poll_interval)
+            return True
+        except TimeoutError:
+            return False
+
+    def stream_current(self, interval=20e-6, capacity=10_000_000, aperture=None):
+        """
+        Start sampling the output current continuously into a ring buffer (see classes.streaming.CurrentSampler).
+
+        Parameters:
+        - interval: seconds between samples on the SMU
+        - capacity: number of most recent samples kept in memory
+        - aperture: integration time per sample, defaults to 80% of the interval
+
+        Returns:
+            The running CurrentSampler; call stop() on it when done.
+        """
+        # Imported here because classes.streaming depends on this module through async_instruments
+        from classes.streaming import CurrentSampler
+        return CurrentSampler(self, interval, capacity).start(aperture)
+
+    def list_sweep(self, voltages, compliance, aperture=None, trigger_count=None, dwell=None):
+        """
+        Source a list of voltages, measuring voltage and current at every point, as one sweep on the SMU.
+
+        The list is loaded with SOUR:LIST:VOLT and the trigger system is armed once;
+        the SMU steps through the points on its own and the results are read back with
+        a single FETC:ARR? as a REAL,64 binary block (voltage and current interleaved),
+        instead of one set/wait/measure round trip per point. The output is left on at
+        the last voltage, use output_off() afterwards.
+
+        Parameters:
+        - voltages: source voltages (V)
+        - compliance: current compliance (A)
+        - aperture: integration time per measurement in seconds, None keeps the current setting
+        - trigger_count: number of points to run, defaults to len(voltages)
+        - dwell: seconds between points (timer trigger), None triggers each point as soon as possible
+
+        Returns:
+            (voltage, current): numpy arrays of the measured voltage (V) and current (A).
+        """
+        voltages = np.asarray(voltages, dtype=float).ravel()
+        if not 1 <= voltages.size <= self.LIST_MAX_POINTS:
+            raise ValueError(f"A list sweep needs 1 to {self.LIST_MAX_POINTS} points")
+        trigger_count = voltages.size if trigger_count is None else int(trigger_count)
+
+        with self.batch():
+            self.write(':SOUR:FUNC:MODE VOLT')
+            self.write('VOLT:MODE LIST')
+            self.write(':SOUR:LIST:VOLT ' + ','.join(f'{v:.6g}' for v in voltages))
+            self.write(':SENS:FUNC "VOLT","CURR"')
+            self.write(f':SENS:CURR:PROT {compliance}')
+            if aperture is not None:
+                self.write(f':SENS:CURR:APER {aperture}')
+                self.write(f':SENS:VOLT:APER {aperture}')
+            if dwell is None:
+                self.write(':TRIG:SOUR AINT')
+            else:
+                self.write(':TRIG:SOUR TIM')
+                self.write(f':TRIG:TIM {dwell}')
+            self.write(f':TRIG:COUN {trigger_count}')
+            self.write(':FORM:ELEM:SENS VOLT,CURR')
+            self.write('OUTP ON')
+
+        # Worst case sweep time, the wait itself returns as soon as the sweep is done
+        per_point = (aperture or 0.1) + (dwell or 0)
+        self.write(':INIT')
+        self.wait_complete(timeout=10 + 2 * trigger_count * per_point)
+
+        self.write(':FORM:DATA REAL,64')
+        self.write(':FORM:BORD SWAP')
+        try:
+            data = self.session.query_binary_values(':FETC:ARR?', datatype='d', is_big_endian=False,
+                                                    container=np.array)
+        finally:
+            # Leave ASCII responses for the other queries (e.g. :MEAS:CURR?)
+            self.write(':FORM:DATA ASC')
+        data = data.reshape(-1, 2)
+        return data[:, 0], data[:, 1]
 
-class SignalGenerator:
+class SignalGenerator(Instrument):
     """
     Class for controlling the Signal Generator instrument.
 
     Attributes:
-        rm: The resource manager for handling VISA resources.
         sg: The specific Signal Generator instrument resource.
 
     Methods:
-        close: Closes the Signal Generator instrument and the resource manager.
+        close: Releases the Signal Generator instrument back to the session pool.
         sin: Configures the Signal Generator to output a sine wave.
         square: Configures the Signal Generator to output a square wave.
         enable_output: Enables or disables the output of the Signal Generator.
+        configure: Configures one channel in a single batched write.
+        load_arb: Uploads an arbitrary waveform as a binary block and plays it.
+        sweep: Loads a frequency sweep that the generator steps through itself.
+        step: Advances a bus triggered sweep by one point.
+        stop_sweep: Returns a channel to a fixed frequency.
     """
+    # Volatile arbitrary waveform memory limits of the 33500B
+    ARB_MIN_POINTS = 8
+    ARB_MAX_POINTS = 16 * 1024 * 1024
+    # Longest frequency list the 33500B accepts, longer sweeps use the native sweep mode
+    LIST_MAX_POINTS = 128
 
-    def __init__(self, address):
-        self.rm = pyvisa.ResourceManager()
-        self.sg = self.rm.open_resource(address)
-        self.sg.write_termination = '\n'
-        self.sg.write('*RST')
-        self.sg.write('*CLS')
-        self.sg.write('SYST:BEEP:STAT OFF') # Disable beeping
-        self.sg.write('PHAS:SYNC')
-        self.sg.write('ROSC:SOUR INT')
-        self.sg.write('TRIG:SOUR BUS')
-        self.sg.write(f'OUTP1:LOAD INF')
-        self.sg.write(f'OUTP2:LOAD INF')
+    def __init__(self, address, reset=False, pool=None):
+        super().__init__(address, reset, pool)
+        self.sg = self.session
+        # {(channel, name): (checksum, points)} of the waveforms in volatile memory, shared through the pool
+        # (None for waveforms found there whose samples are unknown)
+        self.arbs = self.pool.arb_cache(address)
 
-    def close(self):
-        self.sg.close()
+    def write(self, command, force=False):
+        header = self._normalise_header(command.strip().partition(' ')[0])
+        if header.startswith('*RST') or header.endswith('DATA:VOL:CLE'):
+            # Volatile memory is wiped, so cached waveforms have to be uploaded again
+            self.arbs.clear()
+        super().write(command, force)
+
+    def setup(self):
+        self.session.write('SYST:BEEP:STAT OFF') # Disable beeping
+        self.session.write('PHAS:SYNC')
+        self.session.write('ROSC:SOUR INT')
+        self.session.write('TRIG:SOUR BUS')
+        self.session.write(f'OUTP1:LOAD INF')
+        self.session.write(f'OUTP2:LOAD INF')
 
     def sin(self, frequency=1000, amplitude=1.0, offset=0.0, phase=0.0):
         amplitude = amplitude / 1000
         offset = offset / 1000
-        self.sg.write(f'APPL:SIN {frequency},{amplitude},{offset}')
-        self.sg.write(f'PHAS {phase}')
+        self.write(f'APPL:SIN {frequency},{amplitude},{offset}')
+        self.write(f'PHAS {phase}')
 
 
     def square(self, frequency=1000, amplitude=1.0, offset=0.0, phase=0.0):
         amplitude = amplitude / 1000
         offset = offset / 1000
-        self.sg.write(f'APPL:SQU {frequency},{amplitude},{offset}')
-        self.sg.write(f'PHAS {phase}')
+        self.write(f'APPL:SQU {frequency},{amplitude},{offset}')
+        self.write(f'PHAS {phase}')
 
 
     def enable_output(self, enable=True):
-        self.sg.write('OUTP ON' if enable else 'OUTP OFF')
+        self.write('OUTP ON' if enable else 'OUTP OFF')
+
+    def configure(self, channel=1, function=None, frequency=None, amplitude=None, offset=None,
+                  phase=None, output=None):
+        """
+        Configure one channel. Arguments left as None are not sent.
+
+        Parameters:
+        - channel: output channel (1 or 2)
+        - function: 'SIN', 'SQU', 'DC', 'ARB', ...
+        - frequency: Hz
+        - amplitude: peak-to-peak volts
+        - offset: volts
+        - phase: degrees
+        - output: True/False to switch the output on or off after configuring
+        """
+        with self.batch():
+            if function is not None:
+                self.write(f'SOUR{channel}:FUNC {function.upper()}')
+            if frequency is not None:
+                self.write(f'SOUR{channel}:FREQ {frequency}')
+            if amplitude is not None:
+                self.write(f'SOUR{channel}:VOLT {amplitude}')
+            if offset is not None:
+                self.write(f'SOUR{channel}:VOLT:OFFS {offset}')
+            if phase is not None:
+                self.write(f'SOUR{channel}:PHAS {phase}')
+            if output is not None:
+                self.write(f'OUTP{channel} {"ON" if output else "OFF"}')
+
+    def sweep(self, start, stop, points, dwell=None, spacing='log', channel=1):
+        """
+        Load a frequency sweep that the generator sequences itself.
+
+        Up to LIST_MAX_POINTS points use frequency list mode. With dwell=None the
+        trigger source is the bus and every step() (one *TRG) moves to the next
+        frequency; with a dwell time the list runs on the generator's own timer.
+        Longer sweeps use the native sweep mode instead, which glides continuously from
+        start to stop in points * dwell seconds once triggered with step().
+
+        Parameters:
+        - start: first frequency in Hz
+        - stop: last frequency in Hz
+        - points: number of frequencies
+        - dwell: seconds per frequency, None to step with step()
+        - spacing: 'log' or 'lin'
+        - channel: output channel (1 or 2)
+
+        Returns:
+            numpy.ndarray of the swept frequencies.
+        """
+        spacing = spacing.lower()
+        if spacing not in ('log', 'lin'):
+            raise ValueError("Spacing must be 'log' or 'lin'")
+        space = np.geomspace if spacing == 'log' else np.linspace
+        frequencies = space(start, stop, int(points))
+
+        with self.batch():
+            if points <= self.LIST_MAX_POINTS:
+                self.write(f'SOUR{channel}:SWE:STAT OFF')
+                self.write(f'SOUR{channel}:LIST:FREQ ' + ','.join(f'{f:.6g}' for f in frequencies))
+                if dwell is not None:
+                    self.write(f'SOUR{channel}:LIST:DWEL {dwell}')
+                self.write(f'TRIG{channel}:SOUR {"BUS" if dwell is None else "IMM"}')
+                self.write(f'SOUR{channel}:FREQ:MODE LIST')
+            else:
+                if dwell is None:
+                    raise ValueError(f"Sweeps of more than {self.LIST_MAX_POINTS} points need a dwell time")
+                self.write(f'SOUR{channel}:FREQ:MODE SWE')
+                self.write(f'SOUR{channel}:FREQ:STAR {start}')
+                self.write(f'SOUR{channel}:FREQ:STOP {stop}')
+                self.write(f'SOUR{channel}:SWE:SPAC {spacing.upper()}')
+                self.write(f'SOUR{channel}:SWE:TIME {points * dwell}')
+                self.write(f'TRIG{channel}:SOUR BUS')
+                self.write(f'SOUR{channel}:SWE:STAT ON')
+        return frequencies
+
+    def step(self):
+        """Send *TRG: the next point of a bus triggered list sweep, or the start of a native sweep."""
+        self.write('*TRG')
+
+    def stop_sweep(self, channel=1, frequency=None):
+        """Return a channel to fixed frequency output, optionally at a new frequency."""
+        # The sweep moved the frequency behind the shadow's back
+        self.forget_setting(f'SOUR{channel}:FREQ')
+        with self.batch():
+            self.write(f'SOUR{channel}:SWE:STAT OFF')
+            self.write(f'SOUR{channel}:FREQ:MODE CW')
+            if frequency is not None:
+                self.write(f'SOUR{channel}:FREQ {frequency}')
+
+    def load_arb(self, samples, sample_rate, name='ARB1', channel=1, amplitude=None, offset=None):
+        """
+        Upload an arbitrary waveform with DATA:ARB:DAC and play it on a channel.
+
+        The int16 DAC codes are sent as one little endian binary block (FORM:BORD SWAP)
+        with write_binary_values, so no ASCII string is generated. The CRC-32 of each
+        uploaded waveform is cached, and loading the same samples under the same name
+        again only selects the waveform. Waveforms stay in volatile memory between runs,
+        so a name the cache does not know is first looked up with DATA:VOL:CAT?; one that
+        is already there is cleared before uploading, as names cannot be overwritten.
 
-class Oscilloscope:
+        Parameters:
+        - samples: floats normalised to -1..1 (scaled to the full DAC range) or int16 DAC codes
+        - sample_rate: samples per second
+        - name: name of the waveform in volatile memory
+        - channel: output channel (1 or 2)
+        - amplitude: peak-to-peak volts, None keeps the current setting
+        - offset: volts, None keeps the current setting
+
+        Returns:
+            True if the waveform was uploaded, False if it was already in volatile memory.
+        """
+        codes = np.asarray(samples)
+        if codes.dtype != np.int16:
+            codes = np.round(np.clip(codes, -1, 1) * 32767)
+        codes = np.ascontiguousarray(codes, dtype='<i2')
+        if not self.ARB_MIN_POINTS <= codes.size <= self.ARB_MAX_POINTS:
+            raise ValueError(f"An arbitrary waveform needs {self.ARB_MIN_POINTS} to {self.ARB_MAX_POINTS} points")
+        name = name.upper()
+        checksum = zlib.crc32(codes)
+        if (channel, name) not in self.arbs:
+            # Left over from an earlier run? Those are listed with unknown contents (None)
+            catalogue = self.query(f'SOUR{channel}:DATA:VOL:CAT?')
+            for resident_name in catalogue.replace('"', '').split(','):
+                if resident_name.strip():
+                    self.arbs.setdefault((channel, resident_name.strip().upper()), None)
+        uploaded = self.arbs.get((channel, name)) != (checksum, codes.size)
+        if uploaded:
+            if (channel, name) in self.arbs:
+                # The name holds a different waveform and cannot be overwritten, so clear the channel's
+                # volatile memory (the channel must not be playing from it while it is cleared)
+                self.write(f'SOUR{channel}:FUNC SIN')
+                self.write(f'SOUR{channel}:DATA:VOL:CLE')
+            self.write('FORM:BORD SWAP')
+            self._flush()
+            self.session.write_binary_values(f'SOUR{channel}:DATA:ARB:DAC {name},', codes,
+                                             datatype='h', is_big_endian=False)
+            errors = self.check_errors()
+            if errors:
+                raise RuntimeError(f"Uploading {name} to channel {channel} failed: {'; '.join(errors)}")
+            self.arbs[(channel, name)] = (checksum, codes.size)
+            # The new waveform only plays once it is selected again
+            self.forget_setting(f'SOUR{channel}:FUNC:ARB')
+
+        with self.batch():
+            self.write(f'SOUR{channel}:FUNC:ARB {name}')
+            self.write(f'SOUR{channel}:FUNC:ARB:SRAT {sample_rate}')
+            self.write(f'SOUR{channel}:FUNC ARB')
+            if amplitude is not None:
+                self.write(f'SOUR{channel}:VOLT {amplitude}')
+            if offset is not None:
+                self.write(f'SOUR{channel}:VOLT:OFFS {offset}')
+        return uploaded
+
+class Oscilloscope(Instrument):
     """
     Class for controlling the Oscilloscope instrument.
 
     Attributes:
-        rm: The resource manager for handling VISA resources.
         scope: The specific Oscilloscope instrument resource.
 
     Methods:
-        close: Closes the Oscilloscope instrument and the resource manager.
-
+        close: Releases the Oscilloscope instrument back to the session pool.
+        get_preamble: Reads and parses the waveform preamble.
+        read_waveform: Reads one channel as a binary block and returns it scaled to volts.
+        read_waveform_ascii: Reads one channel using the (slow) ASCII waveform format.
+        capture: Acquires several channels and segments with one trigger arm.
+        acquire_single: Arms a single acquisition and returns as soon as it has triggered.
+        time_axis: Builds the time axis matching the last preamble read.
     """
-    def __init__(self):
-        self.rm = pyvisa.ResourceManager()
-        self.scope = self.rm.open_resource(instrument_addresses['oscilloscope'])
-        self.scope.write_termination = '\n'
-        self.scope.read_termination = '\n'
-        self.scope.write('*RST')
-        self.scope.write('*CLS')
-        self.scope.write(f'INP1:LOAD INF')
-        self.scope.write(f'INP2:LOAD INF')
-        self.scope.write(f'INP3:LOAD INF')
-        self.scope.write(f'INP4:LOAD INF')
+    # numpy/struct data type for each binary waveform format (unsigned, LSB first)
+    BINARY_DATATYPES = {'WORD': 'H', 'BYTE': 'B'}
+    # Read chunk size for block transfers, large chunks avoid thousands of small USB reads
+    CHUNK_SIZE = 1024 * 1024
 
-    def close(self):
-        self.scope.close()
-        self.rm.close()
+    def __init__(self, address=instrument_addresses['oscilloscope'], reset=False, pool=None):
+        super().__init__(address, reset, pool)
+        self.scope = self.session
+        self.preamble = None
+
+    def setup(self):
+        self.session.write(f'INP1:LOAD INF')
+        self.session.write(f'INP2:LOAD INF')
+        self.session.write(f'INP3:LOAD INF')
+        self.session.write(f'INP4:LOAD INF')
+
+    def get_preamble(self):
+        """Query :WAV:PRE? and return it as a dict of numbers (see waveform_parser.PREAMBLE_FIELDS)."""
+        self.preamble = waveform_parser.parse_preamble(self.query(':WAV:PRE?'))
+        return self.preamble
+
+    def _select_source(self, channel, points=None):
+        self.write(f':WAV:SOUR CHAN{channel}')
+        if points is not None:
+            self.write(':WAV:POIN:MODE RAW')
+            self.write(f':WAV:POIN {int(points)}')
+
+    def read_waveform(self, channel=1, points=None, format='WORD'):
+        """
+        Read one channel using an IEEE 488.2 definite-length binary block.
+
+        The raw codes go straight into a numpy array and are scaled to volts once
+        using the waveform preamble: volts = (code - yreference) * yincrement + yorigin.
+
+        Parameters:
+        - channel: analog channel number (1-4)
+        - points: number of points to transfer, None keeps the scope setting
+        - format: 'WORD' (16 bit) or 'BYTE' (8 bit)
+
+        Returns:
+            numpy.ndarray of float64 voltages.
+        """
+        format = self._set_binary_format(format)
+        self._select_source(channel, points)
+        preamble = self.get_preamble()
+        return waveform_parser.scale_codes(self._read_block(format), preamble)
+
+    def _set_binary_format(self, format):
+        format = format.upper()
+        if format not in self.BINARY_DATATYPES:
+            raise ValueError("Format must be 'WORD' or 'BYTE'")
+        self.write(f':WAV:FORM {format}')
+        self.write(':WAV:UNS ON')
+        if format == 'WORD':
+            self.write(':WAV:BYT LSBF')
+        return format
+
+    def _read_block(self, format):
+        return self.scope.query_binary_values(':WAV:DATA?', datatype=self.BINARY_DATATYPES[format],
+                                              is_big_endian=False, container=np.array,
+                                              chunk_size=self.CHUNK_SIZE)
+
+    def capture(self, channels=(1, 2, 3, 4), segments=1, points=None, format='WORD', timeout=None):
+        """
+        Acquire several channels (and optionally several segments) with a single trigger arm.
+
+        Segmented memory is armed once with :ACQ:SEGM:COUN and :DIG captures every
+        channel in one go. Each channel is then pulled with :WAV:SEGM:ALL as one block
+        holding all segments, so the number of VISA transactions depends on the number
+        of channels only, not on the number of segments.
+
+        Parameters:
+        - channels: analog channel numbers to read
+        - segments: number of triggered events to capture (1 disables segmented memory)
+        - points: points per segment, None keeps the scope setting
+        - format: 'WORD' (16 bit) or 'BYTE' (8 bit)
+        - timeout: VISA timeout in ms while waiting for the acquisition, None keeps the current one
+
+        Returns:
+            numpy.ndarray of shape (segments, channels, points) in volts.
+        """
+        channels = list(channels)
+        if segments > 1:
+            self.write(':ACQ:MODE SEGM')
+            self.write(f':ACQ:SEGM:COUN {int(segments)}')
+        else:
+            self.write(':ACQ:MODE RTIM')
+        format = self._set_binary_format(format)
+        if points is not None:
+            self.write(':WAV:POIN:MODE RAW')
+            self.write(f':WAV:POIN {int(points)}')
+
+        # Arm once for all channels and wait until every segment has been acquired
+        previous_timeout = self.scope.timeout
+        if timeout is not None:
+            self.scope.timeout = timeout
+        try:
+            self.write(':DIG ' + ','.join(f'CHAN{channel}' for channel in channels))
+            self.query('*OPC?')
+        finally:
+            self.scope.timeout = previous_timeout
+        if segments > 1:
+            self.write(':WAV:SEGM:ALL ON')
+
+        data = None
+        for index, channel in enumerate(channels):
+            self.write(f':WAV:SOUR CHAN{channel}')
+            preamble = self.get_preamble()
+            raw = self._read_block(format)
+            if data is None:
+                n_points = len(raw) // segments
+                data = np.empty((segments, len(channels), n_points))
+            # Scale straight into the preallocated output, no per-segment copies
+            waveform_parser.scale_codes(raw[:segments * n_points].reshape(segments, n_points), preamble,
+                                        out=data[:, index, :])
+        return data
+
+    # Run bit of the Operation Status Condition register, set while the scope is acquiring
+    OPERATION_RUN_BIT = 8
+
+    def acquire_single(self, timeout=10.0, poll_interval=0.002):
+        """
+        Arm a single acquisition (:SING) and return as soon as it has completed.
+
+        Polls the Run bit of :OPER:COND? with a backoff instead of sleeping for a worst case
+        time. Raises TimeoutError if the scope has not triggered within timeout seconds.
+
+        Returns:
+            Seconds from arming to completion.
+        """
+        start = time.perf_counter()
+        self.write(':SING')
+        self.query('*OPC?')  # Make sure :SING has been processed before looking at the Run bit
+        poll_until(lambda: not int(self.query(':OPER:COND?')) & self.OPERATION_RUN_BIT, timeout, poll_interval)
+        return time.perf_counter() - start
+
+    def read_waveform_ascii(self, channel=1, points=None):
+        """Read one channel using :WAV:FORM ASCii. Kept for comparison with read_waveform."""
+        self._select_source(channel, points)
+        self.write(':WAV:FORM ASC')
+        self.get_preamble()
+        self.write(':WAV:DATA?')
+        return waveform_parser.parse_ascii_block(self.scope.read_raw())
+
+    def time_axis(self, n_points=None):
+        """Return the sample times (s) for the last waveform read."""
+        if self.preamble is None:
+            raise ValueError("No waveform has been read yet")
+        return waveform_parser.time_axis(self.preamble, n_points)
 
 
 
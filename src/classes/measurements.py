@@ -1,14 +1,18 @@
 # Import the neccessary modules
-import time
+import threading
 import numpy as np
 import matplotlib.pyplot as plt
-from scipy import signal
-from scipy.fft import fft, ifft, fftfreq
-import librosa
+from scipy.fft import rfft
 from typing import Tuple, Optional
 import warnings
 warnings.filterwarnings('ignore')
-from classes.instruments import SignalGenerator, Oscilloscope
+from classes.instruments import SignalGenerator, Oscilloscope, instrument_addresses
+from classes import tracing
+from classes.spectral import (StreamingWelch, OverlapAddFilter, LockIn, batch_transfer_functions, fir_from_response,
+                              rfft_frequencies, tone_phasors, transform_length)
+from classes.captures import open_capture
+from classes.results import ResultStore
+from classes.stimulus import schroeder_multitone, multitone_response, exponential_sweep, sweep_response
 
 
 
@@ -21,6 +25,7 @@ class dual_channel():
         sg: An instance of the SignalGenerator class.
         type: The waveform type (e.g., 'SIN', 'SQUARE').
         duration: Duration to output the signal in seconds.
+        stop_event: Set it to end the output before duration has elapsed.
 
     Methods:
         show_double: Displays the settings for the dual-channel generator.
@@ -29,6 +34,7 @@ class dual_channel():
         self.sg = SignalGenerator(address)
         self.type = type.upper()
         self.duration = duration
+        self.stop_event = threading.Event()
 
 
     def show_double(self):
@@ -38,20 +44,24 @@ class dual_channel():
         amplitude = float(input("Enter amplitude in mV: "))/1000
         offset = float(input("Enter offset in mV: "))/1000
 
-        for num in [1, 2]:
-            self.sg.sg.write(f'SOUR{num}:FUNC {type_}')
-            self.sg.sg.write(f'SOUR{num}:FREQ {frequency}')
-            self.sg.sg.write(f'SOUR{num}:VOLT {amplitude}')
-            self.sg.sg.write(f'SOUR{num}:VOLT:OFFS {offset}')
-        self.sg.sg.write('SOUR1:PHAS 0')
-        self.sg.sg.write('SOUR2:PHAS 180')
-        self.sg.sg.write('PHAS:SYNC')
-
-        for num in [1, 2]:
-            self.sg.sg.write(f'OUTP{num} ON')
-        time.sleep(self.duration)
-        for num in [1, 2]:
-            self.sg.sg.write(f'OUTP{num} OFF')
+        # One batched write for the whole configuration instead of one USB transaction per command
+        with self.sg.batch():
+            for num in [1, 2]:
+                self.sg.write(f'SOUR{num}:FUNC {type_}')
+                self.sg.write(f'SOUR{num}:FREQ {frequency}')
+                self.sg.write(f'SOUR{num}:VOLT {amplitude}')
+                self.sg.write(f'SOUR{num}:VOLT:OFFS {offset}')
+            self.sg.write('SOUR1:PHAS 0')
+            self.sg.write('SOUR2:PHAS 180')
+            self.sg.write('PHAS:SYNC')
+
+            for num in [1, 2]:
+                self.sg.write(f'OUTP{num} ON')
+        with tracing.span('output hold', self.sg.address):
+            self.stop_event.wait(self.duration)
+        with self.sg.batch(sync=False):
+            for num in [1, 2]:
+                self.sg.write(f'OUTP{num} OFF')
 
 
 class read_scope():
@@ -67,14 +77,12 @@ class read_scope():
     Returns:
         waveform: The waveform data read from the oscilloscope.
     """
-    def __init__(self, address):
+    def __init__(self, address=instrument_addresses['oscilloscope']):
         self.scope = Oscilloscope(address)
 
-    def read_waveform(self, channel=1):
-        self.scope.write(f":MEASU:IMMED:TYPe WAVeform")
-        self.scope.write(f":MEASU:IMMED:WAVeform:CH{channel} ON")
-        waveform = self.scope.read(f":MEASU:IMMED:WAVeform:CH{channel}?")
-        return waveform
+    def read_waveform(self, channel=1, points=None):
+        # Binary block transfer, scaled to volts from the preamble
+        return self.scope.read_waveform(channel=channel, points=points)
 
 
 class TransferFunctionAnalyzer():
@@ -84,49 +92,107 @@ class TransferFunctionAnalyzer():
 
     Attributes:
         sample_rate: The sample rate for audio processing.
+        workers: Number of scipy.fft worker threads (-1 for all cores).
         input_signal: The input audio signal.
         output_signal: The output audio signal.
         transfer_function: The computed transfer function.
         frequencies: The frequency bins corresponding to the transfer function.
+        coherence: Magnitude squared coherence of the last Welch estimate.
+        confidence: Per-bin 95% confidence bounds of the last Welch estimate.
+        segments_used: Number of segments averaged by the last Welch estimate.
+        stream: The StreamingWelch estimator fed by update_stream.
+        transfer_functions: The (n_channels, n_frequencies) result of compute_transfer_functions.
 
     Methods:
-        load_audio_files: Load input and output audio files.
+        load_audio_files: Memory-map input and output capture files.
         set_signals: Set input and output signals directly as numpy arrays.
         compute_transfer_function: Compute the transfer function between input and output signals.
+        start_stream: Start a block-by-block Welch estimate.
+        update_stream: Add input and output blocks to the streaming estimate.
+        measure_until_converged: Acquire blocks until the estimate is within a tolerance.
+        compute_transfer_functions: Compute the transfer functions of many outputs in one batched pass.
+        measure_stimulus: Play a multitone or sweep from the generator and measure the whole response in one capture.
+        compute_tone_response: Gain and phase at known tone frequencies only (lock-in), e.g. one step of a stepped sweep.
+        track_tones: Demodulate acquired blocks at known tones until the response has settled.
+        save_results: Store the transfer function in the results file and catalogue.
         get_magnitude_response: Get the magnitude response of the transfer function.
         get_phase_response: Get the phase response of the transfer function.
         plot_transfer_function: Plot the transfer function.
         plot_signals_comparison: Plot input and output signals for comparison.
         apply_transfer_function: Apply the transfer function to the input signal.
+        fir_kernel: FIR kernel following the transfer function (cached).
+        stream_filter: Overlap-add filter for applying the transfer function to chunked input.
 
     Returns:
         Various plots and data depending on the method called.
     """
 
-    def __init__(self, sample_rate: float = 44100):
+    # Longest FIR kernel designed from a transfer function by default
+    MAX_FIR_TAPS = 4097
+    # Samples passed to the Welch estimator at a time
+    WELCH_BLOCK_SAMPLES = 1 << 22
+    # Segments added between convergence checks when averaging stops early
+    CONVERGENCE_CHECK_SEGMENTS = 8
+
+    def __init__(self, sample_rate: float = 44100, workers: int = -1):
         self.sample_rate = sample_rate
+        self.workers = workers  # scipy.fft threads, -1 uses every core
         self.input_signal = None
         self.output_signal = None
         self.transfer_function = None
         self.frequencies = None
+        self.coherence = None
+        self.confidence = None
+        self.segments_used = 0
+        self.stream = None
+        self.transfer_functions = None
+        self._fir = None  # (H, numtaps, window, (kernel, delay)) of the last FIR kernel designed
+
+    def load_audio_files(self, input_file: str, output_file: str, resample: bool = False, channel: int = 0,
+                         start: float = 0.0, stop: Optional[float] = None, dtype: Optional[str] = None,
+                         channels: int = 1, offset: int = 0) -> None:
+        """
+        Load input and output captures (WAV, .npy or raw, see classes.captures).
 
-    def load_audio_files(self, input_file: str, output_file: str) -> None:
-        """Load input and output audio files."""
-        try:
-            self.input_signal, sr1 = librosa.load(input_file, sr=self.sample_rate)
-            self.output_signal, sr2 = librosa.load(output_file, sr=self.sample_rate)
-
-            # Ensure both signals have the same length
-            min_len = min(len(self.input_signal), len(self.output_signal))
-            self.input_signal = self.input_signal[:min_len]
-            self.output_signal = self.output_signal[:min_len]
-
-            print(f"Loaded audio files successfully")
-            print(f"Signal length: {len(self.input_signal)} samples")
-            print(f"Duration: {len(self.input_signal) / self.sample_rate:.2f} seconds")
+        The files are memory-mapped and nothing is converted up front: float data is
+        used in place and integer data is scaled to floats block by block as it is
+        processed. The analyzer takes the files' sample rate unless resample=True, which
+        converts both to self.sample_rate with polyphase resampling. .npy and raw files
+        are taken to be at self.sample_rate. Errors (missing file, unknown format) are raised.
 
-        except Exception as e:
-            print(f"Error loading audio files: {e}")
+        Parameters:
+        - input_file, output_file: capture files
+        - resample: resample to self.sample_rate instead of adopting the files' rate
+        - channel: channel to use from multichannel files
+        - start, stop: part of the captures to load, in seconds
+        - dtype: sample type of raw files, e.g. '<i2' or '<f4'
+        - channels: interleaved channels in raw files
+        - offset: header bytes to skip in raw files
+        """
+        captures = [open_capture(path, sample_rate=self.sample_rate, dtype=dtype, channels=channels, offset=offset)
+                    for path in (input_file, output_file)]
+        if captures[0].sample_rate != captures[1].sample_rate and not resample:
+            raise ValueError(f"Sample rates differ ({captures[0].sample_rate} and {captures[1].sample_rate} Hz), "
+                             "load with resample=True")
+        signals = []
+        for capture in captures:
+            first = int(round(start * capture.sample_rate))
+            last = None if stop is None else int(round(stop * capture.sample_rate))
+            if resample:
+                signals.append(capture.resample(self.sample_rate, first, last, channel))
+            else:
+                signals.append(capture.view(first, last, channel))
+        if not resample:
+            self.sample_rate = captures[0].sample_rate
+
+        # Ensure both signals have the same length (slicing keeps memory-mapped data unread)
+        min_len = min(len(signals[0]), len(signals[1]))
+        self.input_signal = signals[0][:min_len]
+        self.output_signal = signals[1][:min_len]
+
+        print(f"Loaded audio files successfully")
+        print(f"Signal length: {len(self.input_signal)} samples")
+        print(f"Duration: {len(self.input_signal) / self.sample_rate:.2f} seconds")
 
     def set_signals(self, input_signal: np.ndarray, output_signal: np.ndarray) -> None:
         """Set input and output signals directly as numpy arrays."""
@@ -139,7 +205,8 @@ class TransferFunctionAnalyzer():
         print(f"Signal length: {len(self.input_signal)} samples")
 
     def compute_transfer_function(self, method: str = 'fft', window: str = 'hann', 
-                                nperseg: Optional[int] = None) -> Tuple[np.ndarray, np.ndarray]:
+                                nperseg: Optional[int] = None, pad: bool = False, estimator: str = 'H1',
+                                tolerance: Optional[float] = None) -> Tuple[np.ndarray, np.ndarray]:
         """
         Compute the transfer function H(f) = Y(f) / X(f)
 
@@ -147,57 +214,263 @@ class TransferFunctionAnalyzer():
         - method: 'fft' for simple FFT division, 'welch' for Welch's method
         - window: window function for Welch's method
         - nperseg: length of each segment for Welch's method
+        - pad: for 'fft', zero-pad to the next fast transform length (faster for awkward lengths)
+        - estimator: for 'welch', 'H1', 'H2' or 'Hv' (see StreamingWelch.transfer_function)
+        - tolerance: for 'welch', stop averaging once the relative 95% confidence radius of
+          every coherent bin is below this (None averages the whole signal)
         """
         if self.input_signal is None or self.output_signal is None:
             raise ValueError("Input and output signals must be set first")
 
         if method == 'fft':
-            return self._compute_fft_transfer_function()
+            return self._compute_fft_transfer_function(pad)
         elif method == 'welch':
-            return self._compute_welch_transfer_function(window, nperseg)
+            return self._compute_welch_transfer_function(window, nperseg, estimator, tolerance)
         else:
             raise ValueError("Method must be 'fft' or 'welch'")
 
-    def _compute_fft_transfer_function(self) -> Tuple[np.ndarray, np.ndarray]:
+    def _compute_fft_transfer_function(self, pad: bool = False) -> Tuple[np.ndarray, np.ndarray]:
         """Compute transfer function using simple FFT division."""
-        # Compute FFTs
-        X = fft(self.input_signal)
-        Y = fft(self.output_signal)
+        # Real FFTs: only the positive frequencies are computed, half the work and memory of fft
+        n_fft = transform_length(len(self.input_signal), pad)
+        X = rfft(self.input_signal, n_fft, workers=self.workers)
+        Y = rfft(self.output_signal, n_fft, workers=self.workers)
 
         # Compute transfer function H = Y/X
         # Add small epsilon to avoid division by zero
         epsilon = 1e-10 * np.max(np.abs(X))
-        H = Y / (X + epsilon)
+        Y /= X + epsilon
 
-        # Generate frequency array
-        self.frequencies = fftfreq(len(self.input_signal), 1/self.sample_rate)
-
-        # Only keep positive frequencies
-        n_positive = len(self.frequencies) // 2
-        self.frequencies = self.frequencies[:n_positive]
-        self.transfer_function = H[:n_positive]
+        self.frequencies = rfft_frequencies(n_fft, self.sample_rate)
+        self.transfer_function = Y
 
         return self.frequencies, self.transfer_function
 
-    def _compute_welch_transfer_function(self, window: str, nperseg: Optional[int]) -> Tuple[np.ndarray, np.ndarray]:
+    def _compute_welch_transfer_function(self, window: str, nperseg: Optional[int], estimator: str = 'H1',
+                                         tolerance: Optional[float] = None) -> Tuple[np.ndarray, np.ndarray]:
         """Compute transfer function using Welch's method for better noise handling."""
         if nperseg is None:
             nperseg = len(self.input_signal) // 8
 
-        # Compute cross-power spectral density (Pxy) and auto-power spectral density (Pxx)
-        f, Pxy = signal.csd(self.input_signal, self.output_signal, 
-                           fs=self.sample_rate, window=window, nperseg=nperseg)
-        f, Pxx = signal.welch(self.input_signal, fs=self.sample_rate, 
-                             window=window, nperseg=nperseg)
+        # Pxx, Pyy and Pxy come from the same windowed segment FFTs, so each signal is transformed only once
+        welch = StreamingWelch(self.sample_rate, nperseg, window=window, workers=self.workers)
+        # Feed the signals in blocks, so memory-mapped captures are read a block at a time;
+        # with a tolerance, a few segments at a time, stopping as soon as the estimate has converged
+        if tolerance is None:
+            chunk = max(self.WELCH_BLOCK_SAMPLES // welch.step, 1) * welch.step
+        else:
+            chunk = self.CONVERGENCE_CHECK_SEGMENTS * welch.step
+        for start in range(0, len(self.input_signal), chunk):
+            welch.update(self.input_signal[start:start + chunk], self.output_signal[start:start + chunk])
+            if tolerance is not None and welch.converged(tolerance, estimator=estimator):
+                break
+        return self._store_welch(welch, estimator)
+
+    def _store_welch(self, welch: StreamingWelch, estimator: str) -> Tuple[np.ndarray, np.ndarray]:
+        self.frequencies, self.transfer_function = welch.transfer_function(estimator)
+        self.coherence = welch.coherence()[1]
+        self.confidence = welch.confidence(estimator=estimator)
+        self.segments_used = welch.segments
+        return self.frequencies, self.transfer_function
+
+    def start_stream(self, nperseg: int, window: str = 'hann') -> None:
+        """Start a Welch estimate that is fed block by block with update_stream (live data, long files)."""
+        self.stream = StreamingWelch(self.sample_rate, nperseg, window=window, workers=self.workers)
+
+    def update_stream(self, input_block: np.ndarray, output_block: np.ndarray,
+                      estimator: str = 'H1') -> Tuple[np.ndarray, np.ndarray]:
+        """Add simultaneous input and output blocks and return the transfer function so far."""
+        if self.stream is None:
+            raise ValueError("Call start_stream first")
+        self.stream.update(input_block, output_block)
+        if self.stream.segments == 0:
+            return self.frequencies, self.transfer_function
+        return self._store_welch(self.stream, estimator)
+
+    def measure_until_converged(self, read_blocks, nperseg: int, tolerance: float = 0.01,
+                                max_segments: int = 10000, estimator: str = 'H1',
+                                window: str = 'hann') -> Tuple[np.ndarray, np.ndarray]:
+        """
+        Keep acquiring until the transfer function has converged, instead of for a fixed time.
+
+        Parameters:
+        - read_blocks: callable returning the next (input_block, output_block), e.g. a scope capture
+        - nperseg: Welch segment length
+        - tolerance: relative 95% confidence radius every coherent bin must reach
+        - max_segments: stop after this many segments even if not converged
+        """
+        self.start_stream(nperseg, window)
+        while self.stream.segments < max_segments:
+            self.update_stream(*read_blocks(), estimator=estimator)
+            if self.stream.converged(tolerance, estimator=estimator):
+                break
+        return self.frequencies, self.transfer_function
+
+    def compute_transfer_functions(self, stimulus: np.ndarray, outputs: np.ndarray, method: str = 'fft',
+                                   window: str = 'hann', nperseg: Optional[int] = None,
+                                   processes: Optional[int] = None) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        Compute the transfer functions of many outputs (channels or DUTs) driven by the same stimulus.
+
+        Parameters:
+        - stimulus: (n_samples,) shared input, or (n_channels, n_samples) for method 'fft'
+        - outputs: (n_channels, n_samples)
+        - method: 'fft' or 'welch', as in compute_transfer_function
+        - processes: worker processes, None uses a process pool only for large data
+
+        Returns:
+            (frequencies, H) with H of shape (n_channels, n_frequencies), also kept in
+            self.frequencies and self.transfer_functions.
+        """
+        self.frequencies, self.transfer_functions = batch_transfer_functions(
+            stimulus, outputs, self.sample_rate, method=method, nperseg=nperseg, window=window,
+            workers=self.workers, processes=processes)
+        return self.frequencies, self.transfer_functions
+
+    def measure_stimulus(self, generator: SignalGenerator, scope: Optional[Oscilloscope] = None,
+                         stimulus: str = 'multitone', f_min: float = 20, f_max: float = 20000,
+                         duration: float = 0.1, play_rate: float = 1e6, amplitude: float = 0.1,
+                         channel: int = 1, scope_channels: Tuple[int, ...] = (1, 2), repeats: int = 3,
+                         capture_rate: Optional[float] = None, capture=None, **options) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        Measure the whole frequency response in one acquisition instead of one point per frequency.
+
+        A Schroeder multitone period or an exponential sweep is uploaded to the generator
+        with load_arb and played repeatedly, the DUT input and output are captured together
+        and only the excited bins are demodulated (multitone) or the impulse response is
+        deconvolved (sweep, which also rejects harmonic distortion).
+
+        Parameters:
+        - generator: SignalGenerator driving the DUT
+        - scope: Oscilloscope capturing the DUT input on scope_channels[0] and outputs on the rest
+        - stimulus: 'multitone' or 'sweep'
+        - f_min, f_max: band to measure (Hz)
+        - duration: multitone period or sweep length in seconds
+        - play_rate: arbitrary waveform sample rate
+        - amplitude: peak-to-peak volts
+        - channel: generator channel
+        - repeats: periods (or sweeps) covered by the capture
+        - capture_rate: scope sample rate, None uses 4 * f_max; must exceed 2 * f_max
+        - capture: instead of the scope, a callable(seconds) returning (input, outputs, sample_rate),
+          e.g. an APx recording
+        - options: n_tones and spacing for schroeder_multitone
+
+        Returns:
+            (frequencies, H), also kept in self.frequencies and self.transfer_function
+            (and self.transfer_functions when several outputs are captured).
+        """
+        if capture_rate is None:
+            capture_rate = 4 * f_max
+        if f_max >= capture_rate / 2:
+            raise ValueError(f"f_max ({f_max:g} Hz) must be below half the capture rate ({capture_rate:g} Hz)")
+        n_samples = int(round(duration * play_rate))
+        if stimulus == 'multitone':
+            samples, tones = schroeder_multitone(play_rate, n_samples, f_min, f_max, **options)
+        elif stimulus == 'sweep':
+            samples, _ = exponential_sweep(play_rate, duration, f_min, f_max)
+        else:
+            raise ValueError("Stimulus must be 'multitone' or 'sweep'")
+        generator.load_arb(samples, play_rate, name=stimulus.upper(), channel=channel, amplitude=amplitude)
+        generator.write(f'OUTP{channel} ON')
+
+        try:
+            if capture is None:
+                # Enough points over the record for capture_rate, not whatever the scope was left at
+                scope.write(f':TIM:RANG {repeats * duration}')
+                points = int(np.ceil(repeats * duration * capture_rate))
+                data = scope.capture(channels=scope_channels, points=points)[0]
+                x, y, rate = data[0], data[1:], 1 / scope.preamble['xincrement']
+            else:
+                x, y, rate = capture(repeats * duration)
+                y = np.atleast_2d(y)
+        finally:
+            generator.write(f'OUTP{channel} OFF')
+        if f_max >= rate / 2:
+            raise ValueError(f"The capture was sampled at {rate:g} Hz, too slow for f_max ({f_max:g} Hz)")
+
+        with tracing.span(f'{stimulus} analysis'):
+            if stimulus == 'multitone':
+                frequencies, H = tones, multitone_response(x, y, rate, tones, n_samples / play_rate)
+            else:
+                frequencies, H = sweep_response(x, y, rate, duration, f_min, f_max)
+
+        self.sample_rate = rate
+        self.input_signal, self.output_signal = x, y[0]
+        self.frequencies, self.transfer_function = frequencies, H[0]
+        self.transfer_functions = H if len(H) > 1 else None
+        return self.frequencies, self.transfer_function
 
-        # Transfer function H = Pxy / Pxx
-        epsilon = 1e-10 * np.max(Pxx)
-        H = Pxy / (Pxx + epsilon)
+    def _store_tones(self, frequencies: np.ndarray, H: np.ndarray, append: bool) -> Tuple[np.ndarray, np.ndarray]:
+        if append and self.frequencies is not None and self.transfer_function is not None:
+            # Merge the new points into the sweep so far, sorted by frequency for plotting
+            frequencies = np.concatenate([self.frequencies, frequencies])
+            H = np.concatenate([self.transfer_function, H])
+            order = np.argsort(frequencies, kind='stable')
+            frequencies, H = frequencies[order], H[order]
+        self.frequencies, self.transfer_function = frequencies, H
+        return self.frequencies, self.transfer_function
 
-        self.frequencies = f
-        self.transfer_function = H
+    def compute_tone_response(self, frequencies, window: Optional[str] = 'hann',
+                              append: bool = False) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        Gain and phase of the output relative to the input at the given tones only.
 
-        return f, H
+        Much cheaper than a full FFT of the record when a sine is stepped through
+        frequencies, and the tones need not fall on FFT bins.
+
+        Parameters:
+        - frequencies: tone frequency or frequencies in Hz
+        - window: window applied before demodulating, None for none
+        - append: add the points to the existing result (one call per step of a stepped sweep)
+        """
+        if self.input_signal is None or self.output_signal is None:
+            raise ValueError("Input and output signals must be set first")
+        frequencies = np.atleast_1d(np.asarray(frequencies, dtype=float))
+        phasors = tone_phasors(np.vstack([self.input_signal, self.output_signal]), frequencies,
+                               self.sample_rate, window=window)
+        return self._store_tones(frequencies, phasors[1] / phasors[0], append)
+
+    def track_tones(self, read_blocks, frequencies, tolerance: float = 1e-3, max_blocks: int = 1000,
+                    append: bool = False) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        Demodulate blocks at known tones as they are acquired, until the response has settled.
+
+        Parameters:
+        - read_blocks: callable returning the next (input_block, output_block)
+        - frequencies: tone frequency or frequencies in Hz
+        - tolerance: relative change below which the response counts as settled
+        - max_blocks: stop after this many blocks even if not settled
+        - append: add the points to the existing result
+        """
+        lock_in = LockIn(self.sample_rate, frequencies)
+        for _ in range(max_blocks):
+            lock_in.update(*read_blocks())
+            if lock_in.settled(tolerance):
+                break
+        return self._store_tones(lock_in.frequencies, lock_in.response()[0], append)
+
+    def save_results(self, label: str = 'unlabeled', comment: str = '', path: Optional[str] = None,
+                     **attributes) -> str:
+        """
+        Store the computed transfer function (and coherence, if any) as a 'transfer_function' run.
+
+        Parameters:
+        - label: board / chip label
+        - comment: free text
+        - path: results file, None uses the default (see classes.results)
+        - attributes: further values to store and query by, e.g. supply_voltage=1.8
+
+        Returns:
+            The run's path in the results file.
+        """
+        if self.transfer_function is None:
+            raise ValueError("Transfer function not computed yet")
+        arrays = {'frequency': self.frequencies, 'transfer_function': self.transfer_function}
+        if self.coherence is not None and np.shape(self.coherence) == np.shape(self.transfer_function):
+            arrays['coherence'] = self.coherence
+        with ResultStore(path) as store:
+            return store.save('transfer_function', arrays, label=label, comment=comment,
+                              sample_rate=self.sample_rate, segments_used=self.segments_used, **attributes)
 
     def get_magnitude_response(self) -> Tuple[np.ndarray, np.ndarray]:
         """Get magnitude response in dB."""
@@ -284,48 +557,37 @@ class TransferFunctionAnalyzer():
 
         plt.show()
 
-    def apply_transfer_function(self, test_signal: np.ndarray) -> np.ndarray:
-        """Apply the computed transfer function to a test signal."""
+    def fir_kernel(self, numtaps: Optional[int] = None, window: str = 'hann') -> Tuple[np.ndarray, int]:
+        """
+        FIR kernel (and its delay in samples) following the computed transfer function, cached until H changes.
+
+        numtaps defaults to the resolution of H, capped at MAX_FIR_TAPS.
+        """
         if self.transfer_function is None:
             raise ValueError("Transfer function not computed yet")
+        if numtaps is None:
+            numtaps = min(2 * (len(self.frequencies) - 1) + 1, self.MAX_FIR_TAPS)
+        cached = self._fir
+        if cached is None or cached[0] is not self.transfer_function or cached[1:3] != (numtaps, window):
+            self._fir = (self.transfer_function, numtaps, window,
+                         fir_from_response(self.frequencies, self.transfer_function, self.sample_rate, numtaps, window))
+        return self._fir[3]
+
+    def stream_filter(self, numtaps: Optional[int] = None, block_size: Optional[int] = None) -> OverlapAddFilter:
+        """
+        Overlap-add filter simulating the DUT, for chunked input: call process(chunk) per chunk.
 
-        # Compute FFT of test signal
-        X_test = fft(test_signal)
-        n_test = len(X_test)
-
-        # Create frequency array for test signal
-        freq_test = fftfreq(n_test, 1/self.sample_rate)
-        freq_positive_test = freq_test[:n_test//2]
-
-        # Interpolate transfer function to match test signal frequencies
-        mag_interp = np.interp(freq_positive_test, self.frequencies, np.abs(self.transfer_function))
-        phase_interp = np.interp(freq_positive_test, self.frequencies, np.angle(self.transfer_function))
-
-        # Reconstruct complex transfer function for positive frequencies
-        H_positive = mag_interp * np.exp(1j * phase_interp)
-
-        # Mirror for negative frequencies (excluding DC and Nyquist if present)
-        if n_test % 2 == 0:  # Even length
-            H_full = np.concatenate([H_positive, np.conj(H_positive[-2:0:-1])])
-        else:  # Odd length
-            H_full = np.concatenate([H_positive, np.conj(H_positive[-1:0:-1])])
-
-
-        # Ensure both signals have the same length
-        min_len = min(len(X_test), len(H_full))
-        X_test = X_test[:min_len]
-        H_full = H_full[:min_len]
-
-        # Apply transfer function
-        Y_test = X_test * H_full
-
-        # Convert back to time domain
-        y_test = np.real(ifft(Y_test))
-
-        return y_test
-
-
-
+        The output lags the input by the kernel delay (fir_kernel()[1] samples).
+        """
+        kernel, _ = self.fir_kernel(numtaps)
+        return OverlapAddFilter(kernel, block_size, workers=self.workers)
 
+    def apply_transfer_function(self, test_signal: np.ndarray, numtaps: Optional[int] = None) -> np.ndarray:
+        """Apply the computed transfer function to a test signal."""
+        kernel, delay = self.fir_kernel(numtaps)
+        fir = OverlapAddFilter(kernel, workers=self.workers)
 
+        # Filter block by block, then drop the kernel delay so the output lines up with the input
+        y_test = np.concatenate([fir.process(test_signal), fir.flush()])
 
+        return y_test[delay:delay + len(test_signal)]
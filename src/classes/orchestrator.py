@@ -0,0 +1,92 @@
+# Concurrent setup of every instrument in a test from one declarative description
+import asyncio
+from classes.async_instruments import AsyncSMU, AsyncSignalGenerator, AsyncOscilloscope, executor_for
+
+# Instrument kinds accepted in a setup description
+INSTRUMENT_KINDS = {
+    'smu': AsyncSMU,
+    'generator': AsyncSignalGenerator,
+    'scope': AsyncOscilloscope,
+}
+
+
+async def _open(spec, pool):
+    # Opening a session can take seconds, so it runs on the instrument's own I/O thread too
+    cls = INSTRUMENT_KINDS[spec['kind']]
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(executor_for(spec['address']),
+                                      lambda: cls(spec['address'], spec.get('reset', False), pool))
+
+
+async def _configure(instrument, spec):
+    """Apply every setting of spec except enabling the outputs, ending with one *OPC?."""
+    kind = spec['kind']
+
+    def configure(device):
+        # One synced batch: nested batches (source_voltage, configure) join it, so the
+        # settings go out in as few writes as possible and its closing *OPC? is the barrier
+        with device.batch(sync=True):
+            if kind == 'smu' and 'voltage' in spec:
+                device.source_voltage(spec['voltage'], spec['current_limit'], enable=False)
+            elif kind == 'generator':
+                for channel, settings in spec.get('channels', {}).items():
+                    device.configure(channel, **settings)
+            for command in spec.get('commands', []):
+                device.write(command)
+    await instrument.run(configure, instrument.instrument)
+
+
+async def _enable(instrument, spec):
+    kind = spec['kind']
+    if kind == 'smu' and spec.get('output', False):
+        await instrument.write('OUTP ON')
+    elif kind == 'generator':
+        def enable_outputs(sg):
+            with sg.batch():
+                for channel in spec.get('outputs', []):
+                    sg.write(f'OUTP{channel} ON')
+                if spec.get('phase_sync', False):
+                    sg.write('PHAS:SYNC')
+        await instrument.run(enable_outputs, instrument.instrument)
+
+
+async def setup_instruments(config, pool=None, enable_outputs=True):
+    """
+    Open and configure every instrument of a test concurrently.
+
+    All instruments are configured at the same time with their outputs left alone,
+    each in one batch closed by a single *OPC?, so once every configuration has returned
+    every instrument has applied its settings; only then are the outputs enabled. Total setup time is close to that of the slowest instrument rather
+    than the sum of all of them.
+
+    Parameters:
+    - config: {name: spec}, where spec is a dict with
+        'kind': 'smu', 'generator' or 'scope'
+        'address': VISA address
+        'reset': send *RST when opening (default False)
+        'commands': extra SCPI commands sent during configuration
+      and, depending on the kind:
+        smu: 'voltage', 'current_limit', 'output' (enable the output, default False)
+        generator: 'channels' ({channel: SignalGenerator.configure() keyword arguments}),
+                   'outputs' (channels to switch on), 'phase_sync' (send PHAS:SYNC after enabling)
+    - pool: SessionPool to borrow sessions from, None uses the default pool
+    - enable_outputs: set False to stop after the barrier
+
+    Returns:
+        {name: AsyncInstrument}
+    """
+    for name, spec in config.items():
+        if spec.get('kind') not in INSTRUMENT_KINDS:
+            raise ValueError(f"Unknown instrument kind for '{name}': {spec.get('kind')}")
+
+    names = list(config)
+    opened = await asyncio.gather(*(_open(config[name], pool) for name in names))
+    instruments = dict(zip(names, opened))
+
+    # Barrier: each configuration ends with *OPC?, so every instrument has applied its
+    # settings before any output is switched on
+    await asyncio.gather(*(_configure(instruments[name], config[name]) for name in names))
+
+    if enable_outputs:
+        await asyncio.gather(*(_enable(instruments[name], config[name]) for name in names))
+    return instruments
@@ -0,0 +1,124 @@
+# Compressed, columnar storage of measurement results together with their settings and comments
+import json
+import os
+from datetime import datetime
+import h5py
+import numpy as np
+from classes.catalogue import Catalogue, catalogue_path
+
+# Set to a file name to store results somewhere other than results.h5 in the working directory
+RESULTS_ENV_VAR = 'LAB_INSTRUMENTS_RESULTS'
+DEFAULT_PATH = 'results.h5'
+
+
+class ResultStore:
+    """
+    Measurement runs kept in one HDF5 file.
+
+    Each run is a group /<kind>/<timestamp>_<label> (kind being e.g. 'scope' or
+    'noise') holding chunked, compressed datasets, with the DUT label, comment,
+    creation time, instrument settings and any other values as attributes.
+    Datasets can be grown while measuring with append(), and read() returns
+    h5py datasets that only load the part that is sliced, so going through
+    thousands of runs never parses or loads every sample. Saved runs are also
+    entered in the SQLite catalogue next to the file (classes.catalogue).
+
+    Attributes:
+        path: The HDF5 file.
+        file: The open h5py.File.
+        catalogue: The Catalogue runs are indexed in, None if disabled.
+
+    Methods:
+        create_run: Creates an empty run with its metadata.
+        append: Appends samples to a dataset of a run, creating it if needed.
+        save: Creates a run and writes complete arrays in one call.
+        runs: Lists the runs, optionally of one kind.
+        attributes: Returns a run's metadata.
+        read: Returns a dataset for lazy slicing.
+        index: Enters a run (e.g. one built with append) in the catalogue.
+        close: Closes the file.
+    """
+    # LZF compresses at a fraction of gzip's CPU cost, shuffle groups the bytes of each sample first
+    COMPRESSION = 'lzf'
+
+    def __init__(self, path=None, mode='a', catalogue=True):
+        self.path = path or os.environ.get(RESULTS_ENV_VAR, DEFAULT_PATH)
+        self.file = h5py.File(self.path, mode)
+        self.catalogue = Catalogue(catalogue_path(self.path)) if catalogue else None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def close(self):
+        self.file.close()
+        if self.catalogue is not None:
+            self.catalogue.close()
+
+    def create_run(self, kind, label='unlabeled', comment='', settings=None, **attributes):
+        """
+        Create an empty run and return its path in the file (e.g. '/scope/2025-01-31_12-00-00-000000_board3').
+
+        Parameters:
+        - kind: type of measurement, the group the run is stored under
+        - label: board / chip label
+        - comment: free text
+        - settings: dict of instrument settings (e.g. an instrument's shadow), stored as JSON
+        - attributes: further scalar values (supply voltage, address, ...), None values are skipped
+        """
+        created = datetime.now()
+        label = (label or 'unlabeled').replace('/', '_')
+        group = self.file.require_group(kind).create_group(f'{created:%Y-%m-%d_%H-%M-%S-%f}_{label}')
+        group.attrs.update({'kind': kind, 'label': label, 'comment': comment, 'created': created.isoformat(),
+                            'settings': json.dumps(settings or {})})
+        for key, value in attributes.items():
+            if value is not None:
+                group.attrs[key] = value
+        return group.name
+
+    def append(self, run, name, data):
+        """Append data along the first axis of a run's dataset, so results can be stored while measuring."""
+        data = np.atleast_1d(np.asarray(data))
+        group = self.file[run]
+        if name not in group:
+            group.create_dataset(name, data=data, maxshape=(None,) + data.shape[1:], chunks=True,
+                                 compression=self.COMPRESSION, shuffle=True)
+        else:
+            dataset = group[name]
+            start = dataset.shape[0]
+            dataset.resize(start + data.shape[0], axis=0)
+            dataset[start:] = data
+        # Flush so what has been measured so far survives a crash
+        self.file.flush()
+
+    def save(self, kind, arrays, label='unlabeled', comment='', settings=None, **attributes):
+        """Create a run holding the arrays of a dict {name: array}. Returns the run's path."""
+        run = self.create_run(kind, label, comment, settings, **attributes)
+        for name, data in arrays.items():
+            self.append(run, name, data)
+        if self.catalogue is not None:
+            # Summarise the arrays still in memory rather than reading them back
+            self.catalogue.add_run(self.path, run, self.attributes(run), arrays)
+        return run
+
+    def index(self, run):
+        """Enter a run in the catalogue, e.g. once a run grown with append() is complete."""
+        if self.catalogue is not None:
+            self.catalogue.add_run(self.path, run, self.attributes(run), dict(self.file[run].items()))
+
+    def runs(self, kind=None):
+        """Paths of the stored runs, oldest first within each kind."""
+        kinds = [kind] if kind is not None else list(self.file)
+        return [self.file[k][name].name for k in kinds if k in self.file for name in sorted(self.file[k])]
+
+    def attributes(self, run):
+        """Metadata of a run as a dict, with the settings decoded."""
+        attributes = dict(self.file[run].attrs)
+        attributes['settings'] = json.loads(attributes.get('settings', '{}'))
+        return attributes
+
+    def read(self, run, name):
+        """The dataset (nothing is read until it is sliced, e.g. store.read(run, 'voltage')[:1000])."""
+        return self.file[run][name]
@@ -0,0 +1,120 @@
+# Process-wide pool of open VISA sessions shared by all instrument objects and GUI windows
+import atexit
+import os
+import threading
+import pyvisa
+from classes.tracing import TracedSession
+
+# Set to 1 to run everything against classes.simulator instead of the real instruments
+SIMULATE_ENV_VAR = 'LAB_INSTRUMENTS_SIMULATED'
+
+
+class SessionPool:
+    """
+    Keeps one VISA session open per address for the lifetime of the process.
+
+    Opening a USB instrument and resetting it takes seconds and wipes its state, so
+    instrument objects borrow already-open sessions from the pool instead of opening
+    their own. Everything is closed by close_all(), which is registered with atexit.
+
+    Attributes:
+        rm: The shared resource manager (created on first use, simulated if LAB_INSTRUMENTS_SIMULATED is set).
+        sessions: The open sessions, keyed by VISA address.
+        shadows: The last written settings of each session, keyed by VISA address.
+        arbs: The arbitrary waveforms resident in each generator's volatile memory, keyed by VISA address.
+
+    Methods:
+        open: Returns the open session for an address, opening it if needed.
+        shadow: Returns the settings shadow shared by every user of an address.
+        arb_cache: Returns the resident arbitrary waveform cache of an address.
+        close: Closes the session for one address.
+        close_all: Closes every session and the resource manager.
+    """
+    def __init__(self, rm=None):
+        # rm can be any object with open_resource(), e.g. classes.simulator.SimulatedResourceManager
+        self._rm = rm
+        self.sessions = {}
+        self.shadows = {}
+        self.arbs = {}
+        self._lock = threading.Lock()
+
+    @property
+    def rm(self):
+        if self._rm is None:
+            if os.environ.get(SIMULATE_ENV_VAR, '0') not in ('', '0'):
+                from classes.simulator import SimulatedResourceManager
+                self._rm = SimulatedResourceManager()
+            else:
+                self._rm = pyvisa.ResourceManager()
+        return self._rm
+
+    def open(self, address, reset=False):
+        """
+        Get the session for address.
+
+        Parameters:
+        - address: VISA resource address
+        - reset: send *RST before handing the session out
+
+        Returns:
+            (session, opened): opened is True if the session was opened by this call,
+            so the caller knows whether one-off configuration is still needed.
+        """
+        with self._lock:
+            session = self.sessions.get(address)
+            opened = session is None
+            if opened:
+                # Wrapped so classes.tracing can record its traffic once enabled
+                session = TracedSession(self.rm.open_resource(address), address)
+                session.write_termination = '\n'
+                session.read_termination = '\n'
+                session.write('*CLS')
+                self.sessions[address] = session
+        if reset:
+            session.write('*RST')
+            session.write('*CLS')
+            self.shadow(address).clear()
+            self.arb_cache(address).clear()
+        return session, opened or reset
+
+    def shadow(self, address):
+        """The settings shadow for address, shared so every instrument object sees the same state."""
+        with self._lock:
+            return self.shadows.setdefault(address, {})
+
+    def arb_cache(self, address):
+        """{(channel, name): (checksum, points)} of the arbitrary waveforms loaded into address."""
+        with self._lock:
+            return self.arbs.setdefault(address, {})
+
+    def close(self, address):
+        with self._lock:
+            session = self.sessions.pop(address, None)
+            self.shadows.pop(address, None)
+            self.arbs.pop(address, None)
+        if session is not None:
+            session.close()
+
+    def close_all(self):
+        with self._lock:
+            sessions, self.sessions = list(self.sessions.values()), {}
+            self.shadows = {}
+            self.arbs = {}
+            rm, self._rm = self._rm, None
+        for session in sessions:
+            try:
+                session.close()
+            except Exception:
+                pass
+        if rm is not None:
+            rm.close()
+
+
+# Default pool used by the instrument classes
+pool = SessionPool()
+atexit.register(pool.close_all)
+
+
+def close_all():
+    """Close every pooled instrument session (called on application exit)."""
+    pool.close_all()
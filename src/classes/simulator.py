@@ -0,0 +1,510 @@
+# Offline stand-ins for the VISA instruments, used for benchmarking and testing without hardware
+import time
+import numpy as np
+from classes import waveform_parser
+
+
+class SimulatedResourceManager:
+    """
+    Drop-in replacement for pyvisa.ResourceManager that hands out simulated instruments.
+
+    The instrument model is picked from the USB vendor/product ID in the address
+    (see MODELS), or from the models argument for addresses that do not follow it.
+
+    Attributes:
+        latency: Simulated per-transaction bus latency in seconds.
+        bytes_per_second: Simulated bus throughput used to delay transfers.
+        time_scale: Multiplier on the simulated instrument processing times (0 disables them).
+        models: Extra {address: simulated model class} overrides.
+        resources: The simulated resources opened so far, keyed by address.
+
+    Methods:
+        open_resource: Opens (or reuses) a simulated instrument for an address.
+        list_resources: Lists the addresses opened so far.
+        close: Closes all simulated resources.
+    """
+    def __init__(self, latency=0.5e-3, bytes_per_second=25e6, time_scale=1.0, models=None):
+        self.latency = latency
+        self.bytes_per_second = bytes_per_second
+        self.time_scale = time_scale
+        self.models = dict(models or {})
+        self.resources = {}
+
+    def _model_for(self, address):
+        if address in self.models:
+            return self.models[address]
+        for usb_id, model in MODELS.items():
+            if usb_id in address.upper():
+                return model
+        raise ValueError(f"No simulated instrument for {address}")
+
+    def open_resource(self, address):
+        if address not in self.resources:
+            model = self._model_for(address)
+            self.resources[address] = model(address, self.latency, self.bytes_per_second, self.time_scale)
+        return self.resources[address]
+
+    def list_resources(self):
+        return tuple(self.resources)
+
+    def close(self):
+        for resource in self.resources.values():
+            resource.close()
+
+
+class SimulatedResource:
+    """
+    Minimal pyvisa MessageBasedResource look-alike with a generic SCPI parser.
+
+    Messages are split on ';' so batched writes work. Common commands (*IDN?, *RST, *OPC,
+    *ESR?, SYST:ERR?, ...) are handled here, subclasses handle their own subsystems in
+    handle_command, and any other setting is kept in self.settings so that 'HEADER value'
+    followed by 'HEADER?' reads the value back. Timing is modelled as a bus latency per
+    transaction, a throughput per byte and a processing time per command (COMMAND_TIMES).
+    """
+    IDN = 'SIMULATED,INSTRUMENT,0,1.0'
+    # Processing time in seconds of commands starting with these headers, DEFAULT_COMMAND_TIME otherwise
+    COMMAND_TIMES = {'*RST': 0.1}
+    DEFAULT_COMMAND_TIME = 0.2e-3
+
+    def __init__(self, address, latency=0.5e-3, bytes_per_second=25e6, time_scale=1.0):
+        self.resource_name = address
+        self.latency = latency
+        self.bytes_per_second = bytes_per_second
+        self.time_scale = time_scale
+        self.write_termination = '\n'
+        self.read_termination = '\n'
+        self.timeout = 2000
+        self._response = b''
+        self.errors = []
+        self.esr = 0
+        self.opc_pending = False
+        self.busy_until = 0.0  # Overlapped operations (e.g. acquisitions) finish at this time
+        self.reset()
+
+    def reset(self):
+        self.settings = {}
+
+    # Standard Event Status Register bit of each SCPI error class (-1xx command, -2xx execution, ...)
+    ESR_ERROR_BITS = {'1': 0x20, '2': 0x10, '3': 0x08, '4': 0x04}
+
+    def _error(self, error):
+        # Queue an error for SYST:ERR? and flag its class in *ESR?, as the real instruments do
+        self.errors.append(error)
+        self.esr |= self.ESR_ERROR_BITS.get(error.lstrip('-+')[:1], 0x08)
+
+    def _sleep(self, seconds):
+        if seconds > 0:
+            time.sleep(seconds)
+
+    def _bus_delay(self, n_bytes):
+        self._sleep(self.latency + n_bytes / self.bytes_per_second)
+
+    def _processing_delay(self, header):
+        for prefix, seconds in self.COMMAND_TIMES.items():
+            if header.startswith(prefix):
+                self._sleep(seconds * self.time_scale)
+                return
+        self._sleep(self.DEFAULT_COMMAND_TIME * self.time_scale)
+
+    def write(self, message):
+        self._bus_delay(len(message) + 1)
+        responses = []
+        for part in message.strip().split(';'):
+            header, _, value = part.strip().partition(' ')
+            header = header.lstrip(':').upper()
+            if not header:
+                continue
+            self._processing_delay(header)
+            response = self.handle(header, value.strip())
+            if response is not None:
+                responses.append(response)
+        if len(responses) == 1 and isinstance(responses[0], bytes):
+            self._response = responses[0]
+        elif responses:
+            self._response = (';'.join(responses) + '\n').encode('ascii')
+        return len(message)
+
+    def read_raw(self, size=None):
+        response, self._response = self._response, b''
+        self._bus_delay(len(response))
+        return response
+
+    def read(self):
+        return self.read_raw().decode('ascii').rstrip(self.read_termination or '\n')
+
+    def query(self, message, delay=None):
+        self.write(message)
+        return self.read()
+
+    def query_binary_values(self, message, datatype='f', is_big_endian=False, container=list,
+                            delay=None, header_fmt='ieee', expect_termination=True,
+                            data_points=0, chunk_size=None):
+        self.write(message)
+        dtype = np.dtype(datatype).newbyteorder('>' if is_big_endian else '<')
+        return container(waveform_parser.parse_binary_block(self.read_raw(), dtype))
+
+    def write_raw(self, message):
+        return self.write(bytes(message).decode('ascii'))
+
+    def write_binary_values(self, message, values, datatype='f', is_big_endian=False,
+                            termination=None, encoding=None, header_fmt='ieee'):
+        dtype = np.dtype(datatype).newbyteorder('>' if is_big_endian else '<')
+        return self.write_raw(message.encode('ascii') + self.block(np.asarray(values, dtype).tobytes()))
+
+    def close(self):
+        pass
+
+    def handle(self, header, value):
+        """Execute one command and return its response (str or block bytes), or None."""
+        if header == '*IDN?':
+            return self.IDN
+        if header == '*RST':
+            self.reset()
+        elif header == '*CLS':
+            self.errors = []
+            self.esr = 0
+            self.opc_pending = False
+        elif header == '*OPC?':
+            self._sleep(self.busy_until - time.time())
+            return '1'
+        elif header == '*OPC':
+            self.opc_pending = True
+        elif header == '*ESR?':
+            if self.opc_pending and time.time() >= self.busy_until:
+                self.esr |= 1
+                self.opc_pending = False
+            esr, self.esr = self.esr, 0
+            return str(esr)
+        elif header in ('SYST:ERR?', 'SYST:ERR:NEXT?'):
+            return self.errors.pop(0) if self.errors else '+0,"No error"'
+        else:
+            response = self.handle_command(header, value)
+            if response is not NotImplemented:
+                return response
+            if not header.endswith('?'):
+                self.settings[header] = value
+            elif header[:-1] in self.settings:
+                return self.settings[header[:-1]]
+            else:
+                self._error('-113,"Undefined header"')
+                return '0'
+        return None
+
+    def handle_command(self, header, value):
+        """Subsystem specific commands. Return NotImplemented to fall back to the generic settings store."""
+        return NotImplemented
+
+    @staticmethod
+    def block(payload):
+        """Wrap bytes in an IEEE 488.2 definite-length block header (#<n><length><payload>\\n)."""
+        length = str(len(payload)).encode('ascii')
+        return b'#' + str(len(length)).encode('ascii') + length + payload + b'\n'
+
+
+class SimulatedSMU(SimulatedResource):
+    """
+    Simulated B2901BL source measure unit driving a resistive load.
+
+    Sources a fixed voltage with a current compliance: the measured current is
+    V / LOAD_OHMS clipped to the compliance, plus a little noise. INIT runs TRIG:COUN
+    points of the fixed or LIST:VOLT source into the trace that FETC:ARR? returns; the
+    points appear in TRAC:POIN:ACT? and TRAC:DATA? as the simulated trigger timer runs.
+    ABOR ends a running acquisition at once.
+    """
+    IDN = 'Keysight Technologies,B2901BL,SIMULATED,1.0'
+    COMMAND_TIMES = {'*RST': 0.2, 'OUTP': 5e-3, 'MEAS': 2e-3}
+    LOAD_OHMS = 10e3
+
+    def reset(self):
+        self.settings = {'OUTP': '0', 'VOLT': '0', 'FUNC:MODE': 'VOLT', 'VOLT:MODE': 'FIX', 'SENS:CURR:PROT': '1e-4',
+                         'SENS:CURR:APER': '1e-3', 'TRIG:COUN': '1', 'TRIG:SOUR': 'AINT', 'TRIG:TIM': '1e-3',
+                         'FORM:DATA': 'ASC', 'FORM:BORD': 'NORM', 'FORM:ELEM:SENS': 'VOLT,CURR'}
+        self.rng = np.random.default_rng(0)
+        self.trace = np.zeros((0, 2))  # Voltage, current of the last sweep
+        self.per_point = 0.0
+        self.armed_at = 0.0
+
+    def output_current(self):
+        if self.settings['OUTP'] != '1':
+            return 0.0
+        limit = float(self.settings['SENS:CURR:PROT'])
+        return float(np.clip(float(self.settings['VOLT']) / self.LOAD_OHMS, -limit, limit))
+
+    def handle_command(self, header, value):
+        # VOLT and SOUR:VOLT are the same setting
+        for prefix in ('SOUR1:', 'SOUR:'):
+            if header.startswith(prefix):
+                return self.handle(header[len(prefix):], value)
+        if header in ('MEAS:CURR?', 'MEAS:CURR:DC?'):
+            return f'{self.output_current() + self.rng.normal(0, 1e-9):+.6E}'
+        if header in ('MEAS:VOLT?', 'MEAS:VOLT:DC?'):
+            return f'{self.output_current() * self.LOAD_OHMS + self.rng.normal(0, 1e-6):+.6E}'
+        if header == 'OUTP':
+            self.settings['OUTP'] = '1' if value.upper() in ('ON', '1') else '0'
+            return None
+        if header in ('INIT', 'INIT:ALL', 'INIT:ACQ'):
+            self._run_sweep()
+            return None
+        if header in ('ABOR', 'ABOR:ALL', 'ABOR:ACQ'):
+            # Keep what was acquired so far, *OPC? no longer waits for the rest
+            self.trace = self.trace[:self._acquired()]
+            self.per_point = 0.0
+            self.busy_until = 0.0
+            return None
+        if header in ('FETC:ARR?', 'FETC:ARR:ALL?'):
+            return self._format(self._elements(self.trace).ravel())
+        if header == 'TRAC:POIN:ACT?':
+            return str(self._acquired())
+        if header == 'TRAC:DATA?':
+            offset, size = ([int(v) for v in value.split(',')] + [0, 0])[:2]
+            end = self._acquired() if not size else min(offset + size, self._acquired())
+            return self._format(self._elements(self.trace[offset:end]).ravel())
+        return NotImplemented
+
+    def _acquired(self):
+        # Points of the running acquisition taken so far
+        if self.per_point * self.time_scale <= 0:
+            return len(self.trace)
+        return min(len(self.trace), int((time.time() - self.armed_at) / (self.per_point * self.time_scale)))
+
+    def _elements(self, trace):
+        columns = {'VOLT': 0, 'CURR': 1}
+        elements = self.settings.get('FORM:ELEM:SENS', 'VOLT,CURR').upper().split(',')
+        return trace[:, [columns[e.strip()[:4]] for e in elements if e.strip()[:4] in columns]]
+
+    def _run_sweep(self):
+        # A list sweep steps through LIST:VOLT, a fixed source repeats VOLT, TRIG:COUN times
+        count = int(float(self.settings['TRIG:COUN']))
+        if self.settings['VOLT:MODE'].upper().startswith('LIST'):
+            sources = np.array([float(v) for v in self.settings.get('LIST:VOLT', '0').split(',')])
+        else:
+            sources = np.array([float(self.settings['VOLT'])])
+        sources = np.resize(sources, count)
+        limit = float(self.settings['SENS:CURR:PROT'])
+        on = self.settings['OUTP'] == '1'
+        current = np.clip(sources / self.LOAD_OHMS, -limit, limit) * on + self.rng.normal(0, 1e-9, count)
+        voltage = current * self.LOAD_OHMS + self.rng.normal(0, 1e-6, count)
+        self.trace = np.column_stack([voltage, current])
+        self.per_point = float(self.settings['SENS:CURR:APER'])
+        if self.settings.get('TRIG:SOUR', 'AINT').upper().startswith('TIM'):
+            self.per_point = max(self.per_point, float(self.settings.get('TRIG:TIM', '0')))
+        self.armed_at = time.time()
+        self.busy_until = self.armed_at + count * self.per_point * self.time_scale
+
+    def _format(self, values):
+        if self.settings['FORM:DATA'].upper().startswith('REAL'):
+            dtype = '<f8' if self.settings['FORM:BORD'].upper().startswith('SWAP') else '>f8'
+            return self.block(values.astype(dtype).tobytes())
+        return ','.join(f'{v:+.6E}' for v in values)
+
+
+class SimulatedSignalGenerator(SimulatedResource):
+    """
+    Simulated 33500B two channel waveform generator.
+
+    Headers without a channel (FREQ, OUTP, ...) address channel 1, so 'FREQ 1000' and
+    'SOUR1:FREQ?' see the same setting. APPL:<function> sets function, frequency,
+    amplitude and offset of channel 1 and enables its output, as on the real instrument.
+    Binary DATA:ARB:DAC uploads (write_raw or write_binary_values) are kept per channel in
+    self.arbs, and like the real instrument, uploading a name that is already there is an
+    error. *TRG steps channels in FREQ:MODE LIST through their LIST:FREQ values.
+    """
+    IDN = 'Agilent Technologies,33522B,SIMULATED,1.0'
+    COMMAND_TIMES = {'*RST': 0.1, 'APPL': 20e-3, 'FUNC': 5e-3, 'SOUR1:FUNC': 5e-3, 'SOUR2:FUNC': 5e-3}
+    # Subsystems that belong to a source channel
+    SOURCE_SUBSYSTEMS = ('FUNC', 'FREQ', 'VOLT', 'PHAS', 'DATA', 'LIST', 'SWE', 'BURS', 'AM', 'FM')
+
+    def reset(self):
+        self.settings = {}
+        self.arbs = {}  # {(channel, name): int16 DAC codes} in volatile memory
+        for channel in (1, 2):
+            self.settings.update({f'SOUR{channel}:FUNC': 'SIN', f'SOUR{channel}:FREQ': '1000',
+                                  f'SOUR{channel}:VOLT': '0.1', f'SOUR{channel}:VOLT:OFFS': '0',
+                                  f'SOUR{channel}:PHAS': '0', f'OUTP{channel}': '0'})
+
+    @classmethod
+    def channel_header(cls, header):
+        """Add the implied channel 1 to headers such as FREQ, SOUR:FREQ and OUTP."""
+        if header.startswith('SOUR') and not header[4:5].isdigit():
+            return 'SOUR1' + header[4:]
+        if header.startswith('OUTP') and not header[4:5].isdigit():
+            return 'OUTP1' + header[4:]
+        if header.split(':')[0].rstrip('?') in cls.SOURCE_SUBSYSTEMS and not header.startswith('PHAS:SYNC'):
+            return 'SOUR1:' + header
+        return header
+
+    def handle_command(self, header, value):
+        if header.startswith('APPL'):
+            function = header.split(':')[1] if ':' in header else 'SIN'
+            args = [arg.strip() for arg in value.split(',') if arg.strip()]
+            self.settings['SOUR1:FUNC'] = function
+            for key, arg in zip(('SOUR1:FREQ', 'SOUR1:VOLT', 'SOUR1:VOLT:OFFS'), args):
+                self.settings[key] = arg
+            self.settings['OUTP1'] = '1'
+            return None
+        if header == '*TRG':
+            # Bus triggered frequency lists advance one point per trigger
+            for channel in (1, 2):
+                if self.settings.get(f'SOUR{channel}:FREQ:MODE', 'CW').startswith('LIST'):
+                    frequencies = self.settings.get(f'SOUR{channel}:LIST:FREQ', '').split(',')
+                    index = (self.settings.get(f'LIST{channel}:INDEX', -1) + 1) % len(frequencies)
+                    self.settings[f'LIST{channel}:INDEX'] = index
+                    self.settings[f'SOUR{channel}:FREQ'] = frequencies[index]
+            return None
+        channel_header = self.channel_header(header)
+        if channel_header != header:
+            return self.handle(channel_header, value)
+        if header in ('OUTP1', 'OUTP2'):
+            self.settings[header] = '1' if value.upper() in ('ON', '1') else '0'
+            return None
+        if header.endswith(':DATA:VOL:CLE'):
+            channel = int(header[4])
+            self.arbs = {key: codes for key, codes in self.arbs.items() if key[0] != channel}
+            return None
+        if header.endswith(':DATA:VOL:CAT?'):
+            return ','.join(f'"{name}"' for channel, name in self.arbs if channel == int(header[4]))
+        if header.endswith(':FUNC:ARB') and (int(header[4]), value.strip('"').upper()) not in self.arbs:
+            self._error('-224,"Illegal parameter value"')
+            return None
+        return NotImplemented
+
+    def write_raw(self, message):
+        # Binary uploads: '<header> <name>,#<n><length><payload>'
+        message = bytes(message)
+        start = message.find(b'#')
+        if start < 0:
+            return self.write(message.decode('ascii'))
+        self._bus_delay(len(message))
+        header, _, argument = message[:start].decode('ascii').strip().partition(' ')
+        header = self.channel_header(header.lstrip(':').upper())
+        self._processing_delay(header)
+        offset, length = waveform_parser.parse_block_header(message[start:])
+        payload = message[start + offset:start + offset + length]
+        if header.endswith(':DATA:ARB:DAC'):
+            dtype = '<i2' if self.settings.get('FORM:BORD', 'NORM').upper().startswith('SWAP') else '>i2'
+            key = (int(header[4]), argument.rstrip(',').strip().upper())
+            if key in self.arbs:
+                # Names cannot be overwritten, the old waveform stays
+                self._error('-221,"Settings conflict;arb name already exists"')
+            else:
+                self.arbs[key] = np.frombuffer(payload, dtype)
+        else:
+            self._error('-113,"Undefined header"')
+        return len(message)
+
+
+class SimulatedOscilloscope(SimulatedResource):
+    """
+    Simulated HD304MSO supporting the :WAV, :ACQ and :DIG commands used by classes.instruments.Oscilloscope.
+
+    Each channel holds a synthetic sine (2 kHz, 50 mV amplitude, channel n phase shifted)
+    with a little white noise, digitised to 16 bits over an 8 division screen. The
+    points are spread over :TIM:RANG once it has been set (SAMPLE_INTERVAL apart before). An
+    acquisition takes one trigger period plus the record length per segment, during which
+    the Run bit of :OPER:COND? is set and *OPC? blocks.
+    """
+    IDN = 'KEYSIGHT TECHNOLOGIES,HD304MSO,SIMULATED,1.0'
+    COMMAND_TIMES = {'*RST': 0.5}
+    FULL_SCALE = 0.8  # Volts across the screen
+    SAMPLE_INTERVAL = 1e-7  # Seconds per point
+    SIGNAL_FREQUENCY = 2000  # Hz, also the trigger rate
+
+    def reset(self):
+        self.settings = {}
+        self.scope = {'source': 1, 'format': 'ASC', 'points': 1000, 'unsigned': True,
+                      'segments': 1, 'segmented': False, 'all_segments': False, 'range': None}
+        self._codes = {}
+        self._blocks = {}
+
+    def _sample_interval(self):
+        if self.scope['range'] is None:
+            return self.SAMPLE_INTERVAL
+        return self.scope['range'] / self.scope['points']
+
+    def _channel_codes(self, channel, points):
+        key = (channel, points, self._sample_interval())
+        if key not in self._codes:
+            rng = np.random.default_rng(channel)
+            t = np.arange(points) * key[2]
+            volts = 0.05 * np.sin(2 * np.pi * self.SIGNAL_FREQUENCY * t + (channel - 1) * np.pi / 2)
+            volts += rng.normal(0, 1e-3, points)
+            codes = np.round(volts / self.FULL_SCALE * 65536 + 32768)
+            self._codes[key] = np.clip(codes, 0, 65535).astype('<u2')
+        return self._codes[key]
+
+    def _preamble(self):
+        fmt = self.scope['format']
+        points = self.scope['points']
+        if fmt == 'BYTE':
+            yinc, yref, fmt_code = self.FULL_SCALE / 256, 128, 0
+        else:
+            yinc, yref, fmt_code = self.FULL_SCALE / 65536, 32768, (1 if fmt == 'WORD' else 4)
+        return f'{fmt_code},0,{points},1,{self._sample_interval():e},0.0,0,{yinc:e},0.0,{yref}'
+
+    def _acquire(self):
+        segments = self.scope['segments'] if self.scope['segmented'] else 1
+        duration = segments * (1 / self.SIGNAL_FREQUENCY + self.scope['points'] * self._sample_interval())
+        self.busy_until = time.time() + duration * self.time_scale
+        # A new acquisition makes previously rendered waveforms stale
+        self._blocks.clear()
+
+    def handle_command(self, header, value):
+        value = value.upper()
+        if not header.endswith('?'):
+            self.settings[header] = value  # So the settings can be read back
+        if header == 'WAV:SOUR':
+            self.scope['source'] = int(value.replace('CHANNEL', '').replace('CHAN', ''))
+        elif header == 'WAV:FORM':
+            self.scope['format'] = value[:4]
+        elif header == 'WAV:POIN':
+            self.scope['points'] = int(value)
+        elif header == 'TIM:RANG':
+            self.scope['range'] = float(value)
+        elif header == 'WAV:UNS':
+            self.scope['unsigned'] = value in ('ON', '1')
+        elif header == 'ACQ:MODE':
+            self.scope['segmented'] = value.startswith('SEGM')
+        elif header == 'ACQ:SEGM:COUN':
+            self.scope['segments'] = int(value)
+        elif header == 'WAV:SEGM:ALL':
+            self.scope['all_segments'] = value in ('ON', '1')
+        elif header in ('DIG', 'SING'):
+            self._acquire()
+        elif header == 'OPER:COND?':
+            return '8' if time.time() < self.busy_until else '0'
+        elif header == 'WAV:PRE?':
+            return self._preamble()
+        elif header == 'WAV:DATA?':
+            return self._waveform_block()
+        elif header.endswith('?'):
+            return NotImplemented
+        return None
+
+    def _waveform_block(self):
+        # Blocks are cached so benchmarks time the transfer and host parsing, not the simulator
+        points = self.scope['points']
+        if self.scope['segmented'] and self.scope['all_segments']:
+            points *= self.scope['segments']
+        key = (self.scope['source'], points, self.scope['format'], self._sample_interval())
+        if key not in self._blocks:
+            codes = self._channel_codes(key[0], key[1])
+            fmt = key[2]
+            if fmt == 'WORD':
+                payload = codes.tobytes()
+            elif fmt == 'BYTE':
+                payload = (codes >> 8).astype(np.uint8).tobytes()
+            else:
+                volts = (codes.astype(np.float64) - 32768) * (self.FULL_SCALE / 65536)
+                payload = ','.join(f'{v:+.5e}' for v in volts).encode('ascii')
+            self._blocks[key] = self.block(payload)
+        return self._blocks[key]
+
+
+# USB vendor::product IDs of the lab instruments and the models that simulate them
+MODELS = {
+    '0X2A8D::0X9101': SimulatedSMU,              # B2901BL SMU
+    '0X0957::0X2807': SimulatedSignalGenerator,  # 33500B waveform generators
+    '0X0957::0X2707': SimulatedSignalGenerator,
+    '0X2A8D::0X4704': SimulatedOscilloscope,     # HD304MSO oscilloscope
+}
@@ -0,0 +1,461 @@
+# Incremental and batched spectral estimators for long recordings, live data and many channels
+import os
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from functools import lru_cache
+import numpy as np
+from numpy.lib.stride_tricks import sliding_window_view
+from scipy import fft as sp_fft
+from scipy import signal, stats
+
+# Above this many bytes of output data batch_transfer_functions spreads the channels over processes
+PROCESS_POOL_BYTES = 256 * 1024 * 1024
+
+
+@lru_cache(maxsize=64)
+def rfft_frequencies(n, sample_rate):
+    """Cached, read-only rfftfreq grid for a transform length, shared by repeated analyses of the same size."""
+    frequencies = np.fft.rfftfreq(n, 1 / sample_rate)
+    frequencies.flags.writeable = False
+    return frequencies
+
+
+@lru_cache(maxsize=64)
+def cached_window(window, n):
+    """Cached, read-only scipy window of length n."""
+    values = signal.get_window(window, n)
+    values.flags.writeable = False
+    return values
+
+
+def transform_length(n, pad=False):
+    """n, or with pad=True the next length >= n that scipy.fft transforms quickly (any small-prime factors)."""
+    return sp_fft.next_fast_len(n, real=True) if pad else n
+
+
+class StreamingWelch:
+    """
+    Welch estimate of Pxx, Pyy and Pxy built up from blocks of samples as they arrive.
+
+    Blocks of any length can be passed to update(); samples that do not yet fill a
+    segment are carried over to the next call, so the result is the same as running
+    scipy.signal.welch/csd on the concatenated signals (constant detrend, density
+    scaling, one-sided). Each segment of each channel is windowed and transformed
+    once and feeds all three spectra. Memory is O(nperseg) apart from the block
+    being processed.
+
+    The output may have several channels, shape (n_channels, n_samples), measured
+    against one shared input: the input segments are then transformed once for all
+    outputs and Pyy, Pxy and H have shape (n_channels, n_frequencies).
+
+    Attributes:
+        sample_rate: Sample rate in Hz.
+        nperseg: Segment length.
+        noverlap: Samples shared by consecutive segments.
+        frequencies: Frequency bins of the spectra.
+        segments: Number of segments averaged so far.
+        workers: scipy.fft worker threads (None for one).
+
+    Methods:
+        update: Adds a block of input and output samples.
+        spectra: Returns the averaged Pxx, Pyy and Pxy.
+        transfer_function: Returns H(f) with the H1, H2 or Hv estimator.
+        coherence: Returns the magnitude squared coherence.
+        confidence: Returns per-bin confidence bounds of H.
+        converged: Whether the estimate is within a tolerance, for stopping the averaging early.
+        reset: Discards everything accumulated.
+    """
+    # Segments transformed per FFT call, bounds the temporary memory for very long blocks
+    SEGMENTS_PER_BATCH = 64
+
+    def __init__(self, sample_rate, nperseg, noverlap=None, window='hann', workers=None):
+        self.sample_rate = sample_rate
+        self.nperseg = int(nperseg)
+        self.noverlap = self.nperseg // 2 if noverlap is None else int(noverlap)
+        if not 0 <= self.noverlap < self.nperseg:
+            raise ValueError("noverlap must be smaller than nperseg")
+        self.step = self.nperseg - self.noverlap
+        self.window = cached_window(window, self.nperseg)
+        # Density scaling, doubled for the one-sided spectrum except at DC (and Nyquist for even nperseg)
+        self.scale = np.full(self.nperseg // 2 + 1, 2.0 / (sample_rate * np.sum(self.window ** 2)))
+        self.scale[0] /= 2
+        if self.nperseg % 2 == 0:
+            self.scale[-1] /= 2
+        self.frequencies = rfft_frequencies(self.nperseg, sample_rate)
+        self.workers = workers  # scipy.fft worker threads
+        self.reset()
+
+    def reset(self):
+        self.segments = 0
+        self._sxx = np.zeros(len(self.frequencies))
+        self._syy = None
+        self._sxy = None
+        self._x = np.zeros(0)
+        self._y = None
+        self._multichannel = False
+
+    def _spectra(self, segments):
+        segments = segments - segments.mean(axis=-1, keepdims=True)
+        return sp_fft.rfft(segments * self.window, axis=-1, workers=self.workers)
+
+    def update(self, x, y):
+        """Add a block of simultaneous input (x) and output (y, one or more channels) samples."""
+        x = np.asarray(x, dtype=np.float64).ravel()
+        y = np.asarray(y, dtype=np.float64)
+        if self._y is None:
+            self._multichannel = y.ndim == 2
+            self._y = np.zeros((len(y) if self._multichannel else 1, 0))
+            self._syy = np.zeros((len(self._y), len(self.frequencies)))
+            self._sxy = np.zeros((len(self._y), len(self.frequencies)), dtype=complex)
+        x = np.concatenate([self._x, x])
+        y = np.concatenate([self._y, y.reshape(len(self._y), -1)], axis=-1)
+        if len(x) != y.shape[-1]:
+            raise ValueError("Input and output blocks must have the same length")
+
+        n_segments = (len(x) - self.nperseg) // self.step + 1 if len(x) >= self.nperseg else 0
+        if n_segments:
+            x_segments = sliding_window_view(x, self.nperseg)[::self.step][:n_segments]
+            y_segments = sliding_window_view(y, self.nperseg, axis=-1)[:, ::self.step][:, :n_segments]
+            for start in range(0, n_segments, self.SEGMENTS_PER_BATCH):
+                X = self._spectra(x_segments[start:start + self.SEGMENTS_PER_BATCH])
+                Y = self._spectra(y_segments[:, start:start + self.SEGMENTS_PER_BATCH])
+                self._sxx += np.sum(X.real ** 2 + X.imag ** 2, axis=0)
+                self._syy += np.sum(Y.real ** 2 + Y.imag ** 2, axis=1)
+                self._sxy += np.sum(np.conj(X) * Y, axis=1)
+            self.segments += n_segments
+
+        # Keep the samples the next segment starts with
+        consumed = n_segments * self.step
+        self._x = x[consumed:].copy()
+        self._y = y[:, consumed:].copy()
+
+    def spectra(self):
+        """Return (frequencies, Pxx, Pyy, Pxy) averaged over the segments so far."""
+        if self.segments == 0:
+            raise ValueError(f"Need at least {self.nperseg} samples for one segment")
+        scale = self.scale / self.segments
+        Pyy, Pxy = self._syy * scale, self._sxy * scale
+        if not self._multichannel:
+            Pyy, Pxy = Pyy[0], Pxy[0]
+        return self.frequencies, self._sxx * scale, Pyy, Pxy
+
+    def transfer_function(self, estimator='H1'):
+        """
+        Return (frequencies, H) using one of the standard estimators:
+        - 'H1' = Pxy / Pxx, unbiased by noise on the output
+        - 'H2' = Pyy / Pyx, unbiased by noise on the input
+        - 'Hv' = total least squares between the two, for noise on both
+        """
+        f, Pxx, Pyy, Pxy = self.spectra()
+        # Small epsilon to avoid division by zero
+        if estimator == 'H1':
+            return f, Pxy / (Pxx + 1e-10 * np.max(Pxx))
+        Pyx = np.conj(Pxy)
+        Pyx = Pyx + 1e-10 * np.max(np.abs(Pyx))
+        if estimator == 'H2':
+            return f, Pyy / Pyx
+        if estimator == 'Hv':
+            difference = Pyy - Pxx
+            return f, (difference + np.sqrt(difference ** 2 + 4 * np.abs(Pxy) ** 2)) / (2 * Pyx)
+        raise ValueError("Estimator must be 'H1', 'H2' or 'Hv'")
+
+    def coherence(self):
+        """Return (frequencies, Cxy) with Cxy = |Pxy|^2 / (Pxx Pyy)."""
+        f, Pxx, Pyy, Pxy = self.spectra()
+        denominator = Pxx * Pyy
+        return f, np.abs(Pxy) ** 2 / np.where(denominator > 0, denominator, np.inf)
+
+    def confidence(self, level=0.95, estimator='H1'):
+        """
+        Per-bin confidence bounds of H from the coherence and the number of averages.
+
+        Uses the confidence circle of Bendat & Piersol: the true H lies within a radius
+        r = |H| * sqrt(F(2, 2n - 2; level) / (n - 1) * (1 - Cxy) / Cxy) of the
+        estimate, n being the number of segments averaged (overlapping segments are not
+        fully independent, so the bounds are slightly optimistic).
+
+        Returns:
+            {'magnitude_low', 'magnitude_high', 'phase_error' (radians), 'relative_error'}
+        """
+        f, H = self.transfer_function(estimator)
+        _, coherence = self.coherence()
+        n = self.segments
+        if n < 2:
+            infinite = np.full(np.shape(H), np.inf)
+            return {'magnitude_low': np.zeros(np.shape(H)), 'magnitude_high': infinite,
+                    'phase_error': np.full(np.shape(H), np.pi), 'relative_error': infinite}
+        f_value = stats.f.ppf(level, 2, 2 * n - 2)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            relative = np.sqrt(f_value / (n - 1) * (1 - coherence) / coherence)
+        relative = np.nan_to_num(relative, nan=np.inf)
+        magnitude = np.abs(H)
+        return {'magnitude_low': magnitude * np.clip(1 - relative, 0, None),
+                'magnitude_high': magnitude * (1 + relative),
+                'phase_error': np.where(relative < 1, np.arcsin(np.clip(relative, 0, 1)), np.pi),
+                'relative_error': relative}
+
+    def converged(self, tolerance=0.01, level=0.95, min_coherence=0.5, estimator='H1'):
+        """
+        True once every bin with coherence >= min_coherence has a relative confidence
+        radius below tolerance, i.e. further averaging would not change H noticeably.
+        """
+        if self.segments < 2:
+            return False
+        _, coherence = self.coherence()
+        relative = self.confidence(level, estimator)['relative_error']
+        usable = coherence >= min_coherence
+        return bool(np.any(usable)) and bool(np.all(relative[usable] <= tolerance))
+
+
+def tone_phasors(signals, frequencies, sample_rate, start=0, window=None, block_size=65536):
+    """
+    Complex amplitude of each signal at each frequency (a vectorised Goertzel / lock-in).
+
+    Each signal is correlated with exp(-j 2 pi f n / fs) at the requested frequencies
+    only, O(N) per tone instead of a full FFT, and the frequencies need not fall on FFT
+    bins. The reference is built once for a block and rotated block by block, so the
+    work is one matrix product per block for every channel and tone together.
+
+    Parameters:
+    - signals: (n_samples,) or (n_channels, n_samples)
+    - frequencies: tone frequencies in Hz
+    - sample_rate: Hz
+    - start: index of the first sample, keeps the phase continuous across blocks of a stream
+    - window: optional window name (e.g. 'hann') to reduce leakage from other tones
+    - block_size: samples per matrix product, bounds the reference's memory
+
+    Returns:
+        (n_channels, n_tones) complex array; abs() is the peak amplitude and angle() the phase.
+    """
+    signals = np.atleast_2d(np.asarray(signals, dtype=np.float64))
+    frequencies = np.atleast_1d(np.asarray(frequencies, dtype=np.float64))
+    n = signals.shape[-1]
+    # Built per call: record lengths vary, and caching full-length windows would keep them all alive
+    weights = signal.get_window(window, n) if window is not None else None
+    step = -2j * np.pi * frequencies / sample_rate
+    reference = np.exp(np.outer(np.arange(min(block_size, n)), step))
+    total = np.zeros((len(signals), len(frequencies)), dtype=complex)
+    for first in range(0, n, block_size):
+        block = signals[:, first:first + block_size]
+        if weights is not None:
+            block = block * weights[first:first + block_size]
+        total += (block @ reference[:block.shape[-1]]) * np.exp(step * (start + first))
+    gain = weights.sum() if weights is not None else n
+    return 2 * total / gain
+
+
+class LockIn:
+    """
+    Streaming lock-in demodulation of an input and outputs at known tone frequencies.
+
+    Blocks are demodulated as they arrive with tone_phasors and the phasors summed,
+    so the estimate improves with every block without keeping the samples. The
+    response is Y/X per tone; settled() reports when it has stopped changing, which
+    also covers the DUT's own settling after a frequency step.
+
+    Attributes:
+        sample_rate: Hz.
+        frequencies: Tone frequencies in Hz.
+        samples: Number of samples demodulated so far.
+        history: Response after each block, newest last.
+
+    Methods:
+        update: Demodulates a block of input and output samples.
+        response: Returns H per output channel and tone.
+        settled: Whether the last few responses agree within a tolerance.
+        reset: Discards everything accumulated.
+    """
+    def __init__(self, sample_rate, frequencies, history=8):
+        self.sample_rate = sample_rate
+        self.frequencies = np.atleast_1d(np.asarray(frequencies, dtype=np.float64))
+        self.history = deque(maxlen=history)
+        self.reset()
+
+    def reset(self):
+        self.samples = 0
+        self._sums = None
+        self.history.clear()
+
+    def update(self, x, y):
+        """Add a block of simultaneous input (x) and output (y, one or more channels) samples."""
+        signals = np.vstack([np.ravel(x), np.atleast_2d(y)])
+        phasors = tone_phasors(signals, self.frequencies, self.sample_rate, start=self.samples) * signals.shape[-1]
+        self._sums = phasors if self._sums is None else self._sums + phasors
+        self.samples += signals.shape[-1]
+        self.history.append(self.response())
+        return self.history[-1]
+
+    def response(self):
+        """Return H of shape (n_channels, n_tones)."""
+        if self._sums is None:
+            raise ValueError("No samples demodulated yet")
+        return self._sums[1:] / self._sums[0]
+
+    def settled(self, tolerance=1e-3, blocks=3):
+        """True once each of the last `blocks` responses lies within a relative tolerance of the newest."""
+        if len(self.history) < blocks:
+            return False
+        latest = self.history[-1]
+        scale = np.abs(latest) + 1e-30
+        return all(np.all(np.abs(previous - latest) <= tolerance * scale)
+                   for previous in list(self.history)[-blocks:-1])
+
+
+def _transfer_function_chunk(stimulus, outputs, sample_rate, method, nperseg, window, workers):
+    # Module level so it can run in a worker process
+    if method == 'welch':
+        welch = StreamingWelch(sample_rate, nperseg, window=window, workers=workers)
+        welch.update(stimulus, outputs)
+        return welch.transfer_function()
+    X = sp_fft.rfft(stimulus, axis=-1, workers=workers)
+    Y = sp_fft.rfft(outputs, axis=-1, workers=workers)
+    # Small epsilon to avoid division by zero
+    epsilon = 1e-10 * np.max(np.abs(X), axis=-1, keepdims=True)
+    return rfft_frequencies(outputs.shape[-1], sample_rate), Y / (X + epsilon)
+
+
+def batch_transfer_functions(stimulus, outputs, sample_rate, method='fft', nperseg=None, window='hann',
+                             workers=-1, processes=None):
+    """
+    Transfer functions of many output channels in one vectorised pass.
+
+    The stimulus is transformed once and shared by every output (or given per
+    channel for the 'fft' method); outputs are transformed together along the last
+    axis with real FFTs on scipy.fft worker threads. Data larger than
+    PROCESS_POOL_BYTES is split by channel across a process pool.
+
+    Parameters:
+    - stimulus: (n_samples,) shared input, or (n_channels, n_samples) for method 'fft'
+    - outputs: (n_channels, n_samples) measured outputs
+    - sample_rate: Hz
+    - method: 'fft' (H = Y / X) or 'welch' (H = Pxy / Pxx)
+    - nperseg: Welch segment length, defaults to n_samples // 8
+    - window: Welch window
+    - workers: scipy.fft threads per process (-1 uses every core)
+    - processes: worker processes, None decides from the data size, 1 disables the pool
+
+    Returns:
+        (frequencies, H): H has shape (n_channels, n_frequencies).
+    """
+    stimulus = np.asarray(stimulus, dtype=np.float64)
+    outputs = np.atleast_2d(np.asarray(outputs, dtype=np.float64))
+    if method not in ('fft', 'welch'):
+        raise ValueError("Method must be 'fft' or 'welch'")
+    if method == 'welch' and stimulus.ndim != 1:
+        raise ValueError("The 'welch' method needs one shared stimulus")
+    if stimulus.shape[-1] != outputs.shape[-1]:
+        raise ValueError("Stimulus and outputs must have the same number of samples")
+    if nperseg is None:
+        nperseg = outputs.shape[-1] // 8
+
+    if processes is None:
+        processes = min(os.cpu_count() or 1, len(outputs)) if outputs.nbytes > PROCESS_POOL_BYTES else 1
+    if processes <= 1 or len(outputs) == 1:
+        return _transfer_function_chunk(stimulus, outputs, sample_rate, method, nperseg, window, workers)
+
+    chunks = [idx for idx in np.array_split(np.arange(len(outputs)), processes) if len(idx)]
+    with ProcessPoolExecutor(processes) as pool:
+        # One FFT thread per process, the processes already use every core
+        futures = [pool.submit(_transfer_function_chunk, stimulus if stimulus.ndim == 1 else stimulus[idx],
+                               outputs[idx], sample_rate, method, nperseg, window, 1) for idx in chunks]
+        results = [future.result() for future in futures]
+    return results[0][0], np.concatenate([H for _, H in results])
+
+
+def fir_from_response(frequencies, H, sample_rate, numtaps, window='hann'):
+    """
+    Design an FIR kernel whose frequency response follows a measured H(f).
+
+    Magnitude and unwrapped phase are interpolated onto the FFT grid of the kernel
+    (interpolating the wrapped phase would smear every +-180 degree jump), the
+    impulse response is obtained with irfft, centred so it is causal and tapered
+    with a window.
+
+    Parameters:
+    - frequencies: frequency bins of H (Hz, increasing)
+    - H: complex response
+    - sample_rate: Hz
+    - numtaps: kernel length, longer kernels resolve finer detail in H
+    - window: taper applied to the impulse response
+
+    Returns:
+        (kernel, delay): delay is the number of samples the kernel's centring adds.
+    """
+    numtaps = int(numtaps)
+    grid = rfft_frequencies(numtaps, sample_rate)
+    magnitude = np.interp(grid, frequencies, np.abs(H))
+    phase = np.interp(grid, frequencies, np.unwrap(np.angle(H)))
+    impulse = sp_fft.irfft(magnitude * np.exp(1j * phase), numtaps)
+    delay = numtaps // 2
+    kernel = np.roll(impulse, delay) * signal.get_window(window, numtaps, fftbins=False)
+    return kernel, delay
+
+
+class OverlapAddFilter:
+    """
+    FIR filter applied with FFT overlap-add, for arbitrarily long or chunked signals.
+
+    The kernel spectrum is computed once. process() accepts chunks of any length and
+    carries the filter tail between calls, so filtering a recording chunk by chunk
+    gives the same result as filtering it in one go, in memory bounded by the block
+    size.
+
+    Attributes:
+        kernel: The FIR kernel.
+        block_size: Input samples per FFT block.
+        n_fft: Transform length (block_size + len(kernel) - 1, rounded up to a fast length).
+
+    Methods:
+        process: Filters the next chunk and returns the same number of output samples.
+        flush: Returns the remaining filter tail and resets the state.
+    """
+    # Blocks transformed per FFT call
+    BLOCKS_PER_BATCH = 16
+
+    def __init__(self, kernel, block_size=None, workers=None):
+        self.kernel = np.asarray(kernel, dtype=np.float64)
+        taps = len(self.kernel)
+        if block_size is None:
+            block_size = max(4 * taps, 4096)
+        # A block at least as long as the tail means each block's tail only reaches the next block
+        self.block_size = max(int(block_size), taps - 1, 1)
+        self.n_fft = sp_fft.next_fast_len(self.block_size + taps - 1, real=True)
+        self.workers = workers
+        self._spectrum = sp_fft.rfft(self.kernel, self.n_fft)
+        self._tail = np.zeros(taps - 1)
+
+    def _convolve(self, blocks):
+        spectra = sp_fft.rfft(blocks, self.n_fft, axis=-1, workers=self.workers)
+        spectra *= self._spectrum
+        return sp_fft.irfft(spectra, self.n_fft, axis=-1, workers=self.workers)[..., :blocks.shape[-1] + len(self._tail)]
+
+    def process(self, chunk):
+        chunk = np.asarray(chunk, dtype=np.float64).ravel()
+        out = np.empty(len(chunk))
+        taps_1 = len(self._tail)
+        n_full = len(chunk) // self.block_size
+        batch = self.BLOCKS_PER_BATCH
+        for first in range(0, n_full, batch):
+            count = min(batch, n_full - first)
+            start = first * self.block_size
+            blocks = chunk[start:start + count * self.block_size].reshape(count, self.block_size)
+            y = self._convolve(blocks)
+            # Overlap-add: each block's tail lands on the start of the next block
+            body = y[:, :self.block_size].copy()
+            if taps_1:
+                body[1:, :taps_1] += y[:-1, self.block_size:]
+                body[0, :taps_1] += self._tail
+                self._tail = y[-1, self.block_size:].copy()
+            out[start:start + count * self.block_size] = body.ravel()
+
+        rest = chunk[n_full * self.block_size:]
+        if len(rest):
+            y = self._convolve(rest[np.newaxis])[0]
+            y[:taps_1] += self._tail
+            out[n_full * self.block_size:] = y[:len(rest)]
+            self._tail = y[len(rest):].copy()
+        return out
+
+    def flush(self):
+        tail, self._tail = self._tail, np.zeros(len(self._tail))
+        return tail
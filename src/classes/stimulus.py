@@ -0,0 +1,170 @@
+# Broadband stimuli that measure a whole frequency response in one acquisition
+import numpy as np
+from scipy import fft as sp_fft
+
+
+def schroeder_multitone(sample_rate, n_samples, f_min, f_max, n_tones=None, spacing='log', amplitude=1.0):
+    """
+    One period of a Schroeder-phase multitone.
+
+    Every tone sits exactly on a bin of the n_samples period, so the period repeats
+    seamlessly when played as an arbitrary waveform and an analysis over whole periods
+    has no leakage. Schroeder phases, -pi*k*(k-1)/K for tone k of K, keep the crest
+    factor near that of a single sine instead of growing with the number of tones, so
+    each tone gets far more of the DAC range than with equal phases.
+
+    Parameters:
+    - sample_rate: samples per second the period will be played at
+    - n_samples: period length, sets the frequency resolution sample_rate / n_samples
+    - f_min, f_max: band to excite (Hz)
+    - n_tones: number of tones, None excites every bin in the band (log spacing may merge a few low tones)
+    - spacing: 'log' or 'linear' tone spacing
+    - amplitude: peak value of the returned samples
+
+    Returns:
+        (samples, frequencies): the period and the excited frequencies in Hz.
+    """
+    resolution = sample_rate / n_samples
+    lowest = max(1, int(np.ceil(f_min / resolution)))
+    highest = min((n_samples - 1) // 2, int(np.floor(f_max / resolution)))
+    if highest < lowest:
+        raise ValueError("No bin of the period falls inside the band, use a longer period")
+    if n_tones is None:
+        bins = np.arange(lowest, highest + 1)
+    elif spacing == 'log':
+        bins = np.unique(np.round(np.geomspace(lowest, highest, n_tones)).astype(int))
+    elif spacing == 'linear':
+        bins = np.unique(np.round(np.linspace(lowest, highest, n_tones)).astype(int))
+    else:
+        raise ValueError("Spacing must be 'log' or 'linear'")
+
+    k = np.arange(1, len(bins) + 1)
+    spectrum = np.zeros(n_samples // 2 + 1, dtype=complex)
+    spectrum[bins] = np.exp(-1j * np.pi * k * (k - 1) / len(bins))
+    samples = sp_fft.irfft(spectrum, n_samples)
+    samples *= amplitude / np.abs(samples).max()
+    return samples, bins * resolution
+
+
+def multitone_response(x, y, sample_rate, frequencies, period):
+    """
+    Demodulate the excited bins of a captured periodic multitone.
+
+    Only the last whole number of periods of the capture is transformed (dropping the
+    start-up transient), so every tone falls on a bin of one real FFT and the other
+    bins are never looked at. Input and output are captured together, which cancels
+    the generator and digitiser responses and the unknown trigger delay.
+
+    Parameters:
+    - x: (n_samples,) captured input
+    - y: (n_samples,) or (n_channels, n_samples) captured outputs
+    - sample_rate: capture sample rate (need not match the rate the stimulus was played at)
+    - frequencies: excited frequencies (Hz), as returned by schroeder_multitone
+    - period: stimulus period in seconds
+
+    Returns:
+        H at frequencies, shape (n_frequencies,) or (n_channels, n_frequencies).
+    """
+    x = np.asarray(x, dtype=float)
+    y = np.asarray(y, dtype=float)
+    period_samples = period * sample_rate
+    periods = int(x.shape[-1] // period_samples)
+    if periods < 1:
+        raise ValueError("The capture must hold at least one period of the stimulus")
+    n = int(round(periods * period_samples))
+    bins = np.round(np.asarray(frequencies) * n / sample_rate).astype(int)
+    X = sp_fft.rfft(x[-n:], workers=-1)[bins]
+    Y = sp_fft.rfft(y[..., -n:], axis=-1, workers=-1)[..., bins]
+    return Y / X
+
+
+def exponential_sweep(sample_rate, duration, f_start, f_stop, amplitude=1.0, fade=0.02):
+    """
+    Exponential (logarithmic) sine sweep and its inverse filter (Farina).
+
+    Convolving the response to the sweep with the inverse filter turns it into an
+    impulse response in which the harmonic distortion products arrive before the
+    linear response, so they can be windowed away. The inverse filter is the time
+    reversed sweep with a 6 dB/octave envelope, scaled for unit gain in the band.
+
+    Parameters:
+    - sample_rate: samples per second
+    - duration: sweep length in seconds
+    - f_start, f_stop: sweep band (Hz)
+    - amplitude: peak value of the sweep
+    - fade: fraction of the sweep faded in and out, limits the splatter of the ends
+
+    Returns:
+        (sweep, inverse) arrays of the same length.
+    """
+    n = int(round(duration * sample_rate))
+    t = np.arange(n) / sample_rate
+    rate = duration / np.log(f_stop / f_start)
+    sweep = np.sin(2 * np.pi * f_start * rate * (np.exp(t / rate) - 1))
+    n_fade = int(fade * n)
+    if n_fade > 1:
+        ramp = np.hanning(2 * n_fade)
+        sweep[:n_fade] *= ramp[:n_fade]
+        sweep[-n_fade:] *= ramp[n_fade:]
+    inverse = sweep[::-1] * np.exp(-t / rate)
+
+    # Unit gain at the geometric centre of the band
+    n_fft = sp_fft.next_fast_len(2 * n - 1, real=True)
+    centre = int(round(np.sqrt(f_start * f_stop) * n_fft / sample_rate))
+    gain = np.abs(sp_fft.rfft(sweep, n_fft)[centre] * sp_fft.rfft(inverse, n_fft)[centre])
+    return amplitude * sweep, inverse / gain
+
+
+def sweep_impulse_responses(captures, inverse):
+    """
+    Deconvolve captured sweep responses with the inverse filter, all channels in one FFT pass.
+
+    Parameters:
+    - captures: (n_samples,) or (n_channels, n_samples)
+    - inverse: inverse filter from exponential_sweep, at the capture sample rate
+
+    Returns:
+        Impulse responses of length n_samples + len(inverse) - 1; the linear response of a
+        sweep starting at sample 0 is at len(inverse) - 1, distortion products before it.
+    """
+    captures = np.asarray(captures, dtype=float)
+    n = captures.shape[-1] + len(inverse) - 1
+    n_fft = sp_fft.next_fast_len(n, real=True)
+    spectra = sp_fft.rfft(captures, n_fft, axis=-1, workers=-1) * sp_fft.rfft(inverse, n_fft)
+    return sp_fft.irfft(spectra, n_fft, axis=-1, workers=-1)[..., :n]
+
+
+def sweep_response(x, y, sample_rate, duration, f_start, f_stop, ir_length=None):
+    """
+    Transfer function from captured input and outputs of an exponential sweep.
+
+    Both channels are deconvolved, the linear impulse response is located on the
+    input, and the same window (which excludes the earlier distortion products) is cut
+    from every channel; H is the ratio of the windowed responses' spectra, so the
+    generator, digitiser and trigger delay cancel out.
+
+    Parameters:
+    - x: (n_samples,) captured input, holding at least one whole sweep
+    - y: (n_samples,) or (n_channels, n_samples) captured outputs
+    - sample_rate: capture sample rate
+    - duration, f_start, f_stop: the sweep that was played
+    - ir_length: impulse response window in samples, None uses the time before the
+      second harmonic (which arrives duration * ln(2) / ln(f_stop / f_start) earlier)
+
+    Returns:
+        (frequencies, H) over the swept band.
+    """
+    _, inverse = exponential_sweep(sample_rate, duration, f_start, f_stop)
+    irs = sweep_impulse_responses(np.vstack([x, np.atleast_2d(y)]), inverse)
+    harmonic_gap = int(duration * np.log(2) / np.log(f_stop / f_start) * sample_rate)
+    if ir_length is None:
+        ir_length = harmonic_gap
+    # Start a little before the peak so the response's own pre-ringing is kept
+    lead = min(harmonic_gap // 8, ir_length // 8)
+    start = max(0, int(np.argmax(np.abs(irs[0]))) - lead)
+    windowed = irs[:, start:start + ir_length]
+    spectra = sp_fft.rfft(windowed, ir_length, axis=-1, workers=-1)
+    frequencies = np.fft.rfftfreq(ir_length, 1 / sample_rate)
+    band = (frequencies >= f_start) & (frequencies <= f_stop)
+    H = spectra[1:, band] / spectra[0, band]
+    return frequencies[band], H[0] if np.ndim(y) == 1 else H
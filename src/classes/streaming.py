@@ -0,0 +1,247 @@
+# Continuous acquisition into fixed size buffers, for monitoring that runs alongside other measurements
+import threading
+import time
+from collections import deque
+import numpy as np
+from classes.async_instruments import executor_for
+
+
+class RingBuffer:
+    """
+    Preallocated single-writer ring buffer of float64 samples.
+
+    The writer copies samples in and then advances written, a plain counter that
+    only ever grows. Readers never take a lock: they read written, copy the samples
+    they want and check afterwards that the writer has not lapped them during the
+    copy. Memory stays at capacity samples however long the acquisition runs.
+
+    Attributes:
+        capacity: Number of samples kept.
+        written: Total number of samples ever written.
+        overruns: Number of reads that lost samples because the writer lapped them.
+
+    Methods:
+        write: Appends samples (writer thread only).
+        latest: Copies the most recent samples.
+        read_since: Copies every sample after a given position, for readers that must not miss any.
+    """
+    def __init__(self, capacity):
+        self.capacity = int(capacity)
+        self.buffer = np.zeros(self.capacity)
+        self.written = 0
+        self.overruns = 0
+
+    def write(self, samples):
+        samples = np.asarray(samples, dtype=np.float64).ravel()
+        if samples.size > self.capacity:
+            samples = samples[-self.capacity:]
+        start = self.written % self.capacity
+        first = min(samples.size, self.capacity - start)
+        self.buffer[start:start + first] = samples[:first]
+        self.buffer[:samples.size - first] = samples[first:]
+        # Publish only after the copy so readers never see half-written samples
+        self.written += samples.size
+
+    def _copy(self, start, end):
+        n = end - start
+        out = np.empty(n)
+        offset = start % self.capacity
+        first = min(n, self.capacity - offset)
+        out[:first] = self.buffer[offset:offset + first]
+        out[first:] = self.buffer[:n - first]
+        return out
+
+    def latest(self, n=None):
+        """Return (up to) the n most recent samples, oldest first."""
+        end = self.written
+        n = self.capacity if n is None else min(int(n), self.capacity)
+        start = max(0, end - n)
+        out = self._copy(start, end)
+        lapped = self.written - self.capacity - start
+        if lapped > 0:
+            # The writer overwrote the oldest samples while they were copied
+            self.overruns += 1
+            out = out[lapped:]
+        return out
+
+    def read_since(self, position):
+        """
+        Return (samples, new_position) for everything written after position.
+
+        Pass the returned position to the next call. If the reader fell more than
+        capacity samples behind, the lost samples are counted in overruns and the
+        oldest samples still held are returned.
+        """
+        end = self.written
+        start = max(position, end - self.capacity)
+        out = self._copy(start, end)
+        lapped = self.written - self.capacity - start
+        if lapped > 0:
+            out = out[lapped:]
+        if start > position or lapped > 0:
+            self.overruns += 1
+        return out, end
+
+
+class CurrentSampler:
+    """
+    Streams the SMU's measured current into a RingBuffer from a background thread.
+
+    The SMU samples on its own timer into its trace buffer (TRAC:FEED:CONT NEXT); the
+    thread repeatedly asks how many samples are new (TRAC:POIN:ACT?) and pulls just
+    those with one TRAC:DATA? binary block. Every transfer runs on the SMU's I/O
+    executor (classes.async_instruments), so it is serialised with the async wrappers'
+    traffic to the same instrument instead of colliding with it.
+
+    The stream is NOT gap-free: the trace buffer holds TRACE_POINTS samples per arm and
+    cannot wrap, so once it is full the trigger system has to be re-armed, and samples
+    are lost for the time that takes. The thread wakes up just as the buffer is due to
+    fill, so each gap is about one fetch and re-arm round trip. The number of samples
+    lost is estimated from the arm times and kept in lost, with the ring buffer
+    position of every gap in gaps.
+
+    Attributes:
+        smu: The SMU being sampled.
+        interval: Seconds between samples on the SMU.
+        ring: The RingBuffer holding the latest samples.
+        rearms: Number of times the trace buffer was re-armed.
+        lost: Estimated number of samples missed while re-arming.
+        gaps: (ring position, samples lost) of the most recent gaps.
+        error: The exception that stopped the thread, if any.
+
+    Methods:
+        start: Configures the SMU and starts the background thread.
+        stop: Stops the thread and the acquisition, restoring the trigger and format settings.
+        latest: Lock-free copy of the most recent samples.
+        stats: Rolling mean, RMS and peak of the most recent samples.
+    """
+    # Largest B2901 trace buffer
+    TRACE_POINTS = 100000
+    # Settings start() changes and stop() restores to their earlier values
+    RESTORED_SETTINGS = (':TRIG:SOUR', ':TRIG:TIM', ':TRIG:COUN', ':SENS:CURR:APER', ':FORM:ELEM:SENS', ':FORM:BORD')
+    # Settings changed along the way that are only dropped from the shadow
+    FORGOTTEN_SETTINGS = (':SENS:FUNC', ':TRAC:FEED', ':TRAC:POIN', ':FORM:DATA')
+
+    def __init__(self, smu, interval=20e-6, capacity=10_000_000, poll_interval=0.05):
+        self.smu = smu
+        self.interval = interval
+        self.poll_interval = poll_interval
+        self.ring = RingBuffer(capacity)
+        self.rearms = 0
+        self.lost = 0
+        self.gaps = deque(maxlen=1000)
+        self.error = None
+        self._fetched = 0
+        self._armed_at = 0.0
+        self._previous = {}
+        self._stop = threading.Event()
+        self._thread = None
+
+    def _io(self, func, *args):
+        return executor_for(self.smu.address).submit(func, *args).result()
+
+    def _arm(self):
+        session = self.smu.session
+        session.write(':TRAC:FEED:CONT NEV;:TRAC:CLE;:TRAC:FEED SENS;'
+                      f':TRAC:POIN {self.TRACE_POINTS};:TRAC:FEED:CONT NEXT')
+        session.write(':INIT:ACQ')
+        armed_at = time.perf_counter()
+        if self._armed_at:
+            # Whatever the old arm could not hold before this one started was not sampled
+            lost = max(0, round((armed_at - self._armed_at) / self.interval) - self.TRACE_POINTS)
+            self.lost += lost
+            self.gaps.append((self.ring.written, lost))
+        self._armed_at = armed_at
+        self._fetched = 0
+
+    def _configure(self, aperture):
+        # Remember the trigger and format settings (one query), stop() puts them back
+        values = self.smu.query(';'.join(header + '?' for header in self.RESTORED_SETTINGS)).strip().split(';')
+        self._previous = dict(zip(self.RESTORED_SETTINGS, values))
+        with self.smu.batch():
+            self.smu.write(':SENS:FUNC "CURR"')
+            self.smu.write(f':SENS:CURR:APER {aperture}')
+            self.smu.write(':TRIG:SOUR TIM')
+            self.smu.write(f':TRIG:TIM {self.interval}')
+            self.smu.write(f':TRIG:COUN {self.TRACE_POINTS}')
+            self.smu.write(':FORM:ELEM:SENS CURR')
+            self.smu.write(':FORM:BORD SWAP')
+        self._arm()
+
+    def _fetch(self):
+        # One count query and, if anything is new, one binary block of just the new samples
+        available = int(float(self.smu.session.query(':TRAC:POIN:ACT?')))
+        if available > self._fetched:
+            data = self.smu.session.query_binary_values(
+                f':FORM:DATA REAL,64;:TRAC:DATA? {self._fetched},{available - self._fetched}',
+                datatype='d', is_big_endian=False, container=np.array)
+            self.smu.session.write(':FORM:DATA ASC')
+            self.ring.write(data)
+            self._fetched += data.size
+        if self._fetched >= self.TRACE_POINTS:
+            self._arm()
+            self.rearms += 1
+        return available
+
+    def _run(self):
+        try:
+            while not self._stop.is_set():
+                self._io(self._fetch)
+                # Wake up as soon as the trace buffer is due to be full, to keep the re-arm gap short
+                full_in = self._armed_at + self.TRACE_POINTS * self.interval - time.perf_counter()
+                self._stop.wait(min(self.poll_interval, max(full_in, 0.001)))
+        except Exception as e:
+            self.error = e
+
+    def start(self, aperture=None):
+        """
+        Configure the SMU trace buffer and start sampling. The output must already be sourcing.
+
+        Parameters:
+        - aperture: integration time per sample in seconds, defaults to 80% of the interval
+        """
+        if self._thread is not None and self._thread.is_alive():
+            return self
+        self._stop.clear()
+        self.error = None
+        self._armed_at = 0.0
+        self._io(self._configure, aperture if aperture is not None else self.interval * 0.8)
+        self._thread = threading.Thread(target=self._run, name=f'sampler-{self.smu.address}', daemon=True)
+        self._thread.start()
+        return self
+
+    def _restore(self):
+        with self.smu.batch():
+            self.smu.write(':ABOR:ACQ')
+            # _arm left the feed on NEXT behind the shadow's back
+            self.smu.write(':TRAC:FEED:CONT NEV', force=True)
+            for header, value in self._previous.items():
+                self.smu.write(f'{header} {value}')
+        # Changed by _configure, _arm and _fetch but not restored, so they are sent the next time
+        for header in self.FORGOTTEN_SETTINGS:
+            self.smu.forget_setting(header)
+
+    def stop(self):
+        """Stop sampling and put back the SMU's trigger and format settings."""
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+        self._io(self._restore)
+
+    def latest(self, n=None):
+        return self.ring.latest(n)
+
+    def stats(self, window=10000):
+        """
+        Rolling statistics of the last window samples, safe to call from the Tk thread.
+
+        Returns:
+            {'mean', 'rms', 'peak', 'samples', 'overruns', 'rearms', 'lost'}
+        """
+        data = self.ring.latest(window)
+        counts = {'samples': self.ring.written, 'overruns': self.ring.overruns, 'rearms': self.rearms,
+                  'lost': self.lost}
+        if data.size == 0:
+            return {'mean': np.nan, 'rms': np.nan, 'peak': np.nan, **counts}
+        return {'mean': float(data.mean()), 'rms': float(np.sqrt(np.dot(data, data) / data.size)),
+                'peak': float(np.abs(data).max()), **counts}
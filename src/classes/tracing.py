@@ -0,0 +1,252 @@
+# Opt-in tracing of every SCPI transaction, for finding where the time of a test run goes
+import atexit
+import json
+import os
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+
+# Set to a file name to trace the whole run and write a Chrome trace there on exit
+TRACE_ENV_VAR = 'LAB_INSTRUMENTS_TRACE'
+
+
+class Tracer:
+    """
+    Records VISA transactions in a fixed size ring buffer.
+
+    Each record is a tuple (start_ns, duration_ns, address, operation, command, n_bytes,
+    thread_id). Appending to a bounded deque is atomic and cheap, so the tracer can stay
+    on for a whole test; once full the oldest records are dropped.
+
+    Attributes:
+        records: The ring buffer of transaction records.
+        dropped: Number of records pushed out of the ring buffer.
+
+    Methods:
+        record: Appends one record.
+        clear: Empties the buffer.
+        chrome_trace: Builds a Chrome trace / Perfetto JSON document.
+        export_chrome_trace: Writes the Chrome trace to a file.
+        latency_report: Per-command latency statistics and histograms as text.
+    """
+    def __init__(self, capacity=100000):
+        self.records = deque(maxlen=capacity)
+        self.dropped = 0
+
+    def record(self, start_ns, duration_ns, address, operation, command, n_bytes):
+        if len(self.records) == self.records.maxlen:
+            self.dropped += 1
+        self.records.append((start_ns, duration_ns, address, operation, command, n_bytes, threading.get_ident()))
+
+    def clear(self):
+        self.records.clear()
+        self.dropped = 0
+
+    def chrome_trace(self):
+        """
+        Build a trace viewable in chrome://tracing or ui.perfetto.dev.
+
+        Each instrument is shown as its own track, spans (see span()) on the track of
+        the thread that ran them, so gaps between bus transactions show up as sleeps
+        or computation.
+        """
+        records = list(self.records)
+        events = []
+        tracks = {}
+        for start_ns, duration_ns, address, operation, command, n_bytes, thread_id in records:
+            track = address if address is not None else f'thread {thread_id}'
+            if track not in tracks:
+                tracks[track] = len(tracks) + 1
+                events.append({'name': 'thread_name', 'ph': 'M', 'pid': 1, 'tid': tracks[track],
+                               'args': {'name': track}})
+            events.append({'name': command, 'cat': operation, 'ph': 'X', 'pid': 1, 'tid': tracks[track],
+                           'ts': start_ns / 1e3, 'dur': duration_ns / 1e3,
+                           'args': {'bytes': n_bytes, 'thread': thread_id}})
+        return {'traceEvents': events, 'displayTimeUnit': 'ms'}
+
+    def export_chrome_trace(self, path):
+        with open(path, 'w') as f:
+            json.dump(self.chrome_trace(), f)
+        return path
+
+    def latency_report(self, bins_per_decade=2):
+        """
+        Summarise latency per command header (values are dropped, so 'VOLT 1' and 'VOLT 2' are one entry).
+
+        Lists count, total, mean, median, 95th percentile and maximum per command,
+        sorted by total time, each followed by a log-scale latency histogram. The header
+        shows how much of the traced wall time was spent on the bus.
+        """
+        records = [r for r in self.records if r[3] != 'span']
+        if not records:
+            return 'No transactions recorded.'
+        by_command = {}
+        for start_ns, duration_ns, address, operation, command, n_bytes, thread_id in records:
+            header = command.split(' ', 1)[0].lstrip(':').upper()
+            by_command.setdefault(f'{operation} {header}', []).append(duration_ns / 1e6)
+
+        first = min(r[0] for r in records)
+        last = max(r[0] + r[1] for r in records)
+        bus = sum(r[1] for r in records)
+        lines = [f'{len(records)} transactions over {(last - first) / 1e6:.1f} ms, '
+                 f'{bus / 1e6:.1f} ms on the bus ({100 * bus / max(last - first, 1):.0f}%), '
+                 f'{sum(r[5] for r in records)} bytes',
+                 f'{"command":32s} {"count":>7s} {"total ms":>10s} {"mean":>8s} {"p50":>8s} {"p95":>8s} {"max":>8s}']
+        for name, latencies in sorted(by_command.items(), key=lambda item: -sum(item[1])):
+            latencies.sort()
+            n = len(latencies)
+            lines.append(f'{name[:32]:32s} {n:7d} {sum(latencies):10.2f} {sum(latencies) / n:8.3f} '
+                         f'{latencies[n // 2]:8.3f} {latencies[min(n - 1, int(0.95 * n))]:8.3f} {latencies[-1]:8.3f}')
+            lines.extend(_histogram_lines(latencies, bins_per_decade))
+
+        spans = {}
+        for r in self.records:
+            if r[3] == 'span':
+                spans[r[4]] = spans.get(r[4], 0) + r[1] / 1e6
+        if spans:
+            lines.append('Host spans (sleeps, waits and computation):')
+            lines.extend(f'    {name:28s} {total:10.2f} ms' for name, total in sorted(spans.items(), key=lambda item: -item[1]))
+        return '\n'.join(lines)
+
+
+def _histogram_lines(latencies_ms, bins_per_decade, width=40):
+    # Log spaced buckets starting at 10 us
+    counts = {}
+    for latency in latencies_ms:
+        bucket = 0
+        edge = 0.01
+        while latency >= edge * 10 ** (1 / bins_per_decade):
+            edge *= 10 ** (1 / bins_per_decade)
+            bucket += 1
+        counts[bucket] = counts.get(bucket, 0) + 1
+    peak = max(counts.values())
+    lines = []
+    for bucket in range(min(counts), max(counts) + 1):
+        low = 0.01 * 10 ** (bucket / bins_per_decade)
+        count = counts.get(bucket, 0)
+        lines.append(f'    {low:9.3f} ms  {"#" * max(count * width // peak, 1 if count else 0):{width}s} {count}')
+    return lines
+
+
+# The active tracer, None when tracing is off
+tracer = None
+
+
+def enable(capacity=100000):
+    """Start tracing every instrument session. Returns the Tracer."""
+    global tracer
+    if tracer is None:
+        tracer = Tracer(capacity)
+    return tracer
+
+
+def disable():
+    """Stop tracing and return the Tracer with what was recorded."""
+    global tracer
+    stopped, tracer = tracer, None
+    return stopped
+
+
+@contextmanager
+def span(name, address=None):
+    """
+    Mark a region of host code (a sleep, an FFT, a GUI callback) in the trace.
+
+    Usage:
+        with tracing.span('fft'):
+            spectrum = np.fft.rfft(data)
+    """
+    active = tracer
+    if active is None:
+        yield
+        return
+    start = time.perf_counter_ns()
+    try:
+        yield
+    finally:
+        active.record(start, time.perf_counter_ns() - start, address, 'span', name, 0)
+
+
+def _size(data):
+    if data is None:
+        return 0
+    if hasattr(data, 'nbytes'):
+        return data.nbytes
+    return len(data)
+
+
+class TracedSession:
+    """
+    Wraps a VISA session and records write, query and read calls while tracing is enabled.
+
+    Everything else (timeout, termination, events, ...) goes straight to the wrapped
+    session. With tracing off the only cost is a check of the module level tracer.
+    """
+    def __init__(self, session, address):
+        object.__setattr__(self, '_session', session)
+        object.__setattr__(self, '_address', address)
+
+    def __getattr__(self, name):
+        return getattr(self._session, name)
+
+    def __setattr__(self, name, value):
+        setattr(self._session, name, value)
+
+    def _traced(self, operation, command, call, *args, **kwargs):
+        active = tracer
+        if active is None:
+            return call(*args, **kwargs)
+        start = time.perf_counter_ns()
+        result = call(*args, **kwargs)
+        n_bytes = len(command) + (_size(result) if operation != 'write' else 0)
+        active.record(start, time.perf_counter_ns() - start, self._address, operation, command, n_bytes)
+        return result
+
+    def write(self, message, *args, **kwargs):
+        return self._traced('write', message, self._session.write, message, *args, **kwargs)
+
+    def query(self, message, *args, **kwargs):
+        return self._traced('query', message, self._session.query, message, *args, **kwargs)
+
+    def read(self, *args, **kwargs):
+        return self._traced('read', '', self._session.read, *args, **kwargs)
+
+    def read_raw(self, *args, **kwargs):
+        return self._traced('read', '', self._session.read_raw, *args, **kwargs)
+
+    def query_binary_values(self, message, *args, **kwargs):
+        return self._traced('query', message, self._session.query_binary_values, message, *args, **kwargs)
+
+    def write_raw(self, message, *args, **kwargs):
+        active = tracer
+        if active is None:
+            return self._session.write_raw(message, *args, **kwargs)
+        start = time.perf_counter_ns()
+        result = self._session.write_raw(message, *args, **kwargs)
+        # Only the header of a binary upload is kept as the command name
+        command = bytes(message[:message.find(b'#')] if b'#' in message[:64] else message[:64])
+        active.record(start, time.perf_counter_ns() - start, self._address, 'write',
+                      command.decode('ascii', 'replace').strip(), len(message))
+        return result
+
+    def write_binary_values(self, message, values, *args, **kwargs):
+        active = tracer
+        if active is None:
+            return self._session.write_binary_values(message, values, *args, **kwargs)
+        start = time.perf_counter_ns()
+        result = self._session.write_binary_values(message, values, *args, **kwargs)
+        active.record(start, time.perf_counter_ns() - start, self._address, 'write', message,
+                      len(message) + _size(values))
+        return result
+
+
+def _export_on_exit(path):
+    if tracer is not None:
+        tracer.export_chrome_trace(path)
+        print(tracer.latency_report())
+
+
+if os.environ.get(TRACE_ENV_VAR):
+    enable()
+    atexit.register(_export_on_exit, os.environ[TRACE_ENV_VAR])
@@ -0,0 +1,136 @@
+# Vectorised parsing of IEEE 488.2 blocks, ASCII waveforms and scope preambles
+import numpy as np
+
+# Preamble fields returned by :WAV:PRE? in order
+PREAMBLE_FIELDS = ('format', 'type', 'points', 'count', 'xincrement', 'xorigin',
+                   'xreference', 'yincrement', 'yorigin', 'yreference')
+
+
+def parse_block_header(buffer):
+    """
+    Locate the payload of an IEEE 488.2 block.
+
+    Handles definite-length blocks (#<n><length><payload>) and indefinite-length
+    blocks (#0<payload><newline>). Leading whitespace before '#' is skipped. Buffers
+    without a '#' header are treated as a bare payload.
+
+    Parameters:
+    - buffer: bytes, bytearray, memoryview or str holding the block
+
+    Returns:
+        (offset, length): where the payload starts and how many bytes it spans.
+    """
+    view = memoryview(buffer.encode('ascii') if isinstance(buffer, str) else buffer).cast('B')
+    start = 0
+    while start < len(view) and view[start] in b' \t\r\n':
+        start += 1
+    if start == len(view) or view[start] != ord('#'):
+        return start, len(view) - start
+
+    n_digits = view[start + 1] - ord('0')
+    if not 0 <= n_digits <= 9:
+        raise ValueError("Malformed IEEE 488.2 block header")
+    offset = start + 2 + n_digits
+    if n_digits == 0:
+        # Indefinite length: the payload runs up to the terminating newline
+        end = len(view)
+        if end > offset and view[end - 1] == ord('\n'):
+            end -= 1
+        return offset, end - offset
+
+    length = int(bytes(view[start + 2:offset]))
+    if offset + length > len(view):
+        raise ValueError(f"Block declares {length} bytes but only {len(view) - offset} were received")
+    return offset, length
+
+
+def parse_binary_block(buffer, dtype='<u2'):
+    """
+    Decode a binary block into a numpy array without copying.
+
+    The returned array is a read-only view on buffer, so it stays valid as long as
+    the buffer does. Use .copy() if the data must outlive or be modified.
+
+    Parameters:
+    - buffer: the raw bytes read from the instrument
+    - dtype: numpy dtype of one sample, e.g. '<u2' for WORD LSBF, 'u1' for BYTE, '<f8' for REAL,64
+
+    Returns:
+        numpy.ndarray view of the payload.
+    """
+    dtype = np.dtype(dtype)
+    offset, length = parse_block_header(buffer)
+    return np.frombuffer(buffer, dtype=dtype, count=length // dtype.itemsize, offset=offset)
+
+
+def parse_ascii_block(buffer, sep=','):
+    """
+    Decode a comma separated ASCII waveform (optionally wrapped in a block header) into float64.
+
+    Parsing happens in C through np.fromstring rather than one float() call per value.
+    Newlines are accepted as separators as well, so one-value-per-line files also work.
+    """
+    offset, length = parse_block_header(buffer)
+    payload = buffer[offset:offset + length]
+    if not isinstance(payload, str):
+        payload = bytes(payload).decode('ascii')
+    if '\n' in payload:
+        payload = payload.replace('\n', sep)
+    return np.fromstring(payload, dtype=np.float64, sep=sep)
+
+
+def parse_preamble(text):
+    """Parse a :WAV:PRE? response into a dict of floats keyed by PREAMBLE_FIELDS."""
+    values = text.strip().split(',')
+    if len(values) < len(PREAMBLE_FIELDS):
+        raise ValueError(f"Preamble has {len(values)} fields, expected {len(PREAMBLE_FIELDS)}")
+    return {name: float(value) for name, value in zip(PREAMBLE_FIELDS, values)}
+
+
+def scale_codes(raw, preamble, out=None):
+    """
+    Convert raw ADC codes to volts: volts = (code - yreference) * yincrement + yorigin.
+
+    The conversion is done with in-place ufuncs so only one float64 array is allocated
+    (or none, if out is given).
+    """
+    out = np.subtract(raw, preamble['yreference'], out=out, dtype=np.float64)
+    out *= preamble['yincrement']
+    out += preamble['yorigin']
+    return out
+
+
+def time_axis(preamble, n_points=None):
+    """Return the sample times (s) described by a preamble."""
+    if n_points is None:
+        n_points = int(preamble['points'])
+    return (np.arange(n_points) - preamble['xreference']) * preamble['xincrement'] + preamble['xorigin']
+
+
+# Bytes an ASCII waveform can consist of, anything else means a binary block
+ASCII_WAVEFORM_BYTES = b'0123456789+-.eE,; \t\r\n'
+
+
+def load_capture_file(path, preamble=None, dtype='<u2'):
+    """
+    Read a saved :WAV:DATA? response (ASCII or binary block) from disk into volts.
+
+    ASCII waveforms, bare or inside a block header, are already in volts. A binary
+    block (recognised by bytes an ASCII waveform cannot contain) holds ADC codes,
+    which are scaled with the preamble saved alongside it.
+
+    Parameters:
+    - path: the file
+    - preamble: dict from parse_preamble, needed to scale binary data; None returns the raw codes
+    - dtype: numpy dtype of one binary sample, '<u2' for WORD LSBF, 'u1' for BYTE
+
+    Returns:
+        numpy.ndarray of float64.
+    """
+    with open(path, 'rb') as f:
+        data = f.read()
+    offset, length = parse_block_header(data)
+    if not data[offset:offset + length].translate(None, ASCII_WAVEFORM_BYTES):
+        return parse_ascii_block(data)
+    codes = parse_binary_block(data, dtype)
+    return scale_codes(codes, preamble) if preamble is not None else codes.astype(np.float64)
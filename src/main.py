@@ -3,6 +3,7 @@
 import tkinter as tk
 from tkinter import ttk
 from classes.GUIs import ManualTestingGUI, AutomatedTestsGUI
+from classes import sessions
 
 
 def main():
@@ -93,6 +94,8 @@ def main():
                 window.destroy()
             except:
                 pass
+        # Close the pooled instrument sessions shared by all windows
+        sessions.close_all()
         root.destroy()
 
     btn_close = ttk.Button(frame, text="Close Application", style='Rounded.TButton', command=close_programme)